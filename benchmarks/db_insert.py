@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#
+# Compares works stored per second by GutenbergDB when each work is committed
+# on its own against storing batches of works in a single transaction. This
+# empties the tables of the database it is given, so point it at a throwaway
+# database
+#
+# python -m benchmarks.db_insert "dbname=bench user=postgres" --works 500 --batch 50
+#
+
+import argparse
+import time
+
+from lib.gutenberg_store import GutenbergDB
+from lib.gutenberg_records import (
+    WorkRecord, InstanceRecord, ItemRecord, SubjectRecord, EntityRecord, IdentifierRecord
+)
+
+
+# The production database provides jarowinkler from an extension, this
+# stands in for it with an exact match
+jaroWinklerStub = """
+    CREATE OR REPLACE FUNCTION jarowinkler(TEXT, TEXT) RETURNS FLOAT AS
+    'SELECT CASE WHEN $1 = $2 THEN 1.0 ELSE 0.0 END' LANGUAGE SQL IMMUTABLE
+"""
+
+# Both methods start from empty tables since most of the lookups made for
+# each work scan the tables being written to
+truncateTables = """
+    TRUNCATE works, instances, items, entities, entity_works, entity_instances,
+    entity_items, subjects, subject_works, identifiers, work_identifiers,
+    instance_identifiers, item_identifiers RESTART IDENTITY
+"""
+
+
+def resetDB(db):
+    db.cursor.execute(truncateTables)
+    db.commitOps()
+    if isinstance(db, GutenbergDB):
+        db.clearCache()
+
+
+def createWork(i):
+    bookID = str(i)
+    return WorkRecord(
+        title="Benchmark Work {}".format(bookID),
+        rights_stmt="Public domain in the USA.",
+        language="en",
+        ids=[
+            IdentifierRecord(type="gutenberg", identifier="gb{}".format(bookID)),
+            IdentifierRecord(type="owi", identifier="owi{}".format(bookID))
+        ],
+        instances=[
+            InstanceRecord(
+                title="Benchmark Work {}".format(bookID),
+                pub_date=1900 + (i % 100),
+                pub_place="New York",
+                publisher="Publisher {}".format(i),
+                extent="300 p.",
+                language="en",
+                isbn=["isbn{}-{}".format(bookID, j) for j in range(3)],
+                oclc=["oclc{}-{}".format(bookID, j) for j in range(3)]
+            )
+            for e in range(4)
+        ] + [InstanceRecord(
+            title="Benchmark Work {}".format(bookID),
+            pub_date=2000,
+            publisher="Project Gutenberg",
+            language="en"
+        )],
+        subjects=[
+            SubjectRecord(authority="lcsh", subject="Subject {}".format((i + j) % 200))
+            for j in range(8)
+        ],
+        entities=[
+            # Authors repeat across works, as they do in the catalog
+            EntityRecord(
+                name="Author {}".format(i % 50),
+                viaf="viaf{}".format(i % 50),
+                role="author"
+            )
+        ]
+    ), [
+        ItemRecord(
+            url="http://www.gutenberg.org/ebooks/{}.epub.{}".format(i, imgs),
+            date_modified="2018-01-01",
+            size=1000
+        )
+        for imgs in ["images", "noimages"]
+    ]
+
+
+def timeSingle(db, records):
+    start = time.perf_counter()
+    for work, epubs in records:
+        db.insert_record(work, epubs)
+    return time.perf_counter() - start
+
+
+def timeBatched(db, records, batchSize):
+    start = time.perf_counter()
+    for i in range(0, len(records), batchSize):
+        db.insert_records(records[i:i + batchSize])
+    return time.perf_counter() - start
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark Postgres work inserts")
+    argParser.add_argument('dsn', help="Connection string for a throwaway database")
+    argParser.add_argument('--works', type=int, default=200, help="Works stored by each method")
+    argParser.add_argument('--batch', type=int, default=50, help="Works per transaction when batched")
+    argParser.add_argument('--cache-size', type=int, default=10000, help="Lookup cache entries per type, 0 to disable")
+    args = argParser.parse_args()
+
+    db = GutenbergDB(dsn=args.dsn, cacheSize=args.cache_size)
+    db.cursor.execute(jaroWinklerStub)
+    db.commitOps()
+
+    records = [createWork(i) for i in range(args.works)]
+
+    resetDB(db)
+    singleTime = timeSingle(db, records)
+    resetDB(db)
+    batchTime = timeBatched(db, records, args.batch)
+    resetDB(db)
+    cacheStats = db.getCacheStats()
+    db.closeAll()
+
+    print("single  {:8.1f} works/sec".format(args.works / singleTime))
+    print("batched {:8.1f} works/sec (batch size {})".format(args.works / batchTime, args.batch))
+    print("Speedup {:.1f}x".format(singleTime / batchTime))
+    for cacheName, stats in cacheStats.items():
+        print("{:<12} cache hit rate {:.3f} ({} hits, {} misses)".format(
+            cacheName,
+            stats["hit_rate"],
+            stats["hits"],
+            stats["misses"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
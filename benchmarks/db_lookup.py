@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+#
+# Measures how the latency of the lookups made during ingest changes as the
+# catalog grows. Fuzzy entity and work lookups are compared between the
+# indexed candidate search and scoring every row, and exact identifier,
+# subject and instance lookups with and without the lookup indexes. The
+# matches the indexed search misses are counted with misspelled lookups
+# scored by a real Jaro-Winkler function. This empties the tables of the
+# database it is given and replaces its jarowinkler function, so point it at
+# a throwaway database
+#
+# python -m benchmarks.db_lookup "dbname=bench user=postgres" --sizes 1000 10000 50000
+#
+
+import argparse
+import random
+import time
+
+from benchmarks.db_insert import jaroWinklerStub, resetDB
+from helpers.migrations import createLookupIndexes, lookupIndexes, fuzzyFields
+from helpers.postgres import postgresManager
+
+# Names and titles are built from syllables so that, as in the real catalog,
+# most words are shared by only a few rows
+syllables = [
+    "al", "ber", "cot", "dan", "el", "fen", "gar", "hol", "is", "jor", "ken", "lin",
+    "mor", "nel", "os", "pet", "quin", "ros", "sel", "tor", "ul", "van", "wes", "yor"
+]
+
+
+# The same scoring as the jarowinkler extension function. It is much slower
+# than the extension, so it is only used to count missed matches
+jaroWinklerFunction = """
+    CREATE OR REPLACE FUNCTION jarowinkler(TEXT, TEXT) RETURNS FLOAT AS $$
+    DECLARE
+        a ALIAS FOR $1;
+        b ALIAS FOR $2;
+        lenA INT := length(a);
+        lenB INT := length(b);
+        matchRange INT := GREATEST(GREATEST(length(a), length(b)) / 2 - 1, 0);
+        matchedA BOOLEAN[];
+        matchedB BOOLEAN[];
+        matches INT := 0;
+        transpositions INT := 0;
+        k INT := 1;
+        prefix INT := 0;
+        jaro FLOAT;
+    BEGIN
+        IF lenA = 0 OR lenB = 0 THEN
+            RETURN 0;
+        END IF;
+        matchedA := array_fill(false, ARRAY[lenA]);
+        matchedB := array_fill(false, ARRAY[lenB]);
+        FOR i IN 1..lenA LOOP
+            FOR j IN GREATEST(1, i - matchRange)..LEAST(lenB, i + matchRange) LOOP
+                IF NOT matchedB[j] AND substr(a, i, 1) = substr(b, j, 1) THEN
+                    matchedA[i] := true;
+                    matchedB[j] := true;
+                    matches := matches + 1;
+                    EXIT;
+                END IF;
+            END LOOP;
+        END LOOP;
+        IF matches = 0 THEN
+            RETURN 0;
+        END IF;
+        FOR i IN 1..lenA LOOP
+            IF matchedA[i] THEN
+                WHILE NOT matchedB[k] LOOP
+                    k := k + 1;
+                END LOOP;
+                IF substr(a, i, 1) <> substr(b, k, 1) THEN
+                    transpositions := transpositions + 1;
+                END IF;
+                k := k + 1;
+            END IF;
+        END LOOP;
+        jaro := (matches::FLOAT / lenA + matches::FLOAT / lenB + (matches - transpositions / 2.0) / matches) / 3;
+        WHILE prefix < LEAST(4, lenA, lenB) AND substr(a, prefix + 1, 1) = substr(b, prefix + 1, 1) LOOP
+            prefix := prefix + 1;
+        END LOOP;
+        RETURN jaro + prefix * 0.1 * (1 - jaro);
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+
+def createWord(rand):
+    return "".join(rand.choice(syllables) for i in range(rand.randint(2, 3))).capitalize()
+
+
+def createNames(count, rand):
+    return [
+        "{}, {} {}".format(createWord(rand), createWord(rand), createWord(rand))
+        for i in range(count)
+    ]
+
+
+def createTitles(count, rand):
+    return [
+        "The {} of {} {}".format(createWord(rand), createWord(rand), createWord(rand))
+        for i in range(count)
+    ]
+
+
+# Each work gets an author, an instance with two identifiers and a few
+# subjects drawn from a shared pool
+def fillCatalog(db, size, rand):
+    resetDB(db)
+    names = createNames(size, rand)
+    titles = createTitles(size, rand)
+    subjects = ["Subject {}".format(i) for i in range(max(size // 10, 1))]
+    subjectIDs = db.insertRows("subjects", ["authority", "subject"], [["lcsh", subject] for subject in subjects])
+    for i in range(0, size, 1000):
+        db.insertRows("entities", ["name", "sort_name"], [[name, name] for name in names[i:i + 1000]])
+        workIDs = db.insertRows("works", ["uuid", "title"], [
+            [format(rand.getrandbits(128), "032x"), title] for title in titles[i:i + 1000]
+        ])
+        instanceIDs = db.insertRows("instances", ["title", "work_id"], [
+            [title, workID] for title, workID in zip(titles[i:i + 1000], workIDs)
+        ])
+        identifierIDs = db.insertRows("identifiers", ["type", "identifier"], [
+            [idType, "{}{}".format(idType, instanceID)]
+            for instanceID in instanceIDs for idType in ["isbn", "oclc"]
+        ])
+        db.insertRows("instance_identifiers", ["instance_id", "identifier_id"], [
+            [instanceIDs[j // 2], identifierID] for j, identifierID in enumerate(identifierIDs)
+        ])
+        db.insertRows("subject_works", ["work_id", "subject_id", "weight"], [
+            [workID, subjectID, 1]
+            for workID in workIDs for subjectID in set(rand.sample(subjectIDs, min(3, len(subjectIDs))))
+        ])
+    db.commitOps()
+    db.cursor.execute("ANALYZE")
+    return names, titles, subjects
+
+
+# A typo in one of the words after the first, as found in catalog records
+def misspell(value, rand):
+    start = value.find(" ") + 1
+    i = rand.randint(start, len(value) - 1)
+    return value[:i] + rand.choice(syllables)[0] + value[i + 1:]
+
+
+def timeLookups(db, modes, lookups):
+    db.fuzzySearch = modes
+    results = []
+    start = time.perf_counter()
+    for table, field, value, score in lookups:
+        match = db.queryJaroWinkler(table, field, value, score)
+        results.append(match["id"] if match else None)
+    elapsed = time.perf_counter() - start
+    return elapsed / len(lookups) * 1000, results
+
+
+def setLookupIndexes(db, enabled):
+    if enabled is True:
+        createLookupIndexes(db.cursor)
+    else:
+        for name, table, columns, unique in lookupIndexes:
+            db.cursor.execute("DROP INDEX IF EXISTS {}".format(name))
+    db.commitOps()
+    db.cursor.execute("ANALYZE")
+
+
+# The same queries GutenbergES makes for each batch of documents, repeated
+# here so the benchmark does not need an ES client
+getInstances = """
+    SELECT id, work_id, title, pub_date, pub_place, publisher, language
+    FROM instances WHERE work_id = ANY($1) ORDER BY id
+"""
+getSubjects = """
+    SELECT sw.work_id, s.authority, s.subject
+    FROM subject_works sw
+    JOIN subjects s ON s.id = sw.subject_id
+    WHERE sw.work_id = ANY($1) ORDER BY sw.id
+"""
+
+
+# The lookups made for each stored work and each document sent to ES
+def timeExactLookups(db, size, subjects, rand, count):
+    lookups = [(rand.randint(1, size), rand.choice(subjects)) for i in range(count)]
+    start = time.perf_counter()
+    for rowID, subject in lookups:
+        db.getByIDs(["isbn{}".format(rowID), "oclc{}".format(rowID)], "instance")
+        db.checkForRow("subjects", {"authority": "lcsh", "subject": subject})
+        db.execSelect(getInstances, [rowID])
+        db.execSelect(getSubjects, [rowID])
+    elapsed = time.perf_counter() - start
+    return elapsed / (count * 4) * 1000
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark Postgres lookups against catalog size")
+    argParser.add_argument('dsn', help="Connection string for a throwaway database")
+    argParser.add_argument('--sizes', type=int, nargs="+", default=[1000, 10000, 50000], help="Catalog sizes to test")
+    argParser.add_argument('--lookups', type=int, default=200, help="Lookups made at each size")
+
+    argParser.add_argument('--recall-size', type=int, default=1000, help="Catalog size missed matches are counted at")
+    argParser.add_argument('--recall-lookups', type=int, default=50, help="Misspelled lookups made to count missed matches")
+    args = argParser.parse_args()
+
+    db = postgresManager(dsn=args.dsn)
+    db.getCursor()
+    db.cursor.execute(jaroWinklerStub)
+    db.commitOps()
+    indexModes = dict(db.fuzzySearch)
+    scanModes = dict((key, "scan") for key in fuzzyFields)
+    print("Indexed candidate search uses {}".format(", ".join(
+        "{} index for {}.{}".format(mode, table, field) for (table, field), mode in indexModes.items()
+    )))
+
+    rand = random.Random(1)
+    print("Fuzzy lookups")
+    for size in args.sizes:
+        names, titles, subjects = fillCatalog(db, size, rand)
+        lookups = []
+        for i in range(args.lookups):
+            lookups.append(("entities", "name", rand.choice(names), 0.8))
+            lookups.append(("works", "title", rand.choice(titles), 0.98))
+
+        scanTime, scanResults = timeLookups(db, scanModes, lookups)
+        indexTime, indexResults = timeLookups(db, indexModes, lookups)
+        mismatches = sum(1 for i, res in enumerate(scanResults) if res != indexResults[i])
+        print("{:>8} rows  scan {:8.3f}ms  indexed {:8.3f}ms  mismatches {}".format(
+            size,
+            scanTime,
+            indexTime,
+            mismatches
+        ))
+
+    # Matches scoring every row finds that the indexed search does not
+    print("Missed matches")
+    db.cursor.execute(jaroWinklerFunction)
+    db.commitOps()
+    names, titles, subjects = fillCatalog(db, args.recall_size, rand)
+    for table, field, values, score in [("entities", "name", names, 0.8), ("works", "title", titles, 0.98)]:
+        lookups = [(table, field, misspell(rand.choice(values), rand), score) for i in range(args.recall_lookups)]
+        scanTime, scanResults = timeLookups(db, scanModes, lookups)
+        indexTime, indexResults = timeLookups(db, indexModes, lookups)
+        found = sum(1 for res in scanResults if res is not None)
+        missed = sum(1 for i, res in enumerate(scanResults) if res is not None and res != indexResults[i])
+        print("{:>8} {}.{}  found {:4}  missed {:4}".format(args.recall_size, table, field, found, missed))
+    db.cursor.execute(jaroWinklerStub)
+    db.commitOps()
+
+    print("Exact lookups")
+    for size in args.sizes:
+        names, titles, subjects = fillCatalog(db, size, rand)
+        setLookupIndexes(db, False)
+        withoutTime = timeExactLookups(db, size, subjects, rand, args.lookups)
+        setLookupIndexes(db, True)
+        withTime = timeExactLookups(db, size, subjects, rand, args.lookups)
+        print("{:>8} works  without indexes {:8.3f}ms  with indexes {:8.3f}ms".format(
+            size,
+            withoutTime,
+            withTime
+        ))
+
+    resetDB(db)
+    db.closeAll()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+
+#
+# Measures the throughput of the full GutenbergBib ingest over a fixed corpus.
+# The fixture RDF files are read with MW and OCLC answered from recorded
+# responses, works are stored in a throwaway Postgres started with
+# testing.postgresql, epubs are served from memory and documents are sent to
+# a stub ES endpoint, so a run never touches the network and can be repeated.
+# Works per second, the latency of each stage and peak RSS are compared with
+# a stored baseline and the run fails if any of them has regressed
+#
+# python -m benchmarks.ingest --save-baseline
+# python -m benchmarks.ingest
+#
+# An existing throwaway database can be used in place of testing.postgresql.
+# Its tables are emptied before every round
+#
+# python -m benchmarks.ingest --dsn "dbname=bench user=postgres host=/tmp/pg"
+#
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from psycopg2.extensions import parse_dsn
+
+from benchmarks.db_insert import jaroWinklerStub, resetDB
+
+fixtureDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "fixtures")
+baselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_baseline.json")
+
+# Stage latencies of a millisecond or so are mostly noise, so a stage has to
+# be slower than its baseline by this much as well as by the tolerance
+stageFloorMs = 0.5
+
+
+# Answers every request the ES client makes with a success. Bulk requests
+# get one item result per action so the bulk helper sees every document as
+# indexed
+class StubESHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self._respond(200, None)
+
+    def do_GET(self):
+        self._respond(200, {})
+
+    def do_DELETE(self):
+        self._respond(200, {"acknowledged": True})
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        stats = self.server.stats
+        if self.path.split("?")[0].endswith("/_bulk"):
+            items = self._bulkItems(body)
+            with self.server.lock:
+                stats["requests"] += 1
+                stats["documents"] += len(items)
+                stats["bytes"] += len(body)
+            self._respond(200, {"took": 1, "errors": False, "items": items})
+            return
+
+        with self.server.lock:
+            stats["requests"] += 1
+            stats["documents"] += 1
+            stats["bytes"] += len(body)
+        self._respond(201, {
+            "_id": self.path.split("?")[0].rstrip("/").split("/")[-1],
+            "_version": 1,
+            "result": "created",
+            "_shards": {"total": 1, "successful": 1, "failed": 0}
+        })
+
+    def _bulkItems(self, body):
+        items = []
+        lines = iter(line for line in body.split(b"\n") if line.strip())
+        for line in lines:
+            opType, meta = next(iter(json.loads(line).items()))
+            if opType != "delete":
+                next(lines, None)
+            items.append({opType: {"_id": meta.get("_id"), "status": 200 if opType == "delete" else 201}})
+        return items
+
+    def _respond(self, status, payload):
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubES:
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubESHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.stats = {"requests": 0, "documents": 0, "bytes": 0}
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def getStats(self):
+        with self.server.lock:
+            return dict(self.server.stats)
+
+    def resetStats(self):
+        with self.server.lock:
+            self.server.stats = {"requests": 0, "documents": 0, "bytes": 0}
+
+
+# Stands in for the pooled HTTP client when epubs are fetched. Each URL gets
+# its own fixed body of the given size, so the fetcher streams, hashes and
+# writes the same bytes on every run
+class ReplayResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.headers = {}
+        self.body = body
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class ReplayHTTP:
+
+    def __init__(self, epubSize):
+        self.epubSize = epubSize
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        seed = hashlib.sha256(url.encode("utf-8")).digest()
+        body = (seed * (self.epubSize // len(seed) + 1))[:self.epubSize]
+        return ReplayResponse(body)
+
+    def close(self):
+        pass
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.timings = {}
+
+    def wrap(self, stage, func):
+        timings = self.timings.setdefault(stage, [])
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.append((time.perf_counter() - start) * 1000)
+        return timed
+
+    def getStats(self):
+        return dict(
+            (stage, summarize(timings)) for stage, timings in self.timings.items() if len(timings) > 0
+        )
+
+
+def percentile(timings, pct):
+    return timings[min(len(timings) - 1, int(math.ceil(len(timings) * pct)) - 1)]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "mean": round(statistics.mean(timings), 3),
+        "p50": round(percentile(timings, 0.5), 3),
+        "p95": round(percentile(timings, 0.95), 3),
+        "p99": round(percentile(timings, 0.99), 3)
+    }
+
+
+# Peak resident memory of this process. Linux reports it in kilobytes and
+# macOS in bytes
+def getPeakRSS():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+# Everything in the ingest reads gutenberg.conf from the working directory,
+# so the run gets its own config pointing at the throwaway services. The
+# database connection is made from db, user and password, with the host and
+# port passed through the libpq environment
+def writeConfig(workDir, dsn, esPort, args):
+    dsnParts = parse_dsn(dsn)
+    for part, env in [("host", "PGHOST"), ("port", "PGPORT")]:
+        if part in dsnParts:
+            os.environ[env] = dsnParts[part]
+
+    config = {
+        "postgresql": {
+            "db": dsnParts["dbname"],
+            "user": dsnParts.get("user", "postgres"),
+            "password": dsnParts.get("password", "")
+        },
+        "elasticsearch": {
+            "host": "127.0.0.1",
+            "port": esPort,
+            "bulk": str(args.bulk).lower()
+        },
+        "api_keys": {"wskey": "benchmark"},
+        "enrichment": {"async": str(args.enrich_async).lower()},
+        "http_cache": {"enabled": "true", "path": os.path.join(workDir, "http_cache")},
+        "ingest": {"manifest": os.path.join(workDir, "manifest.db"), "batch_size": args.batch},
+        "reindex": {"queue": "false"},
+        "epubs": {"path": os.path.join(workDir, "epubs")}
+    }
+    os.makedirs(config["epubs"]["path"], exist_ok=True)
+    with open(os.path.join(workDir, "gutenberg.conf"), "w") as configFile:
+        for section, fields in config.items():
+            configFile.write("[{}]\n".format(section))
+            for field, value in fields.items():
+                configFile.write("{}: {}\n".format(field, value))
+            configFile.write("\n")
+
+
+# The recorded responses are listed by URL in index.json and loaded into a
+# response cache that the ingest then reads in cache only mode
+def seedResponses(responseDir):
+    from helpers.config import GutenbergConfig
+    from lib.gutenberg_parse import createResponseCache
+
+    responseCache = createResponseCache(GutenbergConfig(), True, None)
+    with open(os.path.join(responseDir, "index.json")) as indexFile:
+        recorded = json.load(indexFile)
+    for response in recorded:
+        with open(os.path.join(responseDir, response["file"]), "rb") as bodyFile:
+            responseCache.put(response["url"], bodyFile.read())
+    responseCache.close()
+    return len(recorded)
+
+
+def instrument(bib, timer):
+    bib.loadBib = timer.wrap("parse", bib.loadBib)
+    bib.mwReader.getMWData = timer.wrap("mw", bib.mwReader.getMWData)
+    bib.oclcReader.getOCLCData = timer.wrap("oclc", bib.oclcReader.getOCLCData)
+    if bib.enricher is not None:
+        bib.enricher.enhance = timer.wrap("enrich", bib.enricher.enhance)
+    bib.dbConnector.insert_record = timer.wrap("store", bib.dbConnector.insert_record)
+    bib.dbConnector.insert_records = timer.wrap("store", bib.dbConnector.insert_records)
+    bib.fetchEpubs = timer.wrap("fetch", bib.fetchEpubs)
+    # Single works are sent through storeWorks as well
+    if bib.esConnector is not None:
+        bib.esConnector.storeWorks = timer.wrap("index", bib.esConnector.storeWorks)
+
+
+def runRound(db, corpusDir, timer, http):
+    from lib.gutenberg_parse import GutenbergBib
+
+    resetDB(db)
+    bib = GutenbergBib(corpusDir, cacheOnly=True, http=http)
+    instrument(bib, timer)
+    bookIDs = sorted(os.listdir(bib.epubDir))
+
+    start = time.perf_counter()
+    bib.readBooks(bookIDs)
+    elapsed = time.perf_counter() - start
+
+    db.cursor.execute("SELECT COUNT(*) AS works FROM works")
+    works = db.cursor.fetchone()["works"]
+    db.commitOps()
+    return works, elapsed, bib.responseCache.misses
+
+
+def runBenchmark(args, dsn, workDir):
+    from helpers.metrics import metrics
+    from helpers.postgres import postgresManager
+
+    esStub = StubES()
+    esStub.start()
+    writeConfig(workDir, dsn, esStub.port, args)
+    os.chdir(workDir)
+    responses = seedResponses(args.responses)
+
+    # Connecting brings the schema up to date before the first round. The
+    # production database gets jarowinkler from an extension
+    db = postgresManager(dsn=dsn)
+    db.cursor.execute("SELECT 1 FROM pg_proc WHERE proname = 'jarowinkler'")
+    if db.cursor.rowcount < 1:
+        db.cursor.execute(jaroWinklerStub)
+    db.commitOps()
+
+    http = ReplayHTTP(args.epub_kb * 1024)
+    for i in range(args.warmup):
+        runRound(db, args.corpus, StageTimer(), http)
+    esStub.resetStats()
+    metrics.reset()
+
+    timer = StageTimer()
+    totalWorks = 0
+    totalTime = 0
+    misses = 0
+    for i in range(args.rounds):
+        works, elapsed, roundMisses = runRound(db, args.corpus, timer, http)
+        totalWorks += works
+        totalTime += elapsed
+        misses += roundMisses
+
+    resetDB(db)
+    db.closeAll()
+    esStub.stop()
+
+    return {
+        "settings": {
+            "corpus": os.path.basename(os.path.normpath(args.corpus)),
+            "rounds": args.rounds,
+            "batch": args.batch,
+            "bulk": args.bulk,
+            "async": args.enrich_async,
+            "epub_kb": args.epub_kb
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform()
+        },
+        "recorded_responses": responses,
+        "replay_misses": misses,
+        "works": totalWorks,
+        "elapsed": round(totalTime, 3),
+        "works_per_sec": round(totalWorks / totalTime, 2) if totalTime > 0 else 0,
+        "stages": timer.getStats(),
+        "peak_rss_mb": getPeakRSS(),
+        "es": esStub.getStats(),
+        # The ingest's own timers break the stages down by reader request
+        # and database helper, for tracking down where a regression is
+        "metrics": metrics.getSummary()
+    }
+
+
+def printResult(result):
+    print("Stored {} works in {:.3f}s over {} rounds".format(
+        result["works"],
+        result["elapsed"],
+        result["settings"]["rounds"]
+    ))
+    print("{:8.1f} works/sec".format(result["works_per_sec"]))
+    for stage, stats in result["stages"].items():
+        print("{:<8} n {:5}  mean {:8.3f}ms  p50 {:8.3f}ms  p95 {:8.3f}ms  p99 {:8.3f}ms".format(
+            stage,
+            stats["count"],
+            stats["mean"],
+            stats["p50"],
+            stats["p95"],
+            stats["p99"]
+        ))
+    print("Peak RSS {:.1f}MB".format(result["peak_rss_mb"]))
+    print("ES stub received {} requests for {} documents".format(
+        result["es"]["requests"],
+        result["es"]["documents"]
+    ))
+
+
+# Returns a description of each measure that is worse than the baseline by
+# more than the tolerance
+def findRegressions(result, baseline, tolerance):
+    regressions = []
+    if result["works_per_sec"] < baseline["works_per_sec"] * (1 - tolerance):
+        regressions.append("works/sec {} against baseline {}".format(
+            result["works_per_sec"],
+            baseline["works_per_sec"]
+        ))
+    for stage, stats in baseline["stages"].items():
+        current = result["stages"].get(stage)
+        if current is None:
+            continue
+        for measure in ["p50", "p95"]:
+            limit = max(stats[measure] * (1 + tolerance), stats[measure] + stageFloorMs)
+            if current[measure] > limit:
+                regressions.append("{} {} {}ms against baseline {}ms".format(
+                    stage,
+                    measure,
+                    current[measure],
+                    stats[measure]
+                ))
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append("peak RSS {}MB against baseline {}MB".format(
+            result["peak_rss_mb"],
+            baseline["peak_rss_mb"]
+        ))
+    return regressions
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark the full ingest against a stored baseline")
+    argParser.add_argument('--dsn', default=None, help="Connection string for a throwaway database, otherwise one is started with testing.postgresql")
+    argParser.add_argument('--corpus', default=os.path.join(fixtureDir, "catalog"), help="Catalog directory of RDF files")
+    argParser.add_argument('--responses', default=os.path.join(fixtureDir, "responses"), help="Directory of recorded MW and OCLC responses")
+    argParser.add_argument('--rounds', type=int, default=40, help="Times the corpus is ingested, each into empty tables")
+    argParser.add_argument('--warmup', type=int, default=1, help="Untimed rounds run first")
+    argParser.add_argument('--batch', type=int, default=1, help="Works stored per transaction")
+    argParser.add_argument('--bulk', action='store_true', help="Send documents with the ES bulk API")
+    argParser.add_argument('--async', dest='enrich_async', action='store_true', help="Make the MW and OCLC lookups concurrently")
+    argParser.add_argument('--epub-kb', type=int, default=256, help="Size of each served epub")
+    argParser.add_argument('--baseline', default=baselineFile, help="Baseline file to compare with or save to")
+    argParser.add_argument('--save-baseline', action='store_true', help="Store this run as the baseline")
+    argParser.add_argument('--tolerance', type=float, default=0.25, help="Fraction a measure can be worse than the baseline")
+    argParser.add_argument('--output', default=None, help="Write the full result to this file as JSON")
+    args = argParser.parse_args()
+
+    for pathArg in ["corpus", "responses", "baseline"]:
+        setattr(args, pathArg, os.path.abspath(getattr(args, pathArg)))
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+
+    workDir = tempfile.mkdtemp(prefix="gutenberg_bench_")
+    postgresql = None
+    startDir = os.getcwd()
+    try:
+        dsn = args.dsn
+        if dsn is None:
+            import testing.postgresql
+            postgresql = testing.postgresql.Postgresql()
+            dsn = "dbname={database} user={user} host={host} port={port}".format(**postgresql.dsn())
+        result = runBenchmark(args, dsn, workDir)
+    finally:
+        os.chdir(startDir)
+        if postgresql is not None:
+            postgresql.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    printResult(result)
+    if args.output is not None:
+        with open(args.output, "w") as outputFile:
+            json.dump(result, outputFile, indent=4)
+
+    # A replay that misses a recorded response drops the book, which would
+    # otherwise show up as a faster run
+    if result["replay_misses"] > 0:
+        print("FAILED {} requests were not in the recorded responses".format(result["replay_misses"]))
+        raise SystemExit(1)
+
+    if args.save_baseline is True:
+        with open(args.baseline, "w") as baselineOut:
+            json.dump(result, baselineOut, indent=4)
+        print("Saved baseline to {}".format(args.baseline))
+        return
+
+    if os.path.isfile(args.baseline) is False:
+        print("No baseline at {}, run with --save-baseline to store one".format(args.baseline))
+        return
+
+    with open(args.baseline) as baselineIn:
+        baseline = json.load(baselineIn)
+    if baseline["settings"] != result["settings"]:
+        print("Baseline was recorded with {}, rerun with the same settings".format(json.dumps(baseline["settings"])))
+        raise SystemExit(2)
+
+    regressions = findRegressions(result, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    if len(regressions) > 0:
+        raise SystemExit(1)
+    print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+#
+# Compares the per-file parse time of the single pass RDF extractor in
+# gutenbergXML against the original per-field XPath searches, and checks that
+# both produce the same metadata for every file
+#
+# python -m benchmarks.xml_parse files/gutenberg_catalog/cache/epub --limit 1000
+#
+
+import argparse
+import math
+import os
+import statistics
+import time
+
+from lib.gutenberg_xml import gutenbergXML
+
+
+def findRDFFiles(epubDir, limit):
+    rdfFiles = []
+    for bookID in sorted(os.listdir(epubDir)):
+        rdfDir = os.path.join(epubDir, bookID)
+        if os.path.isdir(rdfDir) is False:
+            continue
+        for rdfFile in os.listdir(rdfDir):
+            rdfFiles.append(os.path.join(rdfDir, rdfFile))
+        if limit is not None and len(rdfFiles) >= limit:
+            break
+    return rdfFiles
+
+
+def timeParser(parser, rdfFiles, repeat):
+    timings = []
+    results = []
+    for rdfFile in rdfFiles:
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            book = parser.load(rdfFile)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append(repr(book))
+        timings.append(best * 1000)
+    return timings, results
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(math.ceil(len(timings) * 0.95)) - 1)]
+    print("{:<12} mean {:8.3f}ms  median {:8.3f}ms  p95 {:8.3f}ms  total {:8.1f}ms".format(
+        name,
+        statistics.mean(timings),
+        statistics.median(timings),
+        p95,
+        sum(timings)
+    ))
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark RDF parsing")
+    argParser.add_argument('epubDir', help="Directory of RDF files as laid out in the Gutenberg catalog")
+    argParser.add_argument('--limit', type=int, default=None, help="Maximum number of files to parse")
+    argParser.add_argument('--repeat', type=int, default=3, help="Parses per file, the fastest is kept")
+    args = argParser.parse_args()
+
+    rdfFiles = findRDFFiles(args.epubDir, args.limit)
+    print("Parsing {} RDF files".format(len(rdfFiles)))
+
+    xpathTimes, xpathResults = timeParser(gutenbergXML(singlePass=False), rdfFiles, args.repeat)
+    singleTimes, singleResults = timeParser(gutenbergXML(singlePass=True), rdfFiles, args.repeat)
+
+    summarize("xpath", xpathTimes)
+    summarize("single pass", singleTimes)
+    print("Speedup {:.1f}x".format(sum(xpathTimes) / sum(singleTimes)))
+
+    mismatches = [rdfFiles[i] for i, res in enumerate(xpathResults) if res != singleResults[i]]
+    for rdfFile in mismatches:
+        print("MISMATCH {}".format(rdfFile))
+    if len(mismatches) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
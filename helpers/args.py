@@ -12,3 +12,21 @@ class GutenbergArgs:
         self.parser.add_argument('-f', '--full', action='store_true', help="Run a full import")
         self.parser.add_argument('--DROPDB', action='store_true', help="Drop and recreate the database")
         self.parser.add_argument('-l', '--level', help="Set the log level")
+        self.parser.add_argument('-w', '--workers', type=int, default=1, help="Number of parallel ingest processes")
+        self.parser.add_argument('-p', '--pipeline', action='store_true', help="Run parsing, enrichment, storage and indexing as concurrent stages")
+        self.parser.add_argument('-s', '--stream', action='store_true', help="Parse RDF files while streaming the catalog download instead of extracting it to disk")
+        self.parser.add_argument('-c', '--catalog-file', help="Read books from a combined RDF catalog file")
+        self.parser.add_argument('--cache-only', action='store_true', help="Replay MW and OCLC responses from the response cache without network requests")
+
+
+class ReindexArgs:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="""
+            Send works queued by ingest from Postgres to Elasticsearch
+        """)
+
+        self.parser.add_argument('-a', '--all', action='store_true', help="Queue every stored work before reindexing")
+        self.parser.add_argument('-r', '--rebuild', action='store_true', help="Load every stored work into a new index and move the alias to it")
+        self.parser.add_argument('--follow', action='store_true', help="Keep polling the queue for new works")
+        self.parser.add_argument('-b', '--batch-size', type=int, help="Works claimed from the queue at a time")
+        self.parser.add_argument('-l', '--level', default="info", help="Set the log level")
@@ -0,0 +1,312 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import sqlite3
+import requests
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# This mimics the parts of a requests response that the readers use so that
+# a cached body can be handed back in place of a live request
+class CachedResponse:
+
+    def __init__(self, url, status_code, content, fromCache=True):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.fromCache = fromCache
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.HTTPError("{} for {}".format(self.status_code, self.url))
+
+
+class ResponseCache:
+
+    # Query parameters that are dropped before a URL is hashed. These are
+    # credentials and do not change the content of the response
+    ignoredParams = ["wskey"]
+
+    # Reads only note when each response was last used, so the access times
+    # are written together once this many have built up rather than with a
+    # commit for every hit
+    accessBatch = 100
+
+    def __init__(self, cacheDir, maxSize, cacheOnly=False, upstream=requests):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.cacheOnly = cacheOnly
+        self.upstream = upstream
+
+        # Each endpoint is registered as (name, URL prefix, ttl in seconds)
+        self.endpoints = []
+
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}
+
+        # The cache is shared by the threads of the async enrichment stage so
+        # access to the index is serialized here
+        self.lock = threading.RLock()
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+        self.index = sqlite3.connect(
+            os.path.join(self.cacheDir, "index.db"),
+            timeout=30,
+            check_same_thread=False
+        )
+        # The index only records what is already in the body files, so it is
+        # not synced to disk on every commit
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key         TEXT PRIMARY KEY,
+                url         TEXT NOT NULL,
+                endpoint    TEXT NOT NULL,
+                size        INTEGER NOT NULL,
+                stored      REAL NOT NULL,
+                accessed    REAL NOT NULL
+            )
+        """)
+        self.index.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        # The total size of the stored bodies is kept up to date as responses
+        # are stored and removed, since summing it for every write grows with
+        # the size of the cache. Every process using the cache shares it
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS cache_size (
+                id          INTEGER PRIMARY KEY CHECK (id = 0),
+                total       INTEGER NOT NULL
+            )
+        """)
+        self.index.execute("""
+            INSERT OR IGNORE INTO cache_size (id, total)
+            SELECT 0, COALESCE(SUM(size), 0) FROM responses
+        """)
+        self.index.commit()
+
+    def addEndpoint(self, name, prefix, ttl):
+        self.endpoints.append((name, prefix, ttl))
+
+    # This has the same signature as requests.get so the cache can be handed
+    # to anything that would otherwise make the request itself
+    def get(self, url):
+        key = self.createKey(url)
+        endpoint, ttl = self._matchEndpoint(url)
+
+        with self.lock:
+            cached = self._load(key, ttl)
+            if cached is not None:
+                self.hits += 1
+                return CachedResponse(url, 200, cached)
+            self.misses += 1
+
+        if self.cacheOnly is True:
+            self.logger.debug("Cache miss in cache only mode for {}".format(url))
+            return CachedResponse(url, 504, b"", fromCache=False)
+
+        resp = self.upstream.get(url)
+        if resp.status_code == 200:
+            with self.lock:
+                self._store(key, url, endpoint, resp.content)
+        return resp
+
+    # Stores a response body that was fetched elsewhere, such as a recorded
+    # response that a replay is seeded with
+    def put(self, url, body):
+        endpoint, ttl = self._matchEndpoint(url)
+        with self.lock:
+            self._store(self.createKey(url), url, endpoint, body)
+
+    # URLs are normalized before hashing so that the same request made with
+    # a different API key or parameter order maps to the same entry
+    def createKey(self, url):
+        parts = urlsplit(url)
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key not in ResponseCache.ignoredParams
+        )
+        normalized = urlunsplit((
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path,
+            urlencode(query),
+            ""
+        ))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _matchEndpoint(self, url):
+        for name, prefix, ttl in self.endpoints:
+            if url.startswith(prefix):
+                return name, ttl
+        return "default", None
+
+    def _bodyPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def _load(self, key, ttl):
+        row = self.index.execute(
+            "SELECT stored FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        now = time.time()
+        # Expired entries are still served for replays since there is no
+        # way of getting a fresh copy
+        if ttl is not None and row[0] + ttl < now and self.cacheOnly is False:
+            return None
+
+        try:
+            with open(self._bodyPath(key), "rb") as bodyFile:
+                body = bodyFile.read()
+        except FileNotFoundError:
+            self._delete(key)
+            return None
+
+        self.accessed[key] = now
+        if len(self.accessed) >= ResponseCache.accessBatch:
+            self._writeAccessed()
+        return body
+
+    def _writeAccessed(self):
+        if len(self.accessed) < 1:
+            return
+        self.index.executemany(
+            "UPDATE responses SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self.accessed.items()]
+        )
+        self.index.commit()
+        self.accessed = {}
+
+    def _store(self, key, url, endpoint, body):
+        bodyPath = self._bodyPath(key)
+        os.makedirs(os.path.dirname(bodyPath), exist_ok=True)
+        tmpPath = "{}.{}.{}.tmp".format(bodyPath, os.getpid(), threading.get_ident())
+        with open(tmpPath, "wb") as bodyFile:
+            bodyFile.write(body)
+        os.replace(tmpPath, bodyPath)
+
+        # The write lock is taken up front so that the size being replaced
+        # cannot change before the total is adjusted
+        now = time.time()
+        self.index.execute("BEGIN IMMEDIATE")
+        row = self.index.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.index.execute("""
+            INSERT OR REPLACE INTO responses (key, url, endpoint, size, stored, accessed)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (key, self._stripParams(url), endpoint, len(body), now, now))
+        self.index.execute(
+            "UPDATE cache_size SET total = total + ? WHERE id = 0",
+            (len(body) - (row[0] if row is not None else 0),)
+        )
+        self.index.commit()
+        self._evict()
+
+    # Drop the least recently read responses until the cache is back under
+    # its size limit
+    def _evict(self):
+        total = self.getSize()
+        if total <= self.maxSize:
+            return
+
+        # Pending access times are written first so recently read responses
+        # are not the ones evicted
+        self._writeAccessed()
+        rows = self.index.execute("SELECT key, size FROM responses ORDER BY accessed")
+        evicted = []
+        for key, size in rows.fetchall():
+            if total <= self.maxSize:
+                break
+            evicted.append(key)
+            total -= size
+
+        self.logger.debug("Evicting {} cached responses".format(len(evicted)))
+        for key in evicted:
+            self._delete(key)
+
+    def _delete(self, key):
+        try:
+            os.remove(self._bodyPath(key))
+        except FileNotFoundError:
+            pass
+        self.index.execute("BEGIN IMMEDIATE")
+        row = self.index.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.index.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.index.execute("UPDATE cache_size SET total = total - ? WHERE id = 0", (row[0],))
+        self.index.commit()
+
+    # The stored URL is only kept for debugging, so keys are stripped out
+    def _stripParams(self, url):
+        parts = urlsplit(url)
+        query = [
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key not in ResponseCache.ignoredParams
+        ]
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+    def getSize(self):
+        return self.index.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def getStats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def close(self):
+        self.logger.info("Response cache: {}".format(json.dumps(self.getStats())))
+        with self.lock:
+            self._writeAccessed()
+        self.index.close()
+
+
+# A size bounded, least recently used map for database lookups that repeat
+# across works. Values are row IDs so a miss is returned as None
+class LookupCache:
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxSize < 1:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def getStats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0,
+            "size": len(self.entries)
+        }
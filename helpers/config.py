@@ -20,8 +20,18 @@ class GutenbergConfig:
             sys.exit(1)
         return True
 
-    def getConfigValue(self, section, field):
+    # Optional settings pass a fallback that is used when the section or
+    # field is missing from gutenberg.conf
+    def getConfigValue(self, section, field, fallback=None):
+        if fallback is not None:
+            return self.config.get(section, field, fallback=fallback)
         return self.config[section][field]
 
+    def getConfigInt(self, section, field, fallback):
+        return self.config.getint(section, field, fallback=fallback)
+
+    def getConfigFlag(self, section, field, fallback=False):
+        return self.config.getboolean(section, field, fallback=fallback)
+
     def getConfigSection(self, section):
         return self.config[section]
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+class AsyncFetcher:
+
+    def __init__(self, getter=requests.get, hostLimit=4, threads=16):
+        self.logger = logging.getLogger('guten_logs')
+
+        # The blocking getter is run in a thread pool, the event loop only
+        # decides how many of these calls can be in flight per host
+        self.getter = getter
+        self.hostLimit = hostLimit
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+        self.semaphores = {}
+        self.inFlight = defaultdict(int)
+
+    async def get(self, url):
+        host = urlparse(url).netloc
+        async with self._getSemaphore(host):
+            self.inFlight[host] += 1
+            self.logger.debug("Fetching {} ({} in flight)".format(url, self.inFlight[host]))
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, self.getter, url)
+            finally:
+                self.inFlight[host] -= 1
+
+    async def getAll(self, urls):
+        return await asyncio.gather(*[self.get(url) for url in urls])
+
+    # Semaphores are created on first use so that they are bound to the loop
+    # that is running the enrichment rather than the one present at startup
+    def _getSemaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.hostLimit)
+        return self.semaphores[host]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
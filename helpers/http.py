@@ -0,0 +1,89 @@
+import json
+import logging
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from helpers.config import GutenbergConfig
+
+class HTTPClient:
+
+    retryStatuses = [429, 500, 502, 503, 504]
+
+    def __init__(self):
+        self.logger = logging.getLogger('guten_logs')
+
+        config = GutenbergConfig()
+        self.timeout = (
+            config.getConfigInt("http", "connect_timeout", 10),
+            config.getConfigInt("http", "read_timeout", 60)
+        )
+        retries = Retry(
+            total=config.getConfigInt("http", "retries", 3),
+            backoff_factor=float(config.getConfigValue("http", "backoff", "0.5")),
+            status_forcelist=HTTPClient.retryStatuses,
+            raise_on_status=False
+        )
+
+        # A single session is shared by every reader so that connections to
+        # each host are kept alive and reused rather than opened per request
+        self.session = requests.Session()
+        self.adapters = []
+        defaultSize = config.getConfigInt("http", "pool_size", 10)
+        defaultAdapter = self._createAdapter(defaultSize, retries)
+        self.session.mount("http://", defaultAdapter)
+        self.session.mount("https://", defaultAdapter)
+
+        # Hosts can be given their own pool size as host=size pairs. requests
+        # picks the adapter with the longest matching prefix for each URL
+        hostSizes = config.getConfigValue("http", "host_pool_sizes", "")
+        for hostSize in filter(None, hostSizes.split(",")):
+            host, size = hostSize.strip().split("=")
+            hostAdapter = self._createAdapter(int(size), retries)
+            self.session.mount("http://{}/".format(host), hostAdapter)
+            self.session.mount("https://{}/".format(host), hostAdapter)
+
+        # The pipeline's enrich workers share one client, so the count is
+        # only changed under the lock
+        self.statsLock = threading.Lock()
+        self.requests = 0
+
+    def _createAdapter(self, size, retries):
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size, max_retries=retries)
+        self.adapters.append(adapter)
+        return adapter
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with self.statsLock:
+            self.requests += 1
+        return self.session.get(url, **kwargs)
+
+    # Each urllib3 pool counts the connections it has opened and the requests
+    # it has sent over them, anything above one request per connection was
+    # made over a kept-alive connection
+    def getStats(self):
+        with self.statsLock:
+            requestCount = self.requests
+        stats = {
+            "requests": requestCount,
+            "connections": 0,
+            "reused": 0,
+            "hosts": {}
+        }
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats["hosts"][pool.host] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests
+                }
+                stats["connections"] += pool.num_connections
+                stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+        return stats
+
+    def close(self):
+        self.logger.info("HTTP connections: {}".format(json.dumps(self.getStats())))
+        self.session.close()
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from helpers.config import GutenbergConfig
+
+# Upper bounds, in seconds, of the buckets that timings are counted into.
+# Only the counts are kept, so a timer costs the same however many calls it
+# sees and a run of the whole catalog is summarized in a few hundred numbers
+timerBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Timers and counters for the stages of the ingest. A single registry is
+# kept for each process and can be written to from any thread
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.started = time.time()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # Times every call of the decorated function or method
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def timedFunc(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return timedFunc
+        return decorator
+
+    def observe(self, name, seconds):
+        bucket = bisect.bisect_left(timerBuckets, seconds)
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = self._createTimer()
+            timer["count"] += 1
+            timer["total"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            timer["buckets"][bucket] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def getSnapshot(self):
+        with self.lock:
+            return {
+                "timers": dict(
+                    (name, dict(timer, buckets=list(timer["buckets"])))
+                    for name, timer in self.timers.items()
+                ),
+                "counters": dict(self.counters)
+            }
+
+    # Returns everything recorded since the last drain and starts again from
+    # nothing. Pool workers send this back with each shard so that the
+    # coordinator can merge it into its own registry
+    def drain(self):
+        with self.lock:
+            snapshot = {"timers": self.timers, "counters": self.counters}
+            self.timers = {}
+            self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, other in snapshot["timers"].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = self._createTimer()
+                timer["count"] += other["count"]
+                timer["total"] += other["total"]
+                timer["max"] = max(timer["max"], other["max"])
+                timer["buckets"] = [a + b for a, b in zip(timer["buckets"], other["buckets"])]
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Timers are listed by the total time spent in them, so the stages that
+    # take up most of a run come first. Percentiles are the upper bound of
+    # the bucket they fall in
+    def getSummary(self):
+        snapshot = self.getSnapshot()
+        timers = sorted(snapshot["timers"].items(), key=lambda timer: timer[1]["total"], reverse=True)
+        return {
+            "elapsed": round(time.time() - self.started, 1),
+            "timers": dict(
+                (name, {
+                    "count": timer["count"],
+                    "total_sec": round(timer["total"], 3),
+                    "mean_ms": round(timer["total"] / timer["count"] * 1000, 3),
+                    "p50_ms": self._getPercentile(timer, 0.5),
+                    "p95_ms": self._getPercentile(timer, 0.95),
+                    "max_ms": round(timer["max"] * 1000, 3)
+                })
+                for name, timer in timers
+            ),
+            "counters": dict(sorted(snapshot["counters"].items()))
+        }
+
+    # Timers are written as histograms and counters as totals, both labelled
+    # with their names, in the Prometheus text format
+    def getPrometheus(self):
+        snapshot = self.getSnapshot()
+        lines = [
+            "# HELP gutenberg_duration_seconds Time spent in each stage of the ingest",
+            "# TYPE gutenberg_duration_seconds histogram"
+        ]
+        for name, timer in sorted(snapshot["timers"].items()):
+            cumulative = 0
+            for bound, bucketCount in zip(timerBuckets + ("+Inf",), timer["buckets"]):
+                cumulative += bucketCount
+                lines.append('gutenberg_duration_seconds_bucket{{name="{}",le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('gutenberg_duration_seconds_sum{{name="{}"}} {}'.format(name, repr(timer["total"])))
+            lines.append('gutenberg_duration_seconds_count{{name="{}"}} {}'.format(name, timer["count"]))
+
+        lines.append("# HELP gutenberg_events_total Events counted during the ingest")
+        lines.append("# TYPE gutenberg_events_total counter")
+        for name, amount in sorted(snapshot["counters"].items()):
+            lines.append('gutenberg_events_total{{name="{}"}} {}'.format(name, amount))
+        return "\n".join(lines) + "\n"
+
+    # A process forked while the reporter held the lock would never see it
+    # released, and would count its parent's timings again when merged back
+    def _afterFork(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def _createTimer(self):
+        return {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(timerBuckets) + 1)}
+
+    def _getPercentile(self, timer, pct):
+        target = timer["count"] * pct
+        seen = 0
+        for bound, bucketCount in zip(timerBuckets, timer["buckets"]):
+            seen += bucketCount
+            if seen >= target:
+                return round(min(bound, timer["max"]) * 1000, 3)
+        return round(timer["max"] * 1000, 3)
+
+
+metrics = Metrics()
+os.register_at_fork(after_in_child=metrics._afterFork)
+
+
+# Logs a summary of the metrics at a fixed interval and when stopped, and
+# optionally writes them out as a Prometheus text file and as JSON. The files
+# are replaced whole so that a collector never reads a partial write
+class MetricsReporter:
+
+    def __init__(self, registry=metrics):
+        self.logger = logging.getLogger('guten_logs')
+        self.registry = registry
+
+        config = GutenbergConfig()
+        self.interval = config.getConfigInt("metrics", "interval", 60)
+        self.prometheusFile = config.getConfigValue("metrics", "prometheus_file", "")
+        self.jsonFile = config.getConfigValue("metrics", "json_file", "")
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.report()
+
+    def report(self):
+        summary = self.registry.getSummary()
+        self.logger.info("Metrics: {}".format(json.dumps(summary)))
+        if self.prometheusFile:
+            self._writeFile(self.prometheusFile, self.registry.getPrometheus())
+        if self.jsonFile:
+            self._writeFile(self.jsonFile, json.dumps(summary, indent=4))
+
+    def _run(self):
+        while self.stopped.wait(self.interval) is False:
+            self.report()
+
+    def _writeFile(self, path, contents):
+        tmpPath = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmpPath, "w") as outFile:
+                outFile.write(contents)
+            os.replace(tmpPath, path)
+        except OSError as err:
+            self.logger.warning("Could not write metrics to {}".format(path))
+            self.logger.debug(err)
@@ -0,0 +1,352 @@
+import logging
+import psycopg2
+
+# The schema is built up by a numbered list of migrations. Each one is applied
+# once, in order, and recorded in the schema_migrations table. Changes to the
+# schema are made by adding a migration to the end of the list, never by
+# editing one that may already have been applied
+
+# Any fixed key works, it only has to be the same for every process
+migrationLock = 72017
+
+tableDDL = [
+    """
+        CREATE TABLE IF NOT EXISTS works (
+            id              SERIAL PRIMARY KEY,
+            uuid            UUID NOT NULL,
+            title           TEXT NOT NULL,
+            rights_stmt     TEXT NULL,
+            rights_url      VARCHAR(125) NULL,
+            rights_source   VARCHAR(125) NULL,
+            rights_access   VARCHAR(25) NULL,
+            date_created    TIMESTAMP NOT NULL DEFAULT NOW(),
+            date_updated    TIMESTAMP NOT NULL DEFAULT NOW(),
+            geo_coverage    VARCHAR(255) NULL,
+            temp_coverage   VARCHAR(255) NULL,
+            summary         TEXT NULL,
+            language        CHAR(2) NOT NULL DEFAULT 'en'
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS instances (
+            id              SERIAL PRIMARY KEY,
+            title           TEXT NOT NULL,
+            pub_date        INT NULL,
+            pub_place       VARCHAR(255) NULL,
+            publisher       VARCHAR(255) NULL,
+            extent          VARCHAR(255) NULL,
+            edition         VARCHAR(125) NULL,
+            edition_stmt    VARCHAR(125) NULL,
+            summary         TEXT NULL,
+            issuance        VARCHAR(255) NULL,
+            copyright_date  DATE NULL,
+            toc             TEXT NULL,
+            language        CHAR(2) NULL,
+            work_id         INT REFERENCES works(id)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS items (
+            id              SERIAL PRIMARY KEY,
+            url             VARCHAR(255) NOT NULL,
+            epub_path       VARCHAR(255) NULL,
+            source          VARCHAR(255) NULL,
+            date_modified   DATE NULL,
+            size            INT NULL,
+            checksum        CHAR(32) NULL,
+            access_policy   SMALLINT NOT NULL,
+            instance_id     INT REFERENCES instances(id)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS entities (
+            id              SERIAL PRIMARY KEY,
+            name            VARCHAR(255) NOT NULL,
+            sort_name       VARCHAR(255) NOT NULL,
+            viaf            VARCHAR(125) NULL,
+            lcnaf           VARCHAR(125) NULL,
+            birth           SMALLINT NULL,
+            death           SMALLINT NULL,
+            wikipedia       VARCHAR(125) NULL,
+            aliases         VARCHAR(255) NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS entity_works (
+            id              SERIAL PRIMARY KEY,
+            work_id         INT REFERENCES works(id),
+            entity_id       INT REFERENCES entities(id),
+            role            VARCHAR(50) NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS entity_instances (
+            id              SERIAL PRIMARY KEY,
+            instance_id     INT REFERENCES instances(id),
+            entity_id       INT REFERENCES entities(id),
+            role            VARCHAR(50) NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS entity_items (
+            id              SERIAL PRIMARY KEY,
+            item_id         INT REFERENCES items(id),
+            entity_id       INT REFERENCES entities(id),
+            role            VARCHAR(50) NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS subjects (
+            id              SERIAL PRIMARY KEY,
+            authority       VARCHAR(125) NOT NULL,
+            uri             VARCHAR(255) NULL,
+            subject         TEXT NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS subject_works (
+            id              SERIAL PRIMARY KEY,
+            work_id         INT REFERENCES works(id),
+            subject_id      INT REFERENCES subjects(id),
+            weight          FLOAT(5) NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS identifiers (
+            id              SERIAL PRIMARY KEY,
+            type            VARCHAR(125) NOT NULL,
+            identifier      VARCHAR(255) NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS work_identifiers (
+            id              SERIAL PRIMARY KEY,
+            work_id         INT REFERENCES works(id),
+            identifier_id   INT REFERENCES identifiers(id)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS instance_identifiers (
+            id              SERIAL PRIMARY KEY,
+            instance_id     INT REFERENCES instances(id),
+            identifier_id   INT REFERENCES identifiers(id)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS item_identifiers (
+            id              SERIAL PRIMARY KEY,
+            item_id         INT REFERENCES items(id),
+            identifier_id   INT REFERENCES identifiers(id)
+        )
+    """
+]
+
+# Columns searched with queryJaroWinkler in postgresManager
+fuzzyFields = [
+    ("entities", "name"),
+    ("works", "title")
+]
+
+# Indexes for the lookups made while storing and indexing each work, as
+# (name, table, columns, unique)
+lookupIndexes = [
+    ("identifiers_identifier", "identifiers", ["identifier"], False),
+    ("work_identifiers_link", "work_identifiers", ["work_id", "identifier_id"], True),
+    ("work_identifiers_identifier", "work_identifiers", ["identifier_id"], False),
+    ("instance_identifiers_link", "instance_identifiers", ["instance_id", "identifier_id"], True),
+    ("instance_identifiers_identifier", "instance_identifiers", ["identifier_id"], False),
+    ("item_identifiers_link", "item_identifiers", ["item_id", "identifier_id"], True),
+    ("item_identifiers_identifier", "item_identifiers", ["identifier_id"], False),
+    ("instances_work", "instances", ["work_id"], False),
+    ("items_instance", "items", ["instance_id"], False),
+    ("subjects_heading", "subjects", ["authority", "subject"], True),
+    ("subject_works_link", "subject_works", ["work_id", "subject_id"], True),
+    ("subject_works_subject", "subject_works", ["subject_id"], False),
+    ("entity_works_link", "entity_works", ["work_id", "entity_id", "role"], True),
+    ("entity_works_entity", "entity_works", ["entity_id"], False),
+    ("entity_instances_instance", "entity_instances", ["instance_id"], False),
+    ("entity_items_item", "entity_items", ["item_id"], False),
+    ("entities_viaf", "entities", ["viaf"], False),
+    ("entities_lcnaf", "entities", ["lcnaf"], False)
+]
+
+# Link rows that appear more than once, by the columns that should be unique
+duplicateLinks = [
+    ("work_identifiers", ["work_id", "identifier_id"]),
+    ("instance_identifiers", ["instance_id", "identifier_id"]),
+    ("item_identifiers", ["item_id", "identifier_id"]),
+    ("subject_works", ["work_id", "subject_id"]),
+    ("entity_works", ["work_id", "entity_id", "role"])
+]
+
+
+def createTables(cursor):
+    for tableStmt in tableDDL:
+        cursor.execute(tableStmt)
+
+
+# Fuzzy matches use pg_trgm indexes where the extension can be installed.
+# Otherwise candidates are found through a full text index on the words of
+# each name and title, which only needs core Postgres but will miss matches
+# that differ by a whole word.
+#
+# Ingest looks up each work before inserting it, so new rows are added to the
+# index straight away rather than queued in the GIN pending list, which every
+# lookup would otherwise have to scan
+def createFuzzyIndexes(cursor):
+    cursor.execute("SAVEPOINT fuzzy_extension")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        trigram = True
+    except psycopg2.Error:
+        logging.getLogger('guten_logs').warning(
+            "pg_trgm is not available, using word index for fuzzy matches"
+        )
+        cursor.execute("ROLLBACK TO SAVEPOINT fuzzy_extension")
+        trigram = False
+
+    for table, field in fuzzyFields:
+        if trigram is True:
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS {}_{}_trgm ON {}
+                USING GIN ({} gin_trgm_ops) WITH (fastupdate = off)
+            """.format(table, field, table, field))
+        else:
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS {}_{}_tokens ON {}
+                USING GIN (to_tsvector('simple', {})) WITH (fastupdate = off)
+            """.format(table, field, table, field))
+
+
+# Earlier versions could store the same subject or link more than once. These
+# are merged before the unique indexes are created
+def removeDuplicates(cursor):
+    duplicateSubjects = """
+        SELECT id, MIN(id) OVER (PARTITION BY authority, subject) AS keep_id
+        FROM subjects
+    """
+    cursor.execute("""
+        UPDATE subject_works sw SET subject_id = d.keep_id FROM ({}) AS d
+        WHERE sw.subject_id = d.id AND d.id <> d.keep_id
+    """.format(duplicateSubjects))
+    cursor.execute("""
+        DELETE FROM subjects s USING ({}) AS d
+        WHERE s.id = d.id AND d.id <> d.keep_id
+    """.format(duplicateSubjects))
+
+    for table, columns in duplicateLinks:
+        matches = " AND ".join(["a.{} = b.{}".format(col, col) for col in columns])
+        cursor.execute("""
+            DELETE FROM {} a USING {} b WHERE {} AND a.id > b.id
+        """.format(table, table, matches))
+
+
+def createLookupIndexes(cursor):
+    removeDuplicates(cursor)
+    for name, table, columns, unique in lookupIndexes:
+        cursor.execute("""
+            CREATE {}INDEX IF NOT EXISTS {} ON {} ({})
+        """.format("UNIQUE " if unique else "", name, table, ", ".join(columns)))
+
+
+# Works that have been written to since they were last sent to ES. Each work
+# is queued once, however many times it changes before the reindex worker
+# gets to it, and is not tied to the works table so that deletions can be
+# queued as well
+def createReindexQueue(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reindex_queue (
+            work_id         INT PRIMARY KEY,
+            deleted         BOOLEAN NOT NULL DEFAULT FALSE,
+            queued          TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS reindex_queue_queued ON reindex_queue (queued)
+    """)
+
+
+# Epubs are fetched after their items are stored. The validators from the
+# last download are kept so that the next ingest can make a conditional
+# request for the same file
+def addItemFetchState(cursor):
+    cursor.execute("""
+        ALTER TABLE items
+            ADD COLUMN IF NOT EXISTS etag VARCHAR(255) NULL,
+            ADD COLUMN IF NOT EXISTS last_modified VARCHAR(64) NULL
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS items_url ON items (url)
+    """)
+
+
+# Queued works are claimed by the reindex process for a limited time rather
+# than taken off the queue, so a batch that never reaches ES is sent again
+def addReindexClaims(cursor):
+    cursor.execute("""
+        ALTER TABLE reindex_queue
+            ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP NULL
+    """)
+
+
+migrations = [
+    (1, "create_tables", createTables),
+    (2, "fuzzy_indexes", createFuzzyIndexes),
+    (3, "lookup_indexes", createLookupIndexes),
+    (4, "reindex_queue", createReindexQueue),
+    (5, "item_fetch_state", addItemFetchState),
+    (6, "reindex_claims", addReindexClaims)
+]
+
+
+class SchemaMigrator:
+
+    def __init__(self, conn):
+        self.logger = logging.getLogger('guten_logs')
+        self.conn = conn
+
+    # Every ingest worker opens its own connection, so an advisory lock makes
+    # sure only one of them applies the pending migrations. The others wait
+    # and then find nothing left to do
+    def migrate(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", [migrationLock])
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version         INT PRIMARY KEY,
+                    name            VARCHAR(125) NOT NULL,
+                    applied         TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+            """)
+            self.conn.commit()
+
+            applied = self.getApplied(cursor)
+            for version, name, migration in migrations:
+                if version in applied:
+                    continue
+                self.logger.info("Applying schema migration {} {}".format(version, name))
+                migration(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    [version, name]
+                )
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [migrationLock])
+            self.conn.commit()
+            cursor.close()
+
+    def getApplied(self, cursor):
+        cursor.execute("SELECT version FROM schema_migrations")
+        return set(row[0] for row in cursor.fetchall())
+
+    def getVersion(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT MAX(version) FROM schema_migrations")
+        version = cursor.fetchone()[0]
+        cursor.close()
+        return version
@@ -0,0 +1,221 @@
+import json
+import time
+import queue
+import logging
+import threading
+
+class PipelineStage:
+
+    # The handler is called with an item and the worker's context and returns
+    # the item to pass on, or None to drop it. Raising marks the item as
+    # failed. When a batch size is given the handler is instead called with a
+    # list of up to that many items and returns a list in the same order,
+    # where an exception in place of an item marks that item alone as failed.
+    # Each worker calls setup once to create its own context, so nothing that
+    # holds a connection is shared between them
+    def __init__(self, name, handler, workers=1, batchSize=None, setup=None, teardown=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batchSize = batchSize
+        self.setup = setup
+        self.teardown = teardown
+
+        self.inbox = None
+        self.running = 0
+        self.working = 0
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def getStats(self, elapsed):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queued": self.inbox.qsize() if self.inbox is not None else 0,
+                "processed": self.processed,
+                "failed": self.failed,
+                "per_sec": round(self.processed / elapsed, 2) if elapsed > 0 else 0,
+                "busy": round(self.busy / (elapsed * self.workers), 3) if elapsed > 0 else 0
+            }
+
+
+class Pipeline:
+
+    # Put on a stage's queue once for each of its workers when there is
+    # nothing more to come
+    done = object()
+
+    # Seconds a worker waits for more items before handling a partial batch
+    batchWait = 0.5
+
+    def __init__(self, stages, queueSize=100, statsInterval=60, keyFunc=repr):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.stages = stages
+        self.queueSize = queueSize
+        self.statsInterval = statsInterval
+        self.keyFunc = keyFunc
+
+        self.lock = threading.Lock()
+        self.started = None
+        self.completed = 0
+        self.failures = []
+
+    # Every stage reads from its own bounded queue and writes to the next
+    # one. The source is read in the calling thread, so when the first stage
+    # falls behind the source waits, and a slow stage further on holds up the
+    # stages before it in the same way rather than letting items pile up in
+    # memory. Returns a summary of the run
+    def run(self, source):
+        for stage in self.stages:
+            stage.inbox = queue.Queue(maxsize=self.queueSize)
+            stage.running = stage.workers
+            stage.working = stage.workers
+        self.started = time.perf_counter()
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._runWorker,
+                    args=(index,),
+                    name="{}-{}".format(stage.name, worker),
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        stopped = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(stopped,), daemon=True)
+        monitor.start()
+
+        try:
+            for item in source:
+                self.stages[0].inbox.put(item)
+        finally:
+            for worker in range(self.stages[0].workers):
+                self.stages[0].inbox.put(Pipeline.done)
+            for thread in threads:
+                thread.join()
+            stopped.set()
+            monitor.join()
+
+        summary = self.getSummary()
+        self.logger.info("Pipeline stages: {}".format(json.dumps(summary["stages"])))
+        return summary
+
+    def getStats(self):
+        elapsed = time.perf_counter() - self.started
+        return dict((stage.name, stage.getStats(elapsed)) for stage in self.stages)
+
+    def getSummary(self):
+        with self.lock:
+            return {
+                "processed": self.completed,
+                "failed": list(self.failures),
+                "elapsed": round(time.perf_counter() - self.started, 3),
+                "stages": self.getStats()
+            }
+
+    def _runWorker(self, index):
+        stage = self.stages[index]
+        outbox = self.stages[index + 1].inbox if index + 1 < len(self.stages) else None
+        context = None
+        try:
+            if stage.setup is not None:
+                context = stage.setup()
+            while True:
+                batch, finished = self._takeBatch(stage)
+                if len(batch) > 0:
+                    self._handleBatch(stage, batch, context, outbox)
+                if finished is True:
+                    break
+        except Exception as err:
+            # The other workers of the stage carry on with the queue. Once none
+            # are left the rest of the queue is failed so that the stages
+            # before it are not left waiting
+            self.logger.error("PIPELINE WORKER FAILED IN {}".format(stage.name))
+            self.logger.debug(err)
+            with stage.lock:
+                stage.working -= 1
+                lastWorker = stage.working == 0
+            if lastWorker is True:
+                self._drain(stage, err)
+        finally:
+            if stage.teardown is not None and context is not None:
+                stage.teardown(context)
+            self._finishWorker(index)
+
+    def _takeBatch(self, stage):
+        item = stage.inbox.get()
+        if item is Pipeline.done:
+            return [], True
+        batch = [item]
+        while len(batch) < (stage.batchSize or 1):
+            try:
+                item = stage.inbox.get(timeout=Pipeline.batchWait)
+            except queue.Empty:
+                break
+            if item is Pipeline.done:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _handleBatch(self, stage, batch, context, outbox):
+        start = time.perf_counter()
+        try:
+            if stage.batchSize is not None:
+                results = stage.handler(batch, context)
+            else:
+                results = [stage.handler(batch[0], context)]
+        except Exception as err:
+            self.logger.error("PIPELINE STAGE {} FAILED".format(stage.name))
+            self.logger.debug(err)
+            results = [err] * len(batch)
+
+        failed = 0
+        for item, res in zip(batch, results):
+            if isinstance(res, Exception):
+                self._recordFailure(stage, item, res)
+                failed += 1
+            elif res is not None and outbox is not None:
+                outbox.put(res)
+            elif res is not None:
+                with self.lock:
+                    self.completed += 1
+
+        with stage.lock:
+            stage.busy += time.perf_counter() - start
+            stage.processed += len(batch) - failed
+            stage.failed += failed
+
+    def _drain(self, stage, err):
+        while True:
+            item = stage.inbox.get()
+            if item is Pipeline.done:
+                return
+            self._recordFailure(stage, item, err)
+            with stage.lock:
+                stage.failed += 1
+
+    def _recordFailure(self, stage, item, err):
+        with self.lock:
+            self.failures.append((self.keyFunc(item), "{}: {}".format(stage.name, repr(err))))
+
+    # Once the last worker of a stage stops, the workers of the next stage
+    # are told there is nothing more to come
+    def _finishWorker(self, index):
+        stage = self.stages[index]
+        with stage.lock:
+            stage.running -= 1
+            finished = stage.running == 0
+        if finished is True and index + 1 < len(self.stages):
+            nextStage = self.stages[index + 1]
+            for worker in range(nextStage.workers):
+                nextStage.inbox.put(Pipeline.done)
+
+    def _monitor(self, stopped):
+        while stopped.wait(self.statsInterval) is False:
+            self.logger.info("Pipeline stages: {}".format(json.dumps(self.getStats())))
@@ -1,43 +1,56 @@
 import os
+import json
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
 import requests
 import uuid
 import re
 import logging
 from itertools import repeat
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from helpers.args import GutenbergArgs
 from helpers.config import GutenbergConfig
+from helpers.migrations import SchemaMigrator, fuzzyFields
 
 class postgresManager:
 
-    replaceKeys = {
-        "id": "identifier",
-        "source": "authority",
-        "birthdate": "birth",
-        "deathdate": "death",
-        "alias": "aliases"
-    }
+    # The number of indexed candidates scored for each fuzzy lookup
+    candidateLimit = 50
 
+    # Trigram similarity a row needs to be a fuzzy lookup candidate. This is
+    # below the pg_trgm default of 0.3 since short names with a typo or two
+    # can score well with jarowinkler but share few trigrams
+    trigramThreshold = 0.2
 
-
-    def __init__(self, test=False):
-
-        psqlConfig = "postgresql"
-        config = GutenbergConfig()
-        if test is True:
-            psqlConfig = "postgresql_TEST"
-        postgresConfig = config.getConfigSection(psqlConfig)
+    def __init__(self, test=False, dsn=None):
 
         self.logger = logging.getLogger('guten_logs')
 
-        self.conn = psycopg2.connect("dbname={} user={} password={}".format(
-            postgresConfig["db"],
-            postgresConfig["user"],
-            postgresConfig["password"]
-        ))
+        # Server side prepared statements are kept for the life of the
+        # connection, keyed by their SQL text
+        self.statements = {}
+        self.statementStats = {
+            "prepared": 0,
+            "executed": 0
+        }
+
+        # A connection string can be given directly, such as for a throwaway
+        # benchmark database, otherwise it is read from the config file
+        if dsn is None:
+            psqlConfig = "postgresql"
+            config = GutenbergConfig()
+            if test is True:
+                psqlConfig = "postgresql_TEST"
+            postgresConfig = config.getConfigSection(psqlConfig)
+            dsn = "dbname={} user={} password={}".format(
+                postgresConfig["db"],
+                postgresConfig["user"],
+                postgresConfig["password"]
+            )
+
+        self.conn = psycopg2.connect(dsn)
         self._checkDB()
 
     def getCursor(self):
@@ -46,90 +59,193 @@ class postgresManager:
     def commitOps(self):
         self.conn.commit()
 
+    def rollbackOps(self):
+        self.conn.rollback()
+
     def closeCursor(self):
         self.cursor.close()
 
+    # The connection is closed however the last transaction ended. An aborted
+    # transaction is rolled back first so the plan counts can still be read
     def closeAll(self):
-        self.closeCursor()
-        self.conn.close()
+        try:
+            if self.conn.closed == 0 and self.conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                self.rollbackOps()
+            self.logger.info("Prepared statements: {}".format(json.dumps(self.getStatementStats())))
+        except psycopg2.Error as err:
+            self.logger.warning("Could not read prepared statement stats")
+            self.logger.debug(err)
+        finally:
+            self.closeCursor()
+            self.conn.close()
+
+    # Runs a query written with $1, $2... placeholders as a prepared
+    # statement. The statement is prepared the first time its SQL is seen on
+    # this connection and only executed with the bound values after that.
+    # Prepared statements are not dropped by a rollback so the cache stays
+    # valid across failed transactions
+    def execPrepared(self, query, values=None):
+        values = values or []
+        name = self.statements.get(query)
+        if name is None:
+            name = "stmt_{}".format(len(self.statements) + 1)
+            self.cursor.execute("PREPARE {} AS {}".format(name, query))
+            self.statements[query] = name
+            self.statementStats["prepared"] += 1
+        self.statementStats["executed"] += 1
+
+        if len(values) > 0:
+            params = ", ".join(["%s"] * len(values))
+            self.cursor.execute("EXECUTE {} ({})".format(name, params), values)
+        else:
+            self.cursor.execute("EXECUTE {}".format(name))
+
+    # Reports how often a cached statement was reused along with how often
+    # Postgres ran each one with its cached generic plan
+    def getStatementStats(self):
+        stats = dict(self.statementStats)
+        executed = stats["executed"]
+        stats["reuse_rate"] = round((executed - stats["prepared"]) / executed, 3) if executed > 0 else 0
+
+        # Plan counts are only recorded from Postgres 14
+        if self.conn.closed or self.conn.server_version < 140000:
+            return stats
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT SUM(generic_plans), SUM(custom_plans) FROM pg_prepared_statements")
+        genericPlans, customPlans = cursor.fetchone()
+        cursor.close()
+        stats["generic_plans"] = int(genericPlans or 0)
+        stats["custom_plans"] = int(customPlans or 0)
+        planned = stats["generic_plans"] + stats["custom_plans"]
+        stats["plan_cache_rate"] = round(stats["generic_plans"] / planned, 3) if planned > 0 else 0
+        return stats
 
     def execSelect(self, selectStmt, iden=None):
-        self.cursor.execute(selectStmt.format(iden))
+        self.execPrepared(selectStmt, [] if iden is None else [iden])
         return self.cursor.fetchall()
 
     def execSelectOne(self, selectStmt, iden=None):
-        self.cursor.execute(selectStmt.format(iden))
+        self.execPrepared(selectStmt, [] if iden is None else [iden])
         return self.cursor.fetchone()
 
     def getRow(self, table, rowID):
-        getQuery = "SELECT * FROM {} WHERE id={}".format(table, rowID)
-        self.cursor.execute(getQuery)
+        getQuery = "SELECT * FROM {} WHERE id = $1".format(table)
+        self.execPrepared(getQuery, [rowID])
         return self.cursor.fetchone()
 
     def generateInsert(self, table, columns):
-        placeholders = ", ".join(["%s"] * len(columns))
+        placeholders = self._generatePlaceholders(len(columns))
         columnNames = [col.upper() for col in columns]
         return """
             INSERT INTO {} ({}) VALUES ({}) RETURNING id
-        """.format(table, ', '.join(columnNames), placeholders)
+        """.format(table, ', '.join(columnNames), ", ".join(placeholders))
 
     # All insert statements should return the id of the newly inserted row
     def insertRow(self, query, values):
-        self.cursor.execute(query, values)
+        self.execPrepared(query, values)
         return self.cursor.fetchone()["id"]
 
+    # This inserts any number of rows with a single multi-row VALUES statement
+    # and returns the new ids in the same order as the rows. A conflict clause
+    # can be given for tables with unique indexes. With "DO NOTHING" only the
+    # ids of the rows actually inserted are returned, so they no longer line
+    # up with the rows that were passed in
+    def insertRows(self, table, columns, rows, conflict=None):
+        if len(rows) < 1:
+            return []
+        placeholder = "({})".format(", ".join(["%s"] * len(columns)))
+        values = b", ".join(self.cursor.mogrify(placeholder, row) for row in rows)
+        # The conflict clause is part of the statement before the row data is
+        # put in, so nothing in the data can be mistaken for SQL
+        conflictStmt = " ON CONFLICT {}".format(conflict) if conflict is not None else ""
+        query = "INSERT INTO {} ({}) VALUES {}{} RETURNING id".format(
+            table,
+            ", ".join([col.upper() for col in columns]),
+            values.decode("utf-8"),
+            conflictStmt
+        )
+        self.cursor.execute(query)
+        return [row["id"] for row in self.cursor.fetchall()]
+
     def updateRow(self, table, rowID, columns, values):
+        placeholders = self._generatePlaceholders(len(columns) + 1)
         setStmts = []
         for i, col in enumerate(columns):
-            escapedValue = self._escapeQuotes(values[i])
-            setStmts.append("{}='{}'".format(col, escapedValue))
+            setStmts.append("{} = {}".format(col, placeholders[i]))
         setStmt = ", ".join(setStmts)
 
         updateQuery = """
-            UPDATE {} SET {} WHERE id={}
-        """.format(table, setStmt, rowID)
+            UPDATE {} SET {} WHERE id = {}
+        """.format(table, setStmt, placeholders[-1])
 
-        self.cursor.execute(updateQuery)
+        self.execPrepared(updateQuery, list(values) + [rowID])
 
     def checkForRowWithRel(self, table, values, relTable, relID):
-        whereStmts = []
-        for key, value in values.items():
-            if value is None:
-                continue
-            escapedValue = self._escapeQuotes(value)
-            whereQuery = "t.{}='{}'".format(self.keyReplace(key), escapedValue)
-            whereStmts.append(whereQuery)
-        whereStmts.append("r.id={}".format(relID))
+        columns, params = self._generateWhere(values, "t.")
+        placeholders = self._generatePlaceholders(len(params) + 1)
+        whereStmts = [
+            "{} = {}".format(col, placeholders[i]) for i, col in enumerate(columns)
+        ]
+        whereStmts.append("r.id = {}".format(placeholders[-1]))
         query = """
             SELECT t.id FROM {} t JOIN {}s r ON t.{}_id = r.id WHERE {}
         """.format(table, relTable, relTable, " AND ".join(whereStmts))
-        self.cursor.execute(query)
+        self.execPrepared(query, params + [relID])
         if self.cursor.rowcount > 0:
             return self.cursor.fetchone()["id"]
         return None
 
     def checkForRow(self, table, values):
-        whereStmts = []
-        for key, value in values.items():
-            if value is None:
-                continue
-            escapedValue = self._escapeQuotes(value)
-            whereQuery = "{}='{}'".format(self.keyReplace(key), escapedValue)
-            whereStmts.append(whereQuery)
+        columns, params = self._generateWhere(values)
+        placeholders = self._generatePlaceholders(len(params))
+        whereStmts = [
+            "{} = {}".format(col, placeholders[i]) for i, col in enumerate(columns)
+        ]
         query = """
             SELECT id FROM {} WHERE {}
         """.format(table, " AND ".join(whereStmts))
-        self.cursor.execute(query)
+        self.execPrepared(query, params)
         if self.cursor.rowcount > 0:
             return self.cursor.fetchone()["id"]
         return None
 
+    # Scoring every row with jarowinkler gets slower as the catalog grows, so
+    # an index is used to narrow the table down to the closest candidates
+    # first. Only these are scored and the best scoring match is returned.
+    # A match that the index does not offer as a candidate is missed, which
+    # benchmarks.db_lookup measures against scoring every row
     def queryJaroWinkler(self, table, field, value, score):
-        escapedValue = self._escapeQuotes(value)
+        mode = self.fuzzySearch.get((table, field), "scan")
+        tokenQuery = self._createTokenQuery(value) if mode == "token" else ""
+        if mode == "trigram":
+            candidateStmt = """
+                SELECT * FROM {} WHERE {} % $1
+                ORDER BY similarity({}, $1) DESC LIMIT {}
+            """.format(table, field, field, postgresManager.candidateLimit)
+            params = [value, score]
+        elif len(tokenQuery) > 0:
+            # Rows sharing all but one word with the value are candidates, in
+            # any order, so a misspelled word does not rule out a name or title.
+            # Values with two or more misspelled words are only found by
+            # scoring every row. Rows sharing the most words are scored first
+            candidateStmt = """
+                SELECT * FROM {} WHERE to_tsvector('simple', {}) @@ to_tsquery('simple', $3)
+                ORDER BY ts_rank(to_tsvector('simple', {}), to_tsquery('simple', $3)) DESC
+                LIMIT {}
+            """.format(table, field, field, postgresManager.candidateLimit)
+            params = [value, score, tokenQuery]
+        else:
+            candidateStmt = "SELECT * FROM {}".format(table)
+            params = [value, score]
+
         query = """
-            SELECT * FROM {} WHERE jarowinkler({}, '{}') > {}
-        """.format(table, field, escapedValue, score)
-        self.cursor.execute(query)
+            SELECT * FROM (
+                SELECT c.*, jarowinkler(c.{}, $1) AS match_score
+                FROM ({}) AS c
+            ) AS m WHERE match_score > $2
+            ORDER BY match_score DESC LIMIT 1
+        """.format(field, candidateStmt)
+        self.execPrepared(query, params)
         if self.cursor.rowcount > 0:
             return self.cursor.fetchone()
         return None
@@ -141,13 +257,29 @@ class postgresManager:
             ON t.id = l.{}_id
             JOIN identifiers AS i
             ON l.identifier_id = i.id
-            WHERE i.identifier='{}'
-        """.format(table, table, table, id)
-        self.cursor.execute(query)
+            WHERE i.identifier = $1
+        """.format(table, table, table)
+        self.execPrepared(query, [id])
         if self.cursor.rowcount > 0:
             return self.cursor.fetchone()["id"]
         return None
 
+    # Looks up any number of identifiers at once, returning a map of each
+    # identifier that is attached to a record to that record's ID
+    def getByIDs(self, ids, table):
+        if len(ids) < 1:
+            return {}
+        query = """
+            SELECT i.identifier, t.id FROM {}s AS t
+            JOIN {}_identifiers AS l
+            ON t.id = l.{}_id
+            JOIN identifiers AS i
+            ON l.identifier_id = i.id
+            WHERE i.identifier = ANY($1)
+        """.format(table, table, table)
+        self.execPrepared(query, [list(ids)])
+        return dict((row["identifier"], row["id"]) for row in self.cursor.fetchall())
+
     def getRecordsByID(self, id):
         existing = defaultdict(set)
         for table in ["work", "instance", "item"]:
@@ -155,167 +287,52 @@ class postgresManager:
             existing[table].add(id)
         return existing
 
-    def _escapeQuotes(self, value):
-        try:
-            escaped = value.replace("'", "''")
-            return escaped
-        except AttributeError:
-            return value
-
-    def keyReplace(self, key):
-        if key in postgresManager.replaceKeys:
-            return postgresManager.replaceKeys[key]
-        return key
+    # A tsquery matching rows that have every word of the value but one.
+    # Only letters and digits are kept so nothing in the value is read as a
+    # tsquery operator
+    def _createTokenQuery(self, value):
+        words = list(OrderedDict.fromkeys(re.findall(r"[^\W_]+", value.lower())))
+        if len(words) < 3:
+            return " | ".join(words)
+        return " | ".join(
+            "({})".format(" & ".join(words[:i] + words[i + 1:])) for i in range(len(words))
+        )
+
+    def _generatePlaceholders(self, count):
+        return ["${}".format(i + 1) for i in range(count)]
+
+    # Null values are left out of lookups, as they were when these queries
+    # were built as strings
+    def _generateWhere(self, values, prefix=""):
+        columns = []
+        params = []
+        for key, value in values.items():
+            if value is None:
+                continue
+            columns.append("{}{}".format(prefix, key))
+            params.append(value)
+        return columns, params
 
+    # Bring the schema up to date and work out which index each of the
+    # fuzzy lookups can use
     def _checkDB(self):
         self.getCursor()
-        self.cursor.execute("""
-            SELECT table_name FROM information_schema.tables
-            WHERE table_schema = 'public'
-        """)
-        if len(self.cursor.fetchall()) < 1:
-            self.logger.info("Database does not exist!, Creating")
-
-            self.cursor.execute("""
-                CREATE TABLE works (
-                    id              SERIAL PRIMARY KEY,
-                    uuid            UUID NOT NULL,
-                    title           TEXT NOT NULL,
-                    rights_stmt     TEXT NULL,
-                    rights_url      VARCHAR(125) NULL,
-                    rights_source   VARCHAR(125) NULL,
-                    rights_access   VARCHAR(25) NULL,
-                    date_created    TIMESTAMP NOT NULL DEFAULT NOW(),
-                    date_updated    TIMESTAMP NOT NULL DEFAULT NOW(),
-                    geo_coverage    VARCHAR(255) NULL,
-                    temp_coverage   VARCHAR(255) NULL,
-                    summary         TEXT NULL,
-                    language        CHAR(2) NOT NULL DEFAULT 'en'
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE instances (
-                    id              SERIAL PRIMARY KEY,
-                    title           TEXT NOT NULL,
-                    pub_date        INT NULL,
-                    pub_place       VARCHAR(255) NULL,
-                    publisher       VARCHAR(255) NULL,
-                    extent          VARCHAR(255) NULL,
-                    edition         VARCHAR(125) NULL,
-                    edition_stmt    VARCHAR(125) NULL,
-                    summary         TEXT NULL,
-                    issuance        VARCHAR(255) NULL,
-                    copyright_date  DATE NULL,
-                    toc             TEXT NULL,
-                    language        CHAR(2) NULL,
-                    work_id         INT REFERENCES works(id)
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE items (
-                    id              SERIAL PRIMARY KEY,
-                    url             VARCHAR(255) NOT NULL,
-                    epub_path       VARCHAR(255) NULL,
-                    source          VARCHAR(255) NULL,
-                    date_modified   DATE NULL,
-                    size            INT NULL,
-                    checksum        CHAR(32) NULL,
-                    access_policy   SMALLINT NOT NULL,
-                    instance_id     INT REFERENCES instances(id)
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE entities (
-                    id              SERIAL PRIMARY KEY,
-                    name            VARCHAR(255) NOT NULL,
-                    sort_name       VARCHAR(255) NOT NULL,
-                    viaf            VARCHAR(125) NULL,
-                    lcnaf           VARCHAR(125) NULL,
-                    birth           SMALLINT NULL,
-                    death           SMALLINT NULL,
-                    wikipedia       VARCHAR(125) NULL,
-                    aliases         VARCHAR(255) NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE entity_works (
-                    id              SERIAL PRIMARY KEY,
-                    work_id         INT REFERENCES works(id),
-                    entity_id       INT REFERENCES entities(id),
-                    role            VARCHAR(50) NOT NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE entity_instances (
-                    id              SERIAL PRIMARY KEY,
-                    instance_id     INT REFERENCES instances(id),
-                    entity_id       INT REFERENCES entities(id),
-                    role            VARCHAR(50) NOT NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE entity_items (
-                    id              SERIAL PRIMARY KEY,
-                    item_id         INT REFERENCES items(id),
-                    entity_id       INT REFERENCES entities(id),
-                    role            VARCHAR(50) NOT NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE subjects (
-                    id              SERIAL PRIMARY KEY,
-                    authority       VARCHAR(125) NOT NULL,
-                    uri             VARCHAR(255) NULL,
-                    subject         TEXT NOT NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE subject_works (
-                    id              SERIAL PRIMARY KEY,
-                    work_id         INT REFERENCES works(id),
-                    subject_id      INT REFERENCES subjects(id),
-                    weight          FLOAT(5) NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE identifiers (
-                    id              SERIAL PRIMARY KEY,
-                    type            VARCHAR(125) NOT NULL,
-                    identifier      VARCHAR(255) NOT NULL
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE work_identifiers (
-                    id              SERIAL PRIMARY KEY,
-                    work_id         INT REFERENCES works(id),
-                    identifier_id   INT REFERENCES identifiers(id)
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE instance_identifiers (
-                    id              SERIAL PRIMARY KEY,
-                    instance_id     INT REFERENCES instances(id),
-                    identifier_id   INT REFERENCES identifiers(id)
-                )
-            """)
-
-            self.cursor.execute("""
-                CREATE TABLE item_identifiers (
-                    id              SERIAL PRIMARY KEY,
-                    item_id         INT REFERENCES items(id),
-                    identifier_id   INT REFERENCES identifiers(id)
-                )
-            """)
-            self.commitOps()
-            self.closeCursor()
+        SchemaMigrator(self.conn).migrate()
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename IN %s", [
+            tuple(set(table for table, field in fuzzyFields))
+        ])
+        indexes = [row[0] for row in cursor.fetchall()]
+        self.fuzzySearch = {}
+        for table, field in fuzzyFields:
+            self.fuzzySearch[(table, field)] = "scan"
+            if "{}_{}_trgm".format(table, field) in indexes:
+                self.fuzzySearch[(table, field)] = "trigram"
+            elif "{}_{}_tokens".format(table, field) in indexes:
+                self.fuzzySearch[(table, field)] = "token"
+
+        if "trigram" in self.fuzzySearch.values():
+            cursor.execute("SET pg_trgm.similarity_threshold = %s", [postgresManager.trigramThreshold])
+        self.conn.commit()
+        cursor.close()
@@ -4,41 +4,56 @@ import csv
 from itertools import repeat
 from lxml import etree
 
+# Parsers hold nothing about the document being read. Every method is given
+# the element it works on and returns what it finds, so a single parser can
+# be shared by any number of threads
 class xmlParser:
 
     def __init__(self):
         self.logger = logging.getLogger('guten_logs')
 
-        # Necessary for lxml to properly parse namespaced elements and attribs
+        # Necessary for lxml to properly parse namespaced elements and attribs.
+        # This is only written to while the parser is set up
         self.nsmap = {}
 
-        self.root = None
-        self.current = None
-
     def parse(self, rdfFile):
-        rdf = etree.parse(rdfFile)
-        self.root = rdf.getroot()
+        return etree.parse(rdfFile).getroot()
 
     def parseString(self, xmlString):
-        self.root = etree.fromstring(xmlString)
+        return etree.fromstring(xmlString)
+
+    # This streams through a large XML file and yields each matching element
+    # as it is completed. Once the caller is done with an element it is
+    # cleared along with any siblings already read, so memory use stays flat
+    # however many records the file holds
+    def iterRecords(self, xmlFile, ns, tag):
+        recordTag = self._formatTag(ns, tag)
+        for event, element in etree.iterparse(xmlFile, events=("end",), tag=recordTag):
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
-    def loadRecord(self, ns, tag):
+    def findRecord(self, root, ns, tag):
+        # A document can also be a single record on its own
+        if root.tag == self._formatTag(ns, tag):
+            return root
         xpath = self._formatXpath(ns, tag)
-        self.current = self.root.find(xpath, namespaces=self.nsmap)
+        return root.find(xpath, namespaces=self.nsmap)
 
     # This loads data from a single field that contains only text
-    def getField(self, tag):
+    def getField(self, node, tag):
         ns, field = tag
         xpath = self._formatXpath(ns, field)
-        xmlData = self.current.find(xpath, namespaces=self.nsmap)
+        xmlData = node.find(xpath, namespaces=self.nsmap)
         return field, xmlData
 
-    def getFields(self, tags):
-        return list(map(self.getField, tags))
+    def getFields(self, node, tags):
+        return list(map(self.getField, repeat(node), tags))
 
-    def getRepeatingField(self, ns, field):
+    def getRepeatingField(self, node, ns, field):
         xpath = self._formatXpath(ns, field)
-        return self.current.findall(xpath, namespaces=self.nsmap)
+        return node.findall(xpath, namespaces=self.nsmap)
 
     def getAttrib(self, field, attrib):
         return field.get(attrib)
@@ -50,6 +65,11 @@ class xmlParser:
         tag, urn = ns
         self.nsmap[tag] = urn
 
+    def _formatTag(self, ns, tag):
+        if ns is None and None not in self.nsmap:
+            return tag
+        return "{{{}}}{}".format(self.nsmap[ns], tag)
+
     def _formatXpath(self, ns, tag):
         if ns is None:
             xpath = ".//{}".format(tag)
@@ -1,24 +1,75 @@
 import logging
 import time
 
+from helpers.config import GutenbergConfig
+from helpers.http import HTTPClient
+from helpers.metrics import MetricsReporter
+
 from lib.gutenberg_downloads import GutenbergDownloads
+from lib.gutenberg_manifest import GutenbergManifest
 from lib.gutenberg_parse import GutenbergBib
+from lib.gutenberg_pipeline import GutenbergPipeline
+from lib.gutenberg_pool import GutenbergPool
 from lib.gutenberg_store import GutenbergDB
 
 class GutenbergCore:
-    def __init__(self):
+    def __init__(self, workers=1, cacheOnly=False, pipeline=False):
         self.logger = logging.getLogger("guten_logs")
-        self.downloads = GutenbergDownloads()
-        self.bibParser = GutenbergBib(self.downloads.catalogDir)
+        self.http = HTTPClient()
+        # Timings and counters from every stage are summarized at a regular
+        # interval for as long as the ingest runs
+        self.reporter = MetricsReporter()
+        self.reporter.start()
+        self.downloads = GutenbergDownloads(http=self.http)
+        # With more than one worker, books are read by a pool of processes
+        # that each hold their own parser, readers and connections
+        if workers > 1:
+            self.bibParser = GutenbergPool(self.downloads.catalogDir, workers, cacheOnly=cacheOnly)
+        elif pipeline is True or GutenbergConfig().getConfigFlag("pipeline", "enabled"):
+            # Otherwise the stages of the ingest can be overlapped in threads
+            self.bibParser = GutenbergPipeline(self.downloads.catalogDir, cacheOnly=cacheOnly, http=self.http)
+        else:
+            self.bibParser = GutenbergBib(self.downloads.catalogDir, cacheOnly=cacheOnly, http=self.http)
 
+    # Only books whose RDF file is new or has changed since the last run are
+    # read, and books marked for deletion are removed
     def ingest_gutenberg(self):
         self.logger.debug("Running normal ingest")
 
-    def ingest_full_gutenberg(self):
+        self.downloads.getRDFRecords()
+
+        manifest = GutenbergManifest(
+            GutenbergConfig().getConfigValue("ingest", "manifest", "files/gutenberg_manifest.db")
+        )
+        changed, deleted = manifest.findChanges(self.bibParser.epubDir)
+        manifest.close()
+
+        self.bibParser.deleteBooks(deleted)
+        self.bibParser.readBooks(changed)
+        self.close()
+
+    def ingest_full_gutenberg(self, stream=False, catalogFile=None):
         self.logger.debug("Running full ingest")
 
+        if catalogFile is not None:
+            # Parse the combined RDF catalog rather than the per-book files
+            self.bibParser.readCatalog(catalogFile)
+            self.close()
+            return
+
+        if stream is True:
+            # Parse each RDF file as it comes out of the catalog download
+            self.bibParser.readStream(self.downloads.streamRDFRecords())
+            self.close()
+            return
+
         # Download full RDF catalog from Gutenberg if it is more than 24 hours old
         self.downloads.getRDFRecords()
 
         # Read the current directory of Gutenberg records and store them
         self.bibParser.readDir()
+        self.close()
+
+    def close(self):
+        self.http.close()
+        self.reporter.stop()
@@ -12,8 +12,9 @@ class GutenbergDownloads:
     fileDir = "files/"
     catalogDir = fileDir + "gutenberg_catalog"
 
-    def __init__(self):
+    def __init__(self, http=requests):
         self.logger = logging.getLogger("guten_logs")
+        self.http = http
 
         self.runTime = time.time()
         self.cutoffTime = self.runTime - 86400
@@ -32,7 +33,7 @@ class GutenbergDownloads:
         # If not, get the tar from Gutenberg
         self.logger.info("Deleting existing copy")
         shutil.rmtree(GutenbergDownloads.catalogDir)
-        gutenberg_zip = requests.get(GutenbergDownloads.gutenbergCatalog)
+        gutenberg_zip = self.http.get(GutenbergDownloads.gutenbergCatalog)
         if gutenberg_zip.status_code != 200:
             self.logger.error("COULD NOT DOWNLOAD RDF FILE! EXITING")
             sys.exit(2)
@@ -50,6 +51,31 @@ class GutenbergDownloads:
 
         return True
 
+    # This streams the catalog tarball straight through bz2 decompression and
+    # tarfile, yielding the ID and contents of each RDF file as it arrives.
+    # Neither the archive nor the extracted catalog is ever written to disk
+    def streamRDFRecords(self):
+        self.logger.info("Streaming RDF Catalog from Gutenberg")
+        gutenbergResp = self.http.get(GutenbergDownloads.gutenbergCatalog, stream=True)
+        if gutenbergResp.status_code != 200:
+            self.logger.error("COULD NOT DOWNLOAD RDF FILE! EXITING")
+            sys.exit(2)
+
+        gutenbergResp.raw.decode_content = True
+        try:
+            with tarfile.open(fileobj=gutenbergResp.raw, mode="r|bz2") as gutenbergTar:
+                for member in gutenbergTar:
+                    if member.isfile() is False or member.name.endswith(".rdf") is False:
+                        continue
+                    # Members are laid out as cache/epub/<id>/pg<id>.rdf
+                    bookID = os.path.basename(os.path.dirname(member.name))
+                    # In stream mode each member has to be read before moving
+                    # on to the next one
+                    rdfData = gutenbergTar.extractfile(member).read()
+                    yield bookID, rdfData
+        finally:
+            gutenbergResp.close()
+
     def _createCat(self):
         if os.path.isdir(GutenbergDownloads.catalogDir) is False:
             os.mkdir(GutenbergDownloads.catalogDir)
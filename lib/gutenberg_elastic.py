@@ -1,109 +1,352 @@
+import json
+import time
+import logging
+from elasticsearch import ElasticsearchException, helpers as esHelpers
+from elasticsearch_dsl.connections import connections
+
 from helpers.elasticsearch import ElasticWriter, Work, Instance, Item, Subject, Entity, Identifier
+from helpers.metrics import metrics
+from lib.gutenberg_records import IdentifierRecord, SubjectRecord, EntityRecord
 
-class GutenbergES():
+# Builds the ES documents for a batch of works with a fixed number of
+# queries, one per table, however many works, instances and items there are.
+# Rows are matched back to their work or instance in memory
+class WorkDocumentBuilder():
 
-    esWriter = ElasticWriter()
+    getWorks = """
+        SELECT id, title, uuid, rights_stmt, date_created, date_updated, language
+        FROM works WHERE id = ANY($1)
+    """
 
-    getWork = "SELECT * FROM works WHERE id={};"
-    getInstances = "SELECT * FROM instances WHERE work_id={}"
+    getInstances = """
+        SELECT id, work_id, title, pub_date, pub_place, publisher, language
+        FROM instances WHERE work_id = ANY($1) ORDER BY id
+    """
 
-    getItems = "SELECT * FROM items WHERE instance_id={}"
+    getItems = """
+        SELECT i.instance_id, i.url, i.epub_path, i.source, i.size, i.date_modified
+        FROM items i
+        JOIN instances n ON n.id = i.instance_id
+        WHERE n.work_id = ANY($1) ORDER BY i.id
+    """
 
-    getSubjects = """
-        SELECT * FROM subjects s
-        JOIN subject_works sw ON s.id = sw.subject_id
-        JOIN works w ON w.id = sw.work_id
-        WHERE w.id={}
+    getInstanceIDs = """
+        SELECT l.instance_id, i.type, i.identifier
+        FROM instance_identifiers l
+        JOIN identifiers i ON i.id = l.identifier_id
+        JOIN instances n ON n.id = l.instance_id
+        WHERE n.work_id = ANY($1) ORDER BY l.id
     """
 
     getEntities = """
-        SELECT * FROM entities e
-        JOIN entity_works ew ON e.id = ew.entity_id
-        JOIN works w ON w.id = ew.work_id
-        WHERE w.id={}
+        SELECT ew.work_id, e.name, e.sort_name, e.aliases, e.viaf, e.lcnaf,
+            e.wikipedia, e.birth, e.death, ew.role
+        FROM entity_works ew
+        JOIN entities e ON e.id = ew.entity_id
+        WHERE ew.work_id = ANY($1) ORDER BY ew.id
     """
 
-    getWorkIDs = """
-        SELECT * FROM identifiers i
-        JOIN work_identifiers il ON il.identifier_id = i.id
-        JOIN works t ON t.id = il.work_id
-        WHERE t.id = {}
+    getSubjects = """
+        SELECT sw.work_id, s.authority, s.subject
+        FROM subject_works sw
+        JOIN subjects s ON s.id = sw.subject_id
+        WHERE sw.work_id = ANY($1) ORDER BY sw.id
     """
 
-    getInstanceIDs = """
-        SELECT * FROM identifiers i
-        JOIN instance_identifiers il ON il.identifier_id = i.id
-        JOIN instances t ON t.id = il.instance_id
-        WHERE t.id = {}
+    getWorkIDs = """
+        SELECT l.work_id, i.type, i.identifier
+        FROM work_identifiers l
+        JOIN identifiers i ON i.id = l.identifier_id
+        WHERE l.work_id = ANY($1) ORDER BY l.id
     """
 
     workFields = ["title", "uuid", "rights_stmt", "date_created", "date_updated", "language"]
     instanceFields = ["title", "pub_date", "pub_place", "publisher", "language"]
     itemFields = ["url", "epub_path", "source", "size", "date_modified"]
-    subjectFields = ["authority", "subject"]
-    entityFields = ["name", "sort_name", "aliases", "viaf", "lcnaf", "wikipedia", "birth", "death", "role"]
-    identifierFields = ["type", "identifier"]
+    subjectFields = SubjectRecord.columns
+    entityFields = EntityRecord.columns + ("role",)
+    identifierFields = IdentifierRecord.columns
+
+    def __init__(self, db):
+        self.db = db
+
+    # Returns a map of work ID to Work document. IDs without a stored work
+    # are left out
+    @metrics.timed("es.build")
+    def buildWorks(self, workIDs):
+        workIDs = list(set(workIDs))
+        if len(workIDs) < 1:
+            return {}
+        self.db.getCursor()
+
+        works = {}
+        for row in self._select(WorkDocumentBuilder.getWorks, workIDs):
+            works[row["id"]] = self._createDoc(Work, row, WorkDocumentBuilder.workFields)
+
+        # Instances are filled in before being added to their work
+        instances = {}
+        workInstances = {}
+        for row in self._select(WorkDocumentBuilder.getInstances, workIDs):
+            instances[row["id"]] = self._createDoc(Instance, row, WorkDocumentBuilder.instanceFields)
+            workInstances.setdefault(row["work_id"], []).append(instances[row["id"]])
+
+        for row in self._select(WorkDocumentBuilder.getItems, workIDs):
+            instances[row["instance_id"]].items.append(
+                self._createDoc(Item, row, WorkDocumentBuilder.itemFields)
+            )
+
+        for row in self._select(WorkDocumentBuilder.getInstanceIDs, workIDs):
+            instances[row["instance_id"]].ids.append(
+                self._createDoc(Identifier, row, WorkDocumentBuilder.identifierFields)
+            )
+
+        for workID, esInstances in workInstances.items():
+            works[workID].instances.extend(esInstances)
+
+        for row in self._select(WorkDocumentBuilder.getEntities, workIDs):
+            works[row["work_id"]].entities.append(
+                self._createDoc(Entity, row, WorkDocumentBuilder.entityFields)
+            )
+
+        for row in self._select(WorkDocumentBuilder.getSubjects, workIDs):
+            works[row["work_id"]].subjects.append(
+                self._createDoc(Subject, row, WorkDocumentBuilder.subjectFields)
+            )
+
+        for row in self._select(WorkDocumentBuilder.getWorkIDs, workIDs):
+            works[row["work_id"]].ids.append(
+                self._createDoc(Identifier, row, WorkDocumentBuilder.identifierFields)
+            )
+
+        return works
+
+    def _select(self, query, workIDs):
+        return self.db.execSelect(query, workIDs)
+
+    def _createDoc(self, docType, row, fields):
+        doc = docType()
+        doc.setFields([(field, row[field]) for field in fields])
+        return doc
+
+
+class GutenbergES():
+
+    # Item level bulk failures that are worth sending again
+    retryStatuses = [429, 500, 502, 503, 504]
 
     def __init__(self):
+        self.logger = logging.getLogger('guten_logs')
         self.workID = None
+        # Each instance gets its own writer so that ingest workers do not
+        # share a database connection or ES client
+        self.esWriter = ElasticWriter()
+        self.builder = WorkDocumentBuilder(self.esWriter)
+
+        # In bulk mode documents are buffered and sent with the bulk API once
+        # enough have built up, rather than saved one request at a time
+        config = self.esWriter.config
+        self.bulk = config.getConfigFlag("elasticsearch", "bulk")
+        self.bulkSize = config.getConfigInt("elasticsearch", "bulk_size", 500)
+        self.bulkBytes = config.getConfigInt("elasticsearch", "bulk_max_mb", 10) * 1024 * 1024
+        self.bulkRetries = config.getConfigInt("elasticsearch", "bulk_retries", 3)
+        self.buffer = []
+        self.bufferBytes = 0
+        # Documents that could not be sent, including from flushes made
+        # automatically as the buffer fills
+        self.failures = 0
 
+        # Full rebuilds write to a new versioned index, which replaces the
+        # one behind the alias once it is complete
+        self.targetIndex = None
+        self.replicas = config.getConfigInt("elasticsearch", "replicas", 1)
+        self.refreshInterval = config.getConfigValue("elasticsearch", "refresh_interval", "1s")
+        self.keepIndexes = config.getConfigInt("elasticsearch", "keep_indices", 1)
+
+    @metrics.timed("es.drop")
     def dropES(self, workID):
-        work = Work.get(id=workID)
-        work.delete()
+        if self.bulk is True:
+            action = Work(meta={"id": workID}).to_dict(include_meta=True)
+            action.pop("_source", None)
+            action["_op_type"] = "delete"
+            self._queueAction(action, 0)
+            return
+
+        work = Work.get(id=workID, ignore=404)
+        if work is not None:
+            work.delete()
 
+    # Documents are indexed under the work's ID, so storing a work that is
+    # already in the index replaces it without having to remove it first
     def storeES(self, workID):
-        GutenbergES.esWriter.getCursor()
-        work = GutenbergES.esWriter.execSelectOne(GutenbergES.getWork, workID)
-
-        fieldPairs = GutenbergES.esWriter.convertToFieldTuples(work, GutenbergES.workFields)
-        esWork = Work()
-        esWork.setFields(fieldPairs)
-
-        workID = work["id"]
-        instances = GutenbergES.esWriter.execSelect(GutenbergES.getInstances, workID)
-        for instance in instances:
-            instancePairs = GutenbergES.esWriter.convertToFieldTuples(instance, GutenbergES.instanceFields)
-            esInstance = Instance()
-            esInstance.setFields(instancePairs)
-            instanceID = instance["id"]
-            items = GutenbergES.esWriter.execSelect(GutenbergES.getItems, instanceID)
-            for item in items:
-                itemPairs = GutenbergES.esWriter.convertToFieldTuples(item, GutenbergES.itemFields)
-                esItem = Item()
-                esItem.setFields(itemPairs)
-                esInstance.items.append(esItem)
-
-            identifiers = GutenbergES.esWriter.execSelect(GutenbergES.getInstanceIDs, instanceID)
-            for iden in identifiers:
-                idenPairs = GutenbergES.esWriter.convertToFieldTuples(iden, GutenbergES.identifierFields)
-                esIden = Identifier()
-                esIden.setFields(idenPairs)
-                esInstance.ids.append(esIden)
-
-            esWork.instances.append(esInstance)
-
-        entities = GutenbergES.esWriter.execSelect(GutenbergES.getEntities, workID)
-        for entity in entities:
-            entityPairs = GutenbergES.esWriter.convertToFieldTuples(entity, GutenbergES.entityFields)
-            esEntity = Entity()
-            esEntity.setFields(entityPairs)
-            esWork.entities.append(esEntity)
-
-        subjects = GutenbergES.esWriter.execSelect(GutenbergES.getSubjects, workID)
-        for subject in subjects:
-            subjectPairs = GutenbergES.esWriter.convertToFieldTuples(subject, GutenbergES.subjectFields)
-            esSubject = Subject()
-            esSubject.setFields(subjectPairs)
-            esWork.subjects.append(esSubject)
-
-        identifiers = GutenbergES.esWriter.execSelect(GutenbergES.getWorkIDs, workID)
-        for iden in identifiers:
-            idenPairs = GutenbergES.esWriter.convertToFieldTuples(iden, GutenbergES.identifierFields)
-            esIden = Identifier()
-            esIden.setFields(idenPairs)
-            esWork.ids.append(esIden)
-
-        esWork.save(id=workID)
+        self.storeWorks([workID])
+
+    @metrics.timed("es.store")
+    def storeWorks(self, workIDs):
+        esWorks = self.builder.buildWorks(workIDs)
+        for workID in workIDs:
+            esWork = esWorks.get(workID)
+            if esWork is None:
+                self.logger.warning("NO STORED WORK {} TO INDEX".format(workID))
+                metrics.count("es.missing")
+                continue
+
+            metrics.count("es.documents")
+            if self.bulk is True:
+                esWork.meta.id = workID
+                action = esWork.to_dict(include_meta=True)
+                if self.targetIndex is not None:
+                    action["_index"] = self.targetIndex
+                self._queueAction(action, len(json.dumps(action["_source"], default=str)))
+            else:
+                with metrics.timer("es.save"):
+                    esWork.save(id=workID, index=self.targetIndex)
+
+    # Versioned indexes are named after the alias that searches go through.
+    # Refreshes and replicas are turned off while the index is loaded, since
+    # nothing searches it until the alias is moved
+    def createIndex(self):
+        indexName = "{}-{}".format(Work._index._name, time.strftime("%Y%m%d%H%M%S"))
+        index = Work._index.clone(name=indexName)
+        index.settings(number_of_replicas=0, refresh_interval="-1")
+        index.create()
+        self.logger.info("Created index {}".format(indexName))
+        return indexName
+
+    def finishIndex(self, indexName):
+        es = connections.get_connection()
+        es.indices.put_settings(index=indexName, body={
+            "index": {
+                "number_of_replicas": self.replicas,
+                "refresh_interval": self.refreshInterval
+            }
+        })
+        es.indices.refresh(index=indexName)
+        health = es.cluster.health(index=indexName, wait_for_status="green", timeout="10m")
+        if health.get("timed_out") is True:
+            self.logger.warning("Index {} is {} after restoring replicas".format(indexName, health.get("status")))
+
+    # Every index behind the alias is swapped for the new one in a single
+    # request, so searches never see a partial index. The first rebuild also
+    # replaces the index that was written to directly under the alias name.
+    # From ES 6.4 that is removed in the same request, before then it has to
+    # be deleted first and searches fail until the alias has been added
+    def swapAlias(self, indexName):
+        es = connections.get_connection()
+        alias = Work._index._name
+        actions = [{"add": {"index": indexName, "alias": alias}}]
+        retries = 0
+        if es.indices.exists_alias(name=alias):
+            for oldIndex in es.indices.get_alias(name=alias).keys():
+                actions.insert(0, {"remove": {"index": oldIndex, "alias": alias}})
+        elif es.indices.exists(index=alias):
+            if self._getServerVersion(es) >= (6, 4):
+                actions.insert(0, {"remove_index": {"index": alias}})
+            else:
+                self.logger.warning("Deleting index {} so it can be replaced by an alias".format(alias))
+                es.indices.delete(index=alias)
+                retries = self.bulkRetries
+        self._updateAliases(es, actions, retries)
+        self.logger.info("Moved alias {} to {}".format(alias, indexName))
+
+    # Once the old index has been deleted nothing can be searched until the
+    # alias is added, so the update is retried before giving up
+    def _updateAliases(self, es, actions, retries):
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.logger.info("Retrying alias update")
+                time.sleep(2 ** attempt)
+            try:
+                es.indices.update_aliases(body={"actions": actions})
+                return
+            except ElasticsearchException as err:
+                if attempt >= retries:
+                    raise
+                self.logger.warning("Alias update failed: {}".format(err))
+
+    # True while searches through the alias still reach an index, either
+    # one the alias points at or an index with the alias's name
+    def hasLiveIndex(self):
+        es = connections.get_connection()
+        alias = Work._index._name
+        return es.indices.exists_alias(name=alias) or es.indices.exists(index=alias)
+
+    def dropIndex(self, indexName):
+        connections.get_connection().indices.delete(index=indexName, ignore=404)
+
+    # The most recent earlier versions are kept so the alias can be moved
+    # back by hand
+    def removeOldIndexes(self, indexName):
+        es = connections.get_connection()
+        versions = sorted(es.indices.get(index="{}-*".format(Work._index._name)).keys())
+        oldIndexes = [version for version in versions if version != indexName]
+        for oldIndex in oldIndexes[:max(len(oldIndexes) - self.keepIndexes, 0)]:
+            self.dropIndex(oldIndex)
+            self.logger.info("Deleted index {}".format(oldIndex))
+
+    def _getServerVersion(self, es):
+        number = es.info()["version"]["number"]
+        return tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+
+    def _queueAction(self, action, size):
+        self.buffer.append(action)
+        self.bufferBytes += size
+        if len(self.buffer) >= self.bulkSize or self.bufferBytes >= self.bulkBytes:
+            self.flush()
+
+    # Send everything that is buffered. Items rejected with a retryable
+    # status are sent again with a growing delay, anything else is logged
+    # as failed. Returns the number of documents that could not be sent
+    @metrics.timed("es.bulk")
+    def flush(self):
+        actions = self.buffer
+        self.buffer = []
+        self.bufferBytes = 0
+
+        failed = []
+        for attempt in range(self.bulkRetries + 1):
+            if len(actions) < 1:
+                break
+            if attempt > 0:
+                self.logger.info("Retrying {} bulk actions".format(len(actions)))
+                time.sleep(2 ** attempt)
+            actions, failed = self._sendBulk(actions, failed)
+
+        for action in actions:
+            failed.append((action.get("_op_type", "index"), action["_id"], "retries exhausted"))
+        for opType, docID, error in failed:
+            self.logger.error("BULK {} FAILED FOR WORK {}: {}".format(opType.upper(), docID, error))
+        self.failures += len(failed)
+        metrics.count("es.failures", len(failed))
+        return len(failed)
+
+    def _sendBulk(self, actions, failed):
+        pending = dict(
+            ((action.get("_op_type", "index"), str(action["_id"])), action) for action in actions
+        )
+        retry = []
+        results = esHelpers.streaming_bulk(
+            connections.get_connection(),
+            actions,
+            chunk_size=self.bulkSize,
+            max_chunk_bytes=self.bulkBytes,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+        for ok, item in results:
+            if ok is True:
+                continue
+            opType, result = next(iter(item.items()))
+            status = result.get("status")
+            # Works that were never indexed have nothing to delete
+            if opType == "delete" and status == 404:
+                continue
+            if status in GutenbergES.retryStatuses or status == "N/A":
+                retry.append(pending[(opType, str(result["_id"]))])
+            else:
+                failed.append((opType, result["_id"], result.get("error")))
+        return retry, failed
 
     def closeConn(self):
-        GutenbergES.esWriter.closeAll()
+        if len(self.buffer) > 0:
+            self.flush()
+        self.esWriter.closeAll()
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import requests
+
+from helpers.fetcher import AsyncFetcher
+from helpers.metrics import metrics
+
+class GutenbergEnricher:
+
+    def __init__(self, mwReader, oclcReader, getter=requests.get, hostLimit=4, threads=16, speculativeOCLC=False):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.mwReader = mwReader
+        self.oclcReader = oclcReader
+
+        # OCLC data is only used for works that MW matched. Starting the OCLC
+        # requests alongside the MW lookup saves a round trip for those works
+        # at the cost of requests that are thrown away for the rest
+        self.speculativeOCLC = speculativeOCLC
+
+        # A single loop is kept for the life of the enricher so that the
+        # per-host limits carry over from one work to the next
+        self.loop = asyncio.new_event_loop()
+        self.fetcher = AsyncFetcher(getter=getter, hostLimit=hostLimit, threads=threads)
+
+    @metrics.timed("enrich")
+    def enhance(self, work, bookID):
+        return self.loop.run_until_complete(self._enhance(work, bookID))
+
+    # As in the blocking path the OCLC request chain is only made once MW has
+    # matched the work. When speculative OCLC requests are enabled the two are
+    # run side by side instead. The results are applied in the same order
+    # either way since OCLC adds to the identifiers MW creates
+    async def _enhance(self, work, bookID):
+        if self.speculativeOCLC is True:
+            self.logger.debug("Loading Metadata Wrangler and OCLC Data")
+            mwResp, oclcData = await asyncio.gather(
+                self._lookupMW(bookID),
+                self.oclcReader.fetchOCLCDataAsync(work, bookID, self.fetcher)
+            )
+            work = self.mwReader.parseMWData(work, mwResp, bookID)
+        else:
+            self.logger.debug("Loading Metadata Wrangler Data")
+            work = self.mwReader.parseMWData(work, await self._lookupMW(bookID), bookID)
+            oclcData = False
+            if work.ids is not None:
+                self.logger.debug("Loading OCLC Data")
+                oclcData = await self.oclcReader.fetchOCLCDataAsync(work, bookID, self.fetcher)
+
+        if work.ids is None:
+            return work
+
+        if oclcData is not False:
+            self.oclcReader.applyOCLCData(work, oclcData)
+        return work
+
+    async def _lookupMW(self, bookID):
+        with metrics.timer("mw.lookup"):
+            return await self.fetcher.get(self.mwReader.lookupURL(bookID))
+
+    def close(self):
+        self.fetcher.close()
+        self.loop.close()
@@ -0,0 +1,193 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import requests
+from datetime import datetime, date, time, timezone
+from email.utils import format_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+class EpubFetcher:
+
+    def __init__(self, http=requests, epubDir="files/epubs/", workers=4, chunkSize=65536, exploder=None):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.http = http
+        self.epubDir = epubDir
+        self.chunkSize = chunkSize
+        # Downloads are written to temporary files in this directory before
+        # they are moved under their digests, so it has to exist first
+        os.makedirs(self.epubDir, exist_ok=True)
+
+        # When set, each stored epub is unpacked and its items point to the
+        # unpacked directory rather than the archive
+        self.exploder = exploder
+
+        # Downloads are run outside of any database transaction, a few at a
+        # time, by a fixed pool of threads
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "fetched": 0,
+            "not_modified": 0,
+            "skipped": 0,
+            "deduplicated": 0,
+            "failed": 0,
+            "bytes": 0
+        }
+
+    # Items are (item ID, epub) pairs and previous maps each URL to the state
+    # stored from its last download. The results are returned in the same
+    # order as the items
+    def fetchAll(self, items, previous):
+        return list(self.executor.map(
+            self.fetch,
+            [itemID for itemID, epub in items],
+            [epub for itemID, epub in items],
+            [previous.get(epub.url) for itemID, epub in items]
+        ))
+
+    def fetch(self, itemID, epub, previous=None):
+        result = {
+            "id": itemID,
+            "url": epub.url,
+            "status": None,
+            "epub_path": None,
+            "checksum": None,
+            "etag": None,
+            "last_modified": None
+        }
+        archivePath = self._getArchivePath(previous)
+        if self._isCurrent(epub, previous, archivePath) is True:
+            self.logger.debug("Stored epub for {} is current".format(epub.url))
+            self._count("skipped")
+            for field in ["checksum", "etag", "last_modified"]:
+                result[field] = previous[field]
+            result["epub_path"] = self._storeEpub(archivePath)
+            return result
+
+        headers = self._getConditions(previous, archivePath)
+        try:
+            resp = self.http.get(epub.url, headers=headers, stream=True)
+            try:
+                result["status"] = resp.status_code
+                if resp.status_code == 304:
+                    self.logger.debug("Epub at {} has not changed".format(epub.url))
+                    self._count("not_modified")
+                    for field in ["checksum", "etag", "last_modified"]:
+                        result[field] = previous[field]
+                    result["epub_path"] = self._storeEpub(archivePath)
+                elif resp.status_code == 200:
+                    self.logger.debug("Storing downloaded epub from {}".format(epub.url))
+                    archivePath, result["checksum"] = self._writeEpub(resp)
+                    result["epub_path"] = self._storeEpub(archivePath)
+                    result["etag"] = resp.headers.get("ETag")
+                    result["last_modified"] = resp.headers.get("Last-Modified")
+                    self._count("fetched")
+                else:
+                    self.logger.debug("Download Error! Status {}".format(resp.status_code))
+                    self._count("failed")
+            finally:
+                resp.close()
+        except (requests.RequestException, OSError) as err:
+            self.logger.error("EPUB DOWNLOAD FAILED FOR {}".format(epub.url))
+            self.logger.debug(err)
+            self._count("failed")
+        return result
+
+    # No request is made at all when the stored copy was downloaded whole,
+    # is the size the catalog gives and the catalog has not marked the epub
+    # as modified since
+    def _isCurrent(self, epub, previous, archivePath):
+        if previous is None or previous["checksum"] is None or previous["date_modified"] is None:
+            return False
+        try:
+            return (
+                str(epub.date_modified)[:10] == previous["date_modified"].isoformat() and
+                os.path.getsize(archivePath) == int(epub.size)
+            )
+        except (OSError, TypeError, ValueError):
+            return False
+
+    # A conditional request is only made when the file from the last download
+    # is still on disk. Without a stored Last-Modified header the dcterms
+    # modified date recorded for the item is used instead
+    def _getConditions(self, previous, archivePath):
+        headers = {}
+        if archivePath is None or os.path.isfile(archivePath) is False:
+            return headers
+        if previous["etag"] is not None:
+            headers["If-None-Match"] = previous["etag"]
+        if previous["last_modified"] is not None:
+            headers["If-Modified-Since"] = previous["last_modified"]
+        elif isinstance(previous["date_modified"], date):
+            modified = datetime.combine(previous["date_modified"], time(), tzinfo=timezone.utc)
+            headers["If-Modified-Since"] = format_datetime(modified, usegmt=True)
+        return headers
+
+    # Items point at the unpacked directory once an epub has been exploded,
+    # which is named after the same hash as the archive
+    def _getArchivePath(self, previous):
+        if previous is None or previous["epub_path"] is None:
+            return None
+        if os.path.isdir(previous["epub_path"]):
+            return self._getEpubPath(os.path.basename(os.path.normpath(previous["epub_path"])))
+        return previous["epub_path"]
+
+    # Epubs that cannot be unpacked are still stored, with their items
+    # pointing at the archive
+    def _storeEpub(self, archivePath):
+        contentHash = os.path.basename(archivePath)[:-len(".epub")]
+        if self.exploder is None or archivePath.endswith(".epub") is False or len(contentHash) != 64:
+            return archivePath
+        try:
+            return self.exploder.explode(archivePath, contentHash)
+        except Exception as err:
+            self.logger.error("COULD NOT UNPACK EPUB {}".format(archivePath))
+            self.logger.debug(err)
+            return archivePath
+
+    # Epubs are stored under the SHA-256 of their contents, so the same file
+    # is only ever written once however many items point to it
+    def _getEpubPath(self, sha):
+        return os.path.join(self.epubDir, sha[:2], "{}.epub".format(sha))
+
+    # The body is written to a temporary file in chunks as it arrives, with
+    # its digests worked out along the way, and only moved into place once
+    # complete. If the same contents are already stored the download is
+    # discarded. Returns the stored path and MD5 checksum
+    def _writeEpub(self, resp):
+        md5 = hashlib.md5()
+        sha = hashlib.sha256()
+        tmpHandle, tmpPath = tempfile.mkstemp(dir=self.epubDir, suffix=".part")
+        try:
+            with os.fdopen(tmpHandle, "wb") as tmpFile:
+                for chunk in resp.iter_content(chunk_size=self.chunkSize):
+                    tmpFile.write(chunk)
+                    md5.update(chunk)
+                    sha.update(chunk)
+                    self._count("bytes", len(chunk))
+
+            epubPath = self._getEpubPath(sha.hexdigest())
+            if os.path.isfile(epubPath):
+                self._count("deduplicated")
+                os.remove(tmpPath)
+            else:
+                os.makedirs(os.path.dirname(epubPath), exist_ok=True)
+                os.replace(tmpPath, epubPath)
+        except Exception:
+            if os.path.isfile(tmpPath):
+                os.remove(tmpPath)
+            raise
+        return epubPath, md5.hexdigest()
+
+    def _count(self, stat, amount=1):
+        with self.statsLock:
+            self.stats[stat] += amount
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.logger.info("Epub downloads: {}".format(json.dumps(self.stats)))
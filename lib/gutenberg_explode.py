@@ -0,0 +1,209 @@
+import os
+import json
+import mmap
+import shutil
+import logging
+import tempfile
+import posixpath
+import zipfile
+from lxml import etree
+
+class EpubExploder:
+
+    namespaces = {
+        "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+        "opf": "http://www.idpf.org/2007/opf",
+        "dc": "http://purl.org/dc/elements/1.1/",
+        "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+        "xhtml": "http://www.w3.org/1999/xhtml",
+        "epub": "http://www.idpf.org/2007/ops"
+    }
+
+    manifestFile = "manifest.json"
+    spineFile = "spine.bin"
+
+    def __init__(self, storeDir="files/epub_store/"):
+        self.logger = logging.getLogger('guten_logs')
+        self.storeDir = storeDir
+
+    # Each stored epub is unpacked once into a directory named after its
+    # content hash. The spine documents are written one after another into
+    # a single file in reading order and the manifest records where each one
+    # starts, so a chapter can be read as a slice of that file. Everything
+    # else in the archive, such as images and stylesheets, is written out
+    # under its original path. Returns the directory
+    def explode(self, archivePath, contentHash):
+        bookDir = os.path.join(self.storeDir, contentHash[:2], contentHash)
+        if os.path.isfile(os.path.join(bookDir, EpubExploder.manifestFile)):
+            return bookDir
+
+        os.makedirs(os.path.dirname(bookDir), exist_ok=True)
+        tmpDir = tempfile.mkdtemp(dir=os.path.dirname(bookDir), suffix=".part")
+        try:
+            with zipfile.ZipFile(archivePath) as archive:
+                manifest = self._unpack(archive, tmpDir)
+            with open(os.path.join(tmpDir, EpubExploder.manifestFile), "w") as manifestFile:
+                json.dump(manifest, manifestFile)
+            # Another process may have unpacked the same epub in the meantime
+            try:
+                os.rename(tmpDir, bookDir)
+            except OSError:
+                if os.path.isfile(os.path.join(bookDir, EpubExploder.manifestFile)) is False:
+                    raise
+                shutil.rmtree(tmpDir)
+        except Exception:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+        return bookDir
+
+    def _unpack(self, archive, bookDir):
+        opfPath = self._getOPFPath(archive)
+        opf = etree.fromstring(archive.read(opfPath))
+        opfDir = posixpath.dirname(opfPath)
+
+        items = {}
+        for item in opf.iterfind("opf:manifest/opf:item", EpubExploder.namespaces):
+            items[item.get("id")] = {
+                "href": posixpath.normpath(posixpath.join(opfDir, item.get("href"))),
+                "media_type": item.get("media-type"),
+                "properties": item.get("properties") or ""
+            }
+
+        spine = []
+        spineHrefs = set()
+        offset = 0
+        with open(os.path.join(bookDir, EpubExploder.spineFile), "wb") as spineFile:
+            for itemRef in opf.iterfind("opf:spine/opf:itemref", EpubExploder.namespaces):
+                item = items.get(itemRef.get("idref"))
+                if item is None or item["href"] in spineHrefs:
+                    continue
+                content = archive.read(item["href"])
+                spineFile.write(content)
+                spine.append({
+                    "id": itemRef.get("idref"),
+                    "href": item["href"],
+                    "media_type": item["media_type"],
+                    "title": None,
+                    "offset": offset,
+                    "size": len(content)
+                })
+                spineHrefs.add(item["href"])
+                offset += len(content)
+
+        resources = []
+        for info in archive.infolist():
+            if info.is_dir() or info.filename in spineHrefs:
+                continue
+            targetPath = self._getTargetPath(bookDir, info.filename)
+            if targetPath is None:
+                self.logger.warning("Skipping unsafe epub entry {}".format(info.filename))
+                continue
+            os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+            with archive.open(info) as source, open(targetPath, "wb") as target:
+                shutil.copyfileobj(source, target)
+            resources.append({"href": info.filename, "size": info.file_size})
+
+        toc = self._getTOC(archive, opf, items)
+        chapters = dict((chapter["href"], index) for index, chapter in enumerate(spine))
+        for entry in toc:
+            entry["chapter"] = chapters.get(entry["href"].split("#")[0])
+            if entry["chapter"] is not None and spine[entry["chapter"]]["title"] is None:
+                spine[entry["chapter"]]["title"] = entry["title"]
+
+        title = opf.findtext("opf:metadata/dc:title", namespaces=EpubExploder.namespaces)
+        return {
+            "title": title,
+            "opf": opfPath,
+            "spine": spine,
+            "toc": toc,
+            "resources": resources
+        }
+
+    def _getOPFPath(self, archive):
+        container = etree.fromstring(archive.read("META-INF/container.xml"))
+        rootFile = container.find(".//container:rootfile", EpubExploder.namespaces)
+        return rootFile.get("full-path")
+
+    # The table of contents comes from the NCX file named by the spine, or
+    # from the EPUB 3 navigation document if there is no NCX
+    def _getTOC(self, archive, opf, items):
+        spine = opf.find("opf:spine", EpubExploder.namespaces)
+        ncx = items.get(spine.get("toc")) if spine is not None else None
+        if ncx is not None:
+            return self._readNCX(archive, ncx["href"])
+        for item in items.values():
+            if "nav" in item["properties"].split():
+                return self._readNav(archive, item["href"])
+        return []
+
+    def _readNCX(self, archive, ncxPath):
+        ncx = etree.fromstring(archive.read(ncxPath))
+        ncxDir = posixpath.dirname(ncxPath)
+        toc = []
+        for navPoint in ncx.iterfind(".//ncx:navPoint", EpubExploder.namespaces):
+            content = navPoint.find("ncx:content", EpubExploder.namespaces)
+            if content is None:
+                continue
+            toc.append({
+                "title": (navPoint.findtext("ncx:navLabel/ncx:text", namespaces=EpubExploder.namespaces) or "").strip(),
+                "href": posixpath.normpath(posixpath.join(ncxDir, content.get("src")))
+            })
+        return toc
+
+    def _readNav(self, archive, navPath):
+        nav = etree.fromstring(archive.read(navPath))
+        navDir = posixpath.dirname(navPath)
+        toc = []
+        for navElem in nav.iterfind(".//xhtml:nav", EpubExploder.namespaces):
+            if navElem.get("{{{}}}type".format(EpubExploder.namespaces["epub"])) != "toc":
+                continue
+            for link in navElem.iterfind(".//xhtml:a[@href]", EpubExploder.namespaces):
+                toc.append({
+                    "title": "".join(link.itertext()).strip(),
+                    "href": posixpath.normpath(posixpath.join(navDir, link.get("href")))
+                })
+        return toc
+
+    # Archive entries are only written inside the book's directory
+    def _getTargetPath(self, bookDir, entryName):
+        if entryName.startswith("/") or ".." in entryName.split("/"):
+            return None
+        return os.path.join(bookDir, *entryName.split("/"))
+
+
+# Reads chapters from an unpacked epub. The spine file is mapped into memory
+# once and each chapter is a slice of it, so nothing is decompressed or read
+# beyond the chapter that is asked for
+class ExplodedEpub:
+
+    def __init__(self, bookDir):
+        self.bookDir = bookDir
+        with open(os.path.join(bookDir, EpubExploder.manifestFile)) as manifestFile:
+            self.manifest = json.load(manifestFile)
+        self.chapters = dict(
+            (chapter["href"], index) for index, chapter in enumerate(self.manifest["spine"])
+        )
+
+        self.spineFile = open(os.path.join(bookDir, EpubExploder.spineFile), "rb")
+        self.spine = None
+        if os.path.getsize(self.spineFile.name) > 0:
+            self.spine = mmap.mmap(self.spineFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def getChapterCount(self):
+        return len(self.manifest["spine"])
+
+    # Chapters can be asked for by their position in the spine or by their
+    # path in the archive
+    def getChapter(self, chapter):
+        if isinstance(chapter, str):
+            chapter = self.chapters[chapter.split("#")[0]]
+        entry = self.manifest["spine"][chapter]
+        return self.spine[entry["offset"]:entry["offset"] + entry["size"]]
+
+    def getResourcePath(self, href):
+        return os.path.join(self.bookDir, *href.split("/"))
+
+    def close(self):
+        if self.spine is not None:
+            self.spine.close()
+        self.spineFile.close()
@@ -0,0 +1,120 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+
+class GutenbergManifest:
+
+    # Stored in place of a hash for books that have been removed
+    deletedMarker = "DELETED"
+
+    def __init__(self, manifestPath):
+        self.logger = logging.getLogger('guten_logs')
+
+        # Pool workers each open the manifest, sqlite locks the file while
+        # one of them is writing
+        self.db = sqlite3.connect(manifestPath, timeout=60)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS books (
+                book_id     TEXT PRIMARY KEY,
+                rdf_hash    TEXT NOT NULL,
+                rdf_mtime   REAL NULL,
+                epubs       TEXT NULL,
+                ingested    REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    @staticmethod
+    def hashData(rdfData):
+        return hashlib.sha1(rdfData).hexdigest()
+
+    # This walks the catalog directory and returns the books that are new or
+    # whose RDF file has changed since they were last stored, along with the
+    # books that Gutenberg has marked for deletion. Files are only hashed if
+    # their modification time has moved
+    def findChanges(self, epubDir):
+        stored = {}
+        for bookID, rdfHash, rdfMtime in self.db.execute(
+            "SELECT book_id, rdf_hash, rdf_mtime FROM books"
+        ):
+            stored[bookID] = (rdfHash, rdfMtime)
+
+        changed = []
+        deleted = []
+        touched = []
+        for entry in os.listdir(epubDir):
+            if 'DELETE' in entry:
+                bookID = self._getDeletedID(entry)
+                if bookID is not None and stored.get(bookID, (None,))[0] != GutenbergManifest.deletedMarker:
+                    deleted.append(bookID)
+                continue
+
+            rdfPath = self._getRDFPath(epubDir, entry)
+            if rdfPath is None:
+                continue
+
+            if entry not in stored:
+                changed.append(entry)
+                continue
+
+            storedHash, storedMtime = stored[entry]
+            rdfMtime = os.path.getmtime(rdfPath)
+            if rdfMtime == storedMtime:
+                continue
+
+            with open(rdfPath, "rb") as rdfFile:
+                rdfHash = self.hashData(rdfFile.read())
+            if rdfHash != storedHash:
+                changed.append(entry)
+            else:
+                touched.append((rdfMtime, entry))
+
+        # Files that were rewritten without changing keep their new mtime so
+        # they are not hashed again on the next run
+        self.db.executemany("UPDATE books SET rdf_mtime = ? WHERE book_id = ?", touched)
+        self.db.commit()
+
+        self.logger.info("Found {} changed and {} deleted books".format(len(changed), len(deleted)))
+        return changed, deleted
+
+    # The epubs are given as ItemRecords and stored as their fields
+    def record(self, bookID, rdfHash, rdfMtime, ebooks):
+        epubs = json.dumps([ebook.toDict() for ebook in ebooks])
+        self.db.execute("""
+            INSERT OR REPLACE INTO books (book_id, rdf_hash, rdf_mtime, epubs, ingested)
+            VALUES (?, ?, ?, ?, ?)
+        """, (str(bookID), rdfHash, rdfMtime, epubs, time.time()))
+        self.db.commit()
+
+    def markDeleted(self, bookID):
+        self.record(bookID, GutenbergManifest.deletedMarker, None, [])
+
+    def getEbooks(self, bookID):
+        row = self.db.execute(
+            "SELECT epubs FROM books WHERE book_id = ?", (str(bookID),)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return []
+        return json.loads(row[0])
+
+    def _getDeletedID(self, entry):
+        bookID = re.search(r"[0-9]+", entry)
+        if bookID is not None:
+            return bookID.group(0)
+        return None
+
+    def _getRDFPath(self, epubDir, entry):
+        rdfDir = os.path.join(epubDir, entry)
+        if entry.isdigit() is False or int(entry) == 0 or os.path.isdir(rdfDir) is False:
+            return None
+        rdfFiles = os.listdir(rdfDir)
+        if len(rdfFiles) < 1:
+            return None
+        return os.path.join(rdfDir, rdfFiles[0])
+
+    def close(self):
+        self.db.close()
@@ -2,17 +2,47 @@ import requests
 import os
 import sys
 import logging
+from io import BytesIO
 from lxml import etree
 
+from helpers.cache import ResponseCache
+from helpers.config import GutenbergConfig
+from helpers.http import HTTPClient
+from helpers.metrics import metrics
+from lib.gutenberg_enrich import GutenbergEnricher
+from lib.gutenberg_epubs import EpubFetcher
+from lib.gutenberg_explode import EpubExploder
+from lib.gutenberg_manifest import GutenbergManifest
 from lib.gutenberg_xml import gutenbergXML
 from lib.gutenberg_store import GutenbergDB
 from lib.gutenberg_elastic import GutenbergES
 from readers.metadatawrangler import MetadataWranglerReader
 from readers.oclc import oclcReader
 
+# MW and OCLC responses are cached by endpoint, each with its own time to live
+def createResponseCache(config, cacheOnly, upstream):
+    responseCache = ResponseCache(
+        config.getConfigValue("http_cache", "path", "files/http_cache"),
+        config.getConfigInt("http_cache", "max_size_mb", 2048) * 1024 * 1024,
+        cacheOnly=cacheOnly,
+        upstream=upstream
+    )
+    # Time to live for each endpoint, in days
+    endpoints = [
+        ("mw", MetadataWranglerReader.mwURL, 7),
+        ("oclc_search", oclcReader.oclcSearch, 30),
+        ("oclc_classify", oclcReader.oclcClassify, 30),
+        ("oclc_catalog", oclcReader.oclcCatalog, 90)
+    ]
+    for name, prefix, ttl in endpoints:
+        days = config.getConfigInt("http_cache", "ttl_{}".format(name), ttl)
+        responseCache.addEndpoint(name, prefix, days * 86400)
+    return responseCache
+
+
 class GutenbergBib:
 
-    def __init__(self, catalogDir, test=False):
+    def __init__(self, catalogDir, test=False, cacheOnly=False, http=None):
         self.logger = logging.getLogger('guten_logs')
 
         # This is where we read the RDF files from
@@ -20,79 +50,291 @@ class GutenbergBib:
 
         # These should get reset for next book
         self.currentBib = None
-        self.metadata = {}
-        self.ebookURLs = []
+        self.work = None
+        self.items = []
+        self.rdfState = None
+
+        config = GutenbergConfig()
+
+        # Records the state of each stored RDF file for incremental ingests
+        self.manifest = GutenbergManifest(
+            config.getConfigValue("ingest", "manifest", "files/gutenberg_manifest.db")
+        )
+
+        # All requests go through one pooled client. This is created here
+        # unless the caller already has one to share
+        self.ownsHTTP = http is None
+        if http is None:
+            http = HTTPClient()
+        self.http = http
+
+        # MW and OCLC responses can be served from a local cache, and in
+        # cache only mode are never requested from the network at all
+        self.responseCache = None
+        readerHTTP = http
+        if cacheOnly is True or config.getConfigFlag("http_cache", "enabled"):
+            self.responseCache = createResponseCache(config, cacheOnly, self.http)
+            readerHTTP = self.responseCache
 
         self.gutenbergXML = gutenbergXML()
-        self.mwReader = MetadataWranglerReader()
-        self.oclcReader = oclcReader()
+        self.mwReader = MetadataWranglerReader(http=readerHTTP)
+        self.oclcReader = oclcReader(http=readerHTTP)
 
-        self.dbConnector = GutenbergDB(test=test)
-        self.esConnector = GutenbergES()
+        # Optionally make the MW and OCLC lookups concurrently
+        self.enricher = None
+        if config.getConfigFlag("enrichment", "async"):
+            self.enricher = GutenbergEnricher(
+                self.mwReader,
+                self.oclcReader,
+                getter=readerHTTP.get,
+                hostLimit=config.getConfigInt("enrichment", "host_concurrency", 4),
+                threads=config.getConfigInt("enrichment", "threads", 16),
+                speculativeOCLC=config.getConfigFlag("enrichment", "speculative_oclc")
+            )
+
+        # With the reindex queue enabled, changed works are left for the
+        # reindex worker and ingest never connects to ES
+        self.queueReindex = config.getConfigFlag("reindex", "queue")
+
+        self.dbConnector = GutenbergDB(
+            test=test,
+            cacheSize=config.getConfigInt("lookup_cache", "size", 10000),
+            warmCache=config.getConfigFlag("lookup_cache", "warm"),
+            queueReindex=self.queueReindex
+        )
+        self.esConnector = None
+        if self.queueReindex is not True:
+            self.esConnector = GutenbergES()
+
+        # Epubs are downloaded once their works have been committed, and can
+        # be unpacked for their chapters to be read directly
+        exploder = None
+        if config.getConfigFlag("epubs", "explode"):
+            exploder = EpubExploder(config.getConfigValue("epubs", "explode_path", "files/epub_store/"))
+        self.epubFetcher = EpubFetcher(
+            http=http,
+            epubDir=config.getConfigValue("epubs", "path", "files/epubs/"),
+            workers=config.getConfigInt("epubs", "workers", 4),
+            chunkSize=config.getConfigInt("epubs", "chunk_kb", 64) * 1024,
+            exploder=exploder
+        )
+
+        # Works can be stored in batches that share a single transaction
+        self.batchSize = config.getConfigInt("ingest", "batch_size", 1)
+        self.batch = []
 
         self.test = test
 
     # This is called after each work is processed to prep for the next
     def reset(self):
         self.currentBib = None
-        self.metadata = {}
-        self.ebookURLs = []
-        self.gutenbergXML.metadata["entities"] = []
-        self.gutenbergXML.metadata["subjects"] = []
+        self.work = None
+        self.items = []
+        self.rdfState = None
+
+    # This is called if a book fails partway through so that the open
+    # transaction does not block the next one
+    def recover(self):
+        self.reset()
+        self.dbConnector.rollbackOps()
+
+    def close(self):
+        self.flushBatch()
+        self.epubFetcher.close()
+        self.dbConnector.closeAll()
+        if self.esConnector is not None:
+            self.esConnector.closeConn()
+        if self.enricher is not None:
+            self.enricher.close()
+        if self.responseCache is not None:
+            self.responseCache.close()
+        if self.ownsHTTP is True:
+            self.http.close()
+        self.manifest.close()
 
     def readDir(self):
         self.logger.info("Parsing all Gutenberg books")
+        self.readBooks(os.listdir(self.epubDir))
 
-        list(map(self.readBib, os.listdir(self.epubDir)))
-        self.dbConnector.closeAll()
-        self.esConnector.closeConn()
+    def readBooks(self, bookIDs):
+        list(map(self.readBib, bookIDs))
+        self.close()
+
+    # Remove books that Gutenberg has withdrawn from the catalog
+    def deleteBooks(self, bookIDs):
+        list(map(self.deleteBib, bookIDs))
+
+    def deleteBib(self, bookID):
+        self.logger.info("DELETING {}".format(bookID))
+        res = self.dbConnector.deleteRecord(bookID)
+        self.manifest.markDeleted(bookID)
+        if self.test is True or self.esConnector is None:
+            return True
+
+        for workID in res["deleted"]:
+            self.esConnector.dropES(workID)
+        self.esConnector.storeWorks(res["updated"])
+        return True
+
+    # Read books as they are streamed out of the RDF catalog tarball rather
+    # than from the extracted catalog directory
+    def readStream(self, records):
+        self.logger.info("Parsing Gutenberg books from catalog stream")
+
+        for bookID, rdfData in records:
+            self.readBib(bookID, rdfFile=BytesIO(rdfData))
+        self.close()
+
+    # Read books from the combined RDF catalog file. Records are parsed as
+    # the file is streamed, so the whole catalog is never in memory
+    def readCatalog(self, catalogFile):
+        self.logger.info("Parsing Gutenberg books from {}".format(catalogFile))
 
+        for bookID, book, rdfData in self.gutenbergXML.loadCatalog(catalogFile):
+            metrics.count("books.read")
+            self.currentBib = bookID
+            self.work = book.work
+            self.items = book.items
+            self.rdfState = (self.manifest.hashData(rdfData), None)
+            self.processBib(bookID)
+        self.close()
 
-    def readBib(self, bookID):
-        self.logger.info("READING {}".format(bookID))
+    def readBib(self, bookID, rdfFile=None):
+        self.logger.debug("READING {}".format(bookID))
+        metrics.count("books.read")
         # Load the ebook URLs and book metadata
-        status = self.loadBib(bookID)
+        status = self.loadBib(bookID, rdfFile=rdfFile)
 
         # If we failed to create the book warn and continue
         if status is False:
             self.logger.warning("DID NOT PARSE BOOK {}".format(bookID))
+            metrics.count("books.not_parsed")
             return False
 
+        return self.processBib(bookID)
+
+    # Enhance, store and index the currently loaded book
+    def processBib(self, bookID):
         # Enhance the data we got from Gutenberg with data from MW
         enhanceStatus = self.enhanceBib()
         if enhanceStatus is not True:
-            return ehanceStatus
+            self.reset()
+            return enhanceStatus
+
+        if self.batchSize > 1:
+            self.batch.append((
+                bookID,
+                self.work,
+                self.items,
+                self.rdfState
+            ))
+            self.reset()
+            if len(self.batch) >= self.batchSize:
+                self.flushBatch()
+            return True
 
         # Store the book in the database
-        res = self.dbConnector.insert_record(self.metadata, self.ebookURLs)
+        res = self.dbConnector.insert_record(self.work, self.items)
         if res["result"] > 0:
             self.logger.error("WORK INSERT FAILED FOR {}".format(res["work"]))
             sys.exit(3)
-        self.logger.debug("{} RECORD {}".format(res["status"], res["work"]))
+        rdfState = self.rdfState
+        items = self.items
         self.reset()
 
+        self.fetchEpubs([res])
+        self.indexBib(bookID, res, rdfState, items)
+        return True
+
+    # Store all of the queued books in one transaction and then index them.
+    # Returns the books that could not be stored
+    def flushBatch(self):
+        if len(self.batch) < 1:
+            return []
+        batch = self.batch
+        self.batch = []
+
+        results = self.dbConnector.insert_records([
+            (work, items) for bookID, work, items, rdfState in batch
+        ])
+
+        failed = []
+        stored = []
+        for (bookID, work, items, rdfState), res in zip(batch, results):
+            if res["result"] > 0:
+                self.logger.error("WORK INSERT FAILED FOR {}".format(bookID))
+                failed.append(bookID)
+                continue
+            self.logger.debug("{} RECORD {}".format(res["status"], res["work"]))
+            stored.append((bookID, res["work"], rdfState, items))
+
+        self.fetchEpubs([res for res in results if res["result"] == 0])
+
         if self.test is True:
-            return True
+            return failed
 
-        if res["status"] == "existing":
-            self.esConnector.dropES(res["work"])
-        self.esConnector.storeES(res["work"])
-        return True
+        # The documents for the whole batch are built together so the number
+        # of queries made does not grow with the size of the batch
+        if self.esConnector is not None:
+            self.esConnector.storeWorks([workID for bookID, workID, rdfState, items in stored])
+        for bookID, workID, rdfState, items in stored:
+            self.recordBib(bookID, rdfState, items)
+        return failed
+
+    # The epubs for every stored item are downloaded together, after the
+    # transaction that created the items, and their paths written back in a
+    # second short transaction
+    def fetchEpubs(self, results):
+        items = [item for res in results for item in res["items"]]
+        if len(items) < 1:
+            return
+        fetchState = self.dbConnector.getFetchState([epub.url for itemID, epub in items])
+        fetches = self.epubFetcher.fetchAll(items, fetchState)
+        self.dbConnector.recordFetches(fetches, [res["work"] for res in results])
+
+    def indexBib(self, bookID, res, rdfState, items):
+        self.logger.debug("{} RECORD {}".format(res["status"], res["work"]))
+        if self.test is True:
+            return
+
+        # Existing works are replaced in place since documents are indexed
+        # under the work ID
+        if self.esConnector is not None:
+            self.esConnector.storeES(res["work"])
+        self.recordBib(bookID, rdfState, items)
+
+    def recordBib(self, bookID, rdfState, items):
+        rdfHash, rdfMtime = rdfState
+        self.manifest.record(bookID, rdfHash, rdfMtime, items)
 
     # This provides the main processing for each work and loads metadata from it
-    def loadBib(self, bookID):
+    def loadBib(self, bookID, rdfFile=None):
         rdfDir = "{}{}".format(self.epubDir, bookID)
         if 'DELETE' in str(bookID):
-            # TODO Execute the delete request in the psql/es
+            # Deletions are handled by deleteBooks during incremental ingests
             self.logger.warning("BOOK TO BE DELETED")
             return False
-        elif os.path.isdir(rdfDir) is False or int(bookID) == 0:
+        elif rdfFile is None and os.path.isdir(rdfDir) is False:
+            return False
+        elif int(bookID) == 0:
             return False
 
         self.currentBib = bookID
-        rdfFile = "{}/{}".format(rdfDir, os.listdir(rdfDir)[0])
-        self.logger.info("Loading publication from {}".format(rdfFile))
-        self.metadata, self.ebookURLs = self.gutenbergXML.load(rdfFile)
+        if rdfFile is None:
+            rdfPath = "{}/{}".format(rdfDir, os.listdir(rdfDir)[0])
+            self.logger.debug("Loading publication from {}".format(rdfPath))
+            with open(rdfPath, "rb") as rdfSource:
+                rdfFile = BytesIO(rdfSource.read())
+            rdfMtime = os.path.getmtime(rdfPath)
+        else:
+            rdfMtime = None
+
+        # The hash of the source file is kept so that unchanged books can be
+        # skipped by the next incremental ingest
+        self.rdfState = (self.manifest.hashData(rdfFile.getvalue()), rdfMtime)
+        book = self.gutenbergXML.load(rdfFile)
+        self.work = book.work
+        self.items = book.items
         return True
 
 
@@ -100,14 +342,25 @@ class GutenbergBib:
     # that we get back
     def enhanceBib(self):
 
-        self.logger.info("Formatting Record")
+        self.logger.debug("Formatting Record")
+
+        if self.enricher is not None:
+            self.work = self.enricher.enhance(self.work, self.currentBib)
+            if self.work.ids is None:
+                self.logger.warning("BAD RECORD. CHECK SOURCE GUTENBERG FILE")
+                metrics.count("books.unmatched")
+                return False
+            return True
 
-        self.logger.info("Loading Metadata Wrangler Data")
-        self.metadata = self.mwReader.getMWData(self.metadata, self.currentBib)
-        if "ids" not in self.metadata:
+        self.logger.debug("Loading Metadata Wrangler Data")
+        with metrics.timer("mw"):
+            self.work = self.mwReader.getMWData(self.work, self.currentBib)
+        if self.work.ids is None:
             self.logger.warning("BAD RECORD. CHECK SOURCE GUTENBERG FILE")
+            metrics.count("books.unmatched")
             return False
-        self.logger.info("Loading OCLC Data")
-        self.oclcReader.getOCLCData(self.metadata, self.currentBib)
+        self.logger.debug("Loading OCLC Data")
+        with metrics.timer("oclc"):
+            self.oclcReader.getOCLCData(self.work, self.currentBib)
 
         return True
@@ -0,0 +1,293 @@
+import os
+import logging
+from io import BytesIO
+
+from helpers.config import GutenbergConfig
+from helpers.http import HTTPClient
+from helpers.metrics import metrics
+from helpers.pipeline import Pipeline, PipelineStage
+from lib.gutenberg_enrich import GutenbergEnricher
+from lib.gutenberg_epubs import EpubFetcher
+from lib.gutenberg_explode import EpubExploder
+from lib.gutenberg_manifest import GutenbergManifest
+from lib.gutenberg_parse import GutenbergBib, createResponseCache
+from lib.gutenberg_xml import gutenbergXML, isCatalogBook
+from lib.gutenberg_store import GutenbergDB
+from lib.gutenberg_elastic import GutenbergES
+from readers.metadatawrangler import MetadataWranglerReader
+from readers.oclc import oclcReader
+
+# Reads books through a pipeline where parsing, enrichment, storage, epub
+# downloads and indexing each run in their own threads, connected by bounded
+# queues. Every stage works on a different book at once, so the slowest stage
+# sets the pace of the ingest rather than the sum of all of them. Each worker
+# holds its own connections
+class GutenbergPipeline:
+
+    def __init__(self, catalogDir, test=False, cacheOnly=False, http=None):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.catalogDir = catalogDir
+        self.epubDir = catalogDir + "/cache/epub/"
+        self.test = test
+        self.cacheOnly = cacheOnly
+
+        self.config = GutenbergConfig()
+
+        self.ownsHTTP = http is None
+        if http is None:
+            http = HTTPClient()
+        self.http = http
+
+        # The response cache and the readers that use it are opened for each
+        # run, since the cache is closed when a run ends
+        self.responseCache = None
+        self.readerHTTP = None
+        self.mwReader = None
+        self.oclcReader = None
+
+        # The parser keeps nothing about the book it is reading, so one is
+        # shared by all of the parse workers
+        self.gutenbergXML = gutenbergXML()
+
+        self.queueReindex = self.config.getConfigFlag("reindex", "queue")
+        self.batchSize = self.config.getConfigInt("ingest", "batch_size", 1)
+
+    def readDir(self):
+        self.logger.info("Parsing all Gutenberg books through the ingest pipeline")
+        return self.readBooks(os.listdir(self.epubDir))
+
+    def readBooks(self, bookIDs):
+        return self._run((bookID, None) for bookID in bookIDs)
+
+    def readStream(self, records):
+        self.logger.info("Parsing Gutenberg books from catalog stream through the ingest pipeline")
+        return self._run(records)
+
+    # The combined catalog is streamed here and each serialized ebook record
+    # is only parsed by the parse stage
+    def readCatalog(self, catalogFile):
+        return self.readStream(self.gutenbergXML.loadCatalogRecords(catalogFile))
+
+    # Deletions are rare enough that they are made one at a time outside of
+    # the pipeline
+    def deleteBooks(self, bookIDs):
+        if len(bookIDs) < 1:
+            return
+        bib = GutenbergBib(self.catalogDir, test=self.test, cacheOnly=self.cacheOnly, http=self.http)
+        bib.deleteBooks(bookIDs)
+        bib.close()
+
+    # The response cache serializes its own access so it is shared by all of
+    # the enrichment workers. Like the parser, the readers keep nothing about
+    # the book they are reading
+    def _openReaders(self):
+        self.readerHTTP = self.http
+        if self.cacheOnly is True or self.config.getConfigFlag("http_cache", "enabled"):
+            self.responseCache = createResponseCache(self.config, self.cacheOnly, self.http)
+            self.readerHTTP = self.responseCache
+        self.mwReader = MetadataWranglerReader(http=self.readerHTTP)
+        self.oclcReader = oclcReader(http=self.readerHTTP)
+
+    def close(self):
+        if self.responseCache is not None:
+            self.responseCache.close()
+            self.responseCache = None
+        if self.ownsHTTP is True:
+            self.http.close()
+
+    # Books are given as (book ID, RDF data) pairs, where the data is None
+    # for books read from the catalog directory
+    def _run(self, books):
+        self._openReaders()
+        pipeline = self._createPipeline()
+        records = (
+            {"bookID": bookID, "rdfData": rdfData}
+            for bookID, rdfData in books
+            if self._isBook(bookID)
+        )
+        try:
+            summary = pipeline.run(records)
+        finally:
+            self.close()
+        self._logSummary(summary)
+        return summary
+
+    def _createPipeline(self):
+        workers = self._getWorkers
+        batchSize = max(self.batchSize, 1)
+        stages = [
+            PipelineStage("parse", self._parse, workers("parse", 1)),
+            PipelineStage("enrich", self._enrich, workers("enrich", 4), setup=self._createEnricher, teardown=self._closeEnricher),
+            PipelineStage("store", self._store, workers("store", 1), batchSize, setup=self._createDB, teardown=self._closeDB),
+            PipelineStage("fetch", self._fetch, workers("fetch", 1), batchSize, setup=self._createFetcher, teardown=self._closeFetcher),
+            PipelineStage("index", self._index, workers("index", 1), batchSize, setup=self._createIndexer, teardown=self._closeIndexer)
+        ]
+        return Pipeline(
+            stages,
+            queueSize=self.config.getConfigInt("pipeline", "queue_size", 100),
+            statsInterval=self.config.getConfigInt("pipeline", "stats_interval", 60),
+            keyFunc=lambda record: record["bookID"]
+        )
+
+    def _getWorkers(self, stage, default):
+        return self.config.getConfigInt("pipeline", "{}_workers".format(stage), default)
+
+    def _isBook(self, bookID):
+        if isCatalogBook(bookID) is False:
+            self.logger.debug("Skipping catalog entry {}".format(bookID))
+            return False
+        return True
+
+    def _parse(self, record, context):
+        rdfMtime = None
+        if record["rdfData"] is None:
+            rdfDir = "{}{}".format(self.epubDir, record["bookID"])
+            if os.path.isdir(rdfDir) is False:
+                raise ValueError("not parsed")
+            rdfPath = "{}/{}".format(rdfDir, os.listdir(rdfDir)[0])
+            with open(rdfPath, "rb") as rdfSource:
+                record["rdfData"] = rdfSource.read()
+            rdfMtime = os.path.getmtime(rdfPath)
+
+        book = self.gutenbergXML.load(BytesIO(record["rdfData"]))
+        record["work"] = book.work
+        record["items"] = book.items
+        record["rdfState"] = (GutenbergManifest.hashData(record["rdfData"]), rdfMtime)
+        # The source is not needed again and would otherwise be held in every
+        # queue downstream
+        record["rdfData"] = None
+        return record
+
+    # The async enricher runs its own event loop, so each worker has one
+    def _enrich(self, record, enricher):
+        if enricher is not None:
+            record["work"] = enricher.enhance(record["work"], record["bookID"])
+            if record["work"].ids is None:
+                raise ValueError("bad record")
+            return record
+
+        with metrics.timer("mw"):
+            record["work"] = self.mwReader.getMWData(record["work"], record["bookID"])
+        if record["work"].ids is None:
+            raise ValueError("bad record")
+        with metrics.timer("oclc"):
+            self.oclcReader.getOCLCData(record["work"], record["bookID"])
+        return record
+
+    # Each batch is stored in a single transaction. A batch that fails as a
+    # whole is rolled back so the worker's connection can take the next one
+    def _store(self, records, db):
+        try:
+            results = db.insert_records([
+                (record["work"], record["items"]) for record in records
+            ])
+        except Exception:
+            db.rollbackOps()
+            raise
+        stored = []
+        for record, res in zip(records, results):
+            if res["result"] > 0:
+                self.logger.error("WORK INSERT FAILED FOR {}".format(record["bookID"]))
+                stored.append(RuntimeError("not stored"))
+                continue
+            self.logger.debug("{} RECORD {}".format(res["status"], res["work"]))
+            record["work"] = None
+            record["res"] = res
+            stored.append(record)
+        return stored
+
+    def _fetch(self, records, fetchContext):
+        db, epubFetcher = fetchContext
+        items = [item for record in records for item in record["res"]["items"]]
+        if len(items) < 1:
+            return records
+        try:
+            fetchState = db.getFetchState([epub.url for itemID, epub in items])
+            fetches = epubFetcher.fetchAll(items, fetchState)
+            db.recordFetches(fetches, [record["res"]["work"] for record in records])
+        except Exception:
+            db.rollbackOps()
+            raise
+        return records
+
+    # Books are only recorded in the manifest once their works have been sent
+    # to ES, or queued for the reindex worker
+    def _index(self, records, indexer):
+        esConnector, manifest = indexer
+        if self.test is True:
+            return records
+        if esConnector is not None:
+            esConnector.storeWorks([record["res"]["work"] for record in records])
+        for record in records:
+            rdfHash, rdfMtime = record["rdfState"]
+            manifest.record(record["bookID"], rdfHash, rdfMtime, record["items"])
+        return records
+
+    def _createEnricher(self):
+        if self.config.getConfigFlag("enrichment", "async") is not True:
+            return None
+        return GutenbergEnricher(
+            self.mwReader,
+            self.oclcReader,
+            getter=self.readerHTTP.get,
+            hostLimit=self.config.getConfigInt("enrichment", "host_concurrency", 4),
+            threads=self.config.getConfigInt("enrichment", "threads", 16),
+            speculativeOCLC=self.config.getConfigFlag("enrichment", "speculative_oclc")
+        )
+
+    def _closeEnricher(self, enricher):
+        enricher.close()
+
+    def _createDB(self):
+        return GutenbergDB(
+            test=self.test,
+            cacheSize=self.config.getConfigInt("lookup_cache", "size", 10000),
+            warmCache=self.config.getConfigFlag("lookup_cache", "warm"),
+            queueReindex=self.queueReindex
+        )
+
+    def _closeDB(self, db):
+        db.closeAll()
+
+    def _createFetcher(self):
+        exploder = None
+        if self.config.getConfigFlag("epubs", "explode"):
+            exploder = EpubExploder(self.config.getConfigValue("epubs", "explode_path", "files/epub_store/"))
+        epubFetcher = EpubFetcher(
+            http=self.http,
+            epubDir=self.config.getConfigValue("epubs", "path", "files/epubs/"),
+            workers=self.config.getConfigInt("epubs", "workers", 4),
+            chunkSize=self.config.getConfigInt("epubs", "chunk_kb", 64) * 1024,
+            exploder=exploder
+        )
+        return self._createDB(), epubFetcher
+
+    def _closeFetcher(self, fetchContext):
+        fetchContext[1].close()
+        fetchContext[0].closeAll()
+
+    # The manifest is a SQLite file, so each index worker opens its own
+    # connection to it from its own thread
+    def _createIndexer(self):
+        esConnector = None
+        if self.queueReindex is not True and self.test is not True:
+            esConnector = GutenbergES()
+        manifest = GutenbergManifest(
+            self.config.getConfigValue("ingest", "manifest", "files/gutenberg_manifest.db")
+        )
+        return esConnector, manifest
+
+    def _closeIndexer(self, indexer):
+        if indexer[0] is not None:
+            indexer[0].closeConn()
+        indexer[1].close()
+
+    def _logSummary(self, summary):
+        self.logger.info("Stored {} books, {} failures in {}s".format(
+            summary["processed"],
+            len(summary["failed"]),
+            summary["elapsed"]
+        ))
+        for bookID, reason in summary["failed"]:
+            self.logger.warning("FAILED BOOK {}: {}".format(bookID, reason))
@@ -0,0 +1,197 @@
+import os
+import logging
+from io import BytesIO
+from collections import defaultdict, deque
+from multiprocessing import Pool, util
+
+from helpers.metrics import metrics
+from lib.gutenberg_parse import GutenbergBib
+from lib.gutenberg_xml import gutenbergXML
+
+# Each worker process holds its own GutenbergBib, and with it its own
+# gutenbergXML parser, readers, GutenbergDB connection and ES client. Nothing
+# that holds a socket is shared across the process boundary
+workerBib = None
+
+
+def initWorker(catalogDir, test, cacheOnly):
+    global workerBib
+    workerBib = GutenbergBib(catalogDir, test=test, cacheOnly=cacheOnly)
+    # Pool workers exit without running atexit hooks, so register the
+    # connection cleanup as a multiprocessing finalizer instead
+    util.Finalize(workerBib, workerBib.close, exitpriority=10)
+
+
+# Process a single shard of books in the current worker, recording every
+# book that could not be stored rather than letting it kill the worker. Books
+# are either IDs to read from the catalog directory or (ID, RDF data) pairs
+# from the streamed catalog
+def readShard(books):
+    results = {
+        "pid": os.getpid(),
+        "processed": 0,
+        "failed": []
+    }
+    for book in books:
+        rdfFile = None
+        if isinstance(book, tuple):
+            book, rdfData = book
+            rdfFile = BytesIO(rdfData)
+        try:
+            status = workerBib.readBib(book, rdfFile=rdfFile)
+        except (Exception, SystemExit) as err:
+            workerBib.logger.error("WORKER FAILED ON BOOK {}".format(book))
+            workerBib.logger.debug(err)
+            workerBib.recover()
+            results["failed"].append((book, repr(err)))
+            continue
+
+        if status is True:
+            results["processed"] += 1
+        else:
+            results["failed"].append((book, "not parsed"))
+
+    # Books still queued for a batch insert are stored before the shard is
+    # reported back
+    queued = [queuedBook[0] for queuedBook in workerBib.batch]
+    try:
+        failed = workerBib.flushBatch()
+    except Exception as err:
+        workerBib.logger.error("WORKER FAILED ON BATCH")
+        workerBib.logger.debug(err)
+        workerBib.recover()
+        failed = queued
+    results["processed"] -= len(failed)
+    results["failed"].extend((book, "not stored") for book in failed)
+
+    # Buffered ES documents are sent before the shard is reported back
+    if workerBib.esConnector is not None:
+        workerBib.esConnector.flush()
+
+    # The worker's timings go back with the shard and are merged into the
+    # coordinator's metrics, which are the ones that get reported
+    results["metrics"] = metrics.drain()
+    return results
+
+
+def deleteShard(bookIDs):
+    for bookID in bookIDs:
+        workerBib.deleteBib(bookID)
+    return len(bookIDs)
+
+
+class GutenbergPool:
+
+    shardSize = 50
+
+    def __init__(self, catalogDir, workers, test=False, cacheOnly=False):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.catalogDir = catalogDir
+        self.epubDir = catalogDir + "/cache/epub/"
+        self.workers = workers
+        self.test = test
+        self.cacheOnly = cacheOnly
+
+    def readDir(self):
+        self.logger.info("Parsing all Gutenberg books with {} workers".format(self.workers))
+        return self.readBooks(os.listdir(self.epubDir))
+
+    # Split the book IDs into fixed size shards and hand them out to the
+    # worker pool. Shards are handed out as workers free up, so a slow run
+    # of books in one shard does not hold up the others
+    def readBooks(self, bookIDs):
+        shards = self._createShards(bookIDs)
+        self.logger.debug("Created {} shards for {} books".format(len(shards), len(bookIDs)))
+
+        summary = self._createSummary()
+        with self._createPool() as pool:
+            for res in pool.imap_unordered(readShard, shards):
+                self._addResults(summary, res)
+            pool.close()
+            pool.join()
+
+        self._logSummary(summary)
+        return summary
+
+    # Shards are built from the catalog stream as it is read. Only a couple of
+    # shards per worker are allowed to be waiting at once so that the
+    # download does not run ahead of the workers and fill up memory
+    def readStream(self, records):
+        self.logger.info("Parsing Gutenberg books from catalog stream with {} workers".format(self.workers))
+
+        summary = self._createSummary()
+        pending = deque()
+        with self._createPool() as pool:
+            for shard in self._streamShards(records):
+                if len(pending) >= self.workers * 2:
+                    self._addResults(summary, pending.popleft().get())
+                pending.append(pool.apply_async(readShard, (shard,)))
+            while pending:
+                self._addResults(summary, pending.popleft().get())
+            pool.close()
+            pool.join()
+
+        self._logSummary(summary)
+        return summary
+
+    # Deletions are rare enough that they are made by a single worker
+    def deleteBooks(self, bookIDs):
+        if len(bookIDs) < 1:
+            return
+        with self._createPool(workers=1) as pool:
+            deleted = pool.apply(deleteShard, (bookIDs,))
+            pool.close()
+            pool.join()
+        self.logger.info("Deleted {} books".format(deleted))
+
+    # The combined catalog is streamed by the coordinator and each serialized
+    # ebook record is only parsed by the worker that stores it. Entries that
+    # are not books are left out before the shards are made
+    def readCatalog(self, catalogFile):
+        parser = gutenbergXML()
+        return self.readStream(parser.loadCatalogRecords(catalogFile))
+
+    def _createPool(self, workers=None):
+        return Pool(
+            workers or self.workers,
+            initializer=initWorker,
+            initargs=(self.catalogDir, self.test, self.cacheOnly)
+        )
+
+    def _createSummary(self):
+        return {
+            "processed": 0,
+            "failed": [],
+            "workers": defaultdict(int)
+        }
+
+    def _addResults(self, summary, res):
+        summary["processed"] += res["processed"]
+        summary["failed"].extend(res["failed"])
+        summary["workers"][res["pid"]] += res["processed"]
+        metrics.merge(res["metrics"])
+
+    def _streamShards(self, records):
+        shard = []
+        for record in records:
+            shard.append(record)
+            if len(shard) >= GutenbergPool.shardSize:
+                yield shard
+                shard = []
+        if len(shard) > 0:
+            yield shard
+
+    def _createShards(self, bookIDs):
+        size = GutenbergPool.shardSize
+        return [bookIDs[i:i + size] for i in range(0, len(bookIDs), size)]
+
+    def _logSummary(self, summary):
+        self.logger.info("Stored {} books, {} failures".format(
+            summary["processed"],
+            len(summary["failed"])
+        ))
+        for pid, count in summary["workers"].items():
+            self.logger.debug("Worker {} stored {} books".format(pid, count))
+        for bookID, reason in summary["failed"]:
+            self.logger.warning("FAILED BOOK {}: {}".format(bookID, reason))
@@ -0,0 +1,116 @@
+# Works are held as slotted records rather than nested dicts while they move
+# from the parser through the readers and into Postgres. Field names are the
+# column names in Postgres and the field names of the ES documents, so no
+# stage has to translate them. Catalogs of tens of thousands of works are
+# held in batches, and a slotted record takes a fraction of the memory of a
+# dict with the same fields
+class Record:
+
+    __slots__ = ()
+
+    # Fields that start as an empty list rather than None
+    listFields = ()
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            value = fields.pop(field, None)
+            if value is None and field in self.listFields:
+                value = []
+            setattr(self, field, value)
+        if len(fields) > 0:
+            raise TypeError("Unknown fields for {}: {}".format(
+                type(self).__name__,
+                ", ".join(sorted(fields))
+            ))
+
+    def toDict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(field, getattr(self, field)) for field in self.__slots__)
+        )
+
+
+class IdentifierRecord(Record):
+
+    __slots__ = ("type", "identifier")
+
+    # Stored in the identifiers table and sent to ES
+    columns = ("type", "identifier")
+
+
+class SubjectRecord(Record):
+
+    __slots__ = ("authority", "subject")
+
+    columns = ("authority", "subject")
+
+
+class EntityRecord(Record):
+
+    __slots__ = (
+        "name",
+        "sort_name",
+        "viaf",
+        "lcnaf",
+        "birth",
+        "death",
+        "wikipedia",
+        "aliases",
+        "role",
+        "gutenberg_id"
+    )
+
+    # The role belongs to the link to the work and the Gutenberg agent ID is
+    # not stored, so neither is a column of the entities table
+    columns = ("name", "sort_name", "viaf", "lcnaf", "birth", "death", "wikipedia", "aliases")
+
+
+# An epub of a Gutenberg book, as listed in its RDF file
+class ItemRecord(Record):
+
+    __slots__ = ("url", "size", "date_modified")
+
+
+class InstanceRecord(Record):
+
+    __slots__ = (
+        "title",
+        "pub_date",
+        "pub_place",
+        "publisher",
+        "extent",
+        "dimensions",
+        "summary",
+        "language",
+        "isbn",
+        "issn",
+        "oclc"
+    )
+
+    listFields = ("isbn", "issn", "oclc")
+
+
+# The ids are left as None until they have been loaded from MW, which is how
+# a record that MW could not match is told apart
+class WorkRecord(Record):
+
+    __slots__ = (
+        "title",
+        "rights_stmt",
+        "language",
+        "marc010",
+        "ids",
+        "instances",
+        "entities",
+        "subjects"
+    )
+
+    listFields = ("instances", "entities", "subjects")
@@ -0,0 +1,246 @@
+import time
+import logging
+import psycopg2
+
+from lib.gutenberg_elastic import GutenbergES
+
+# Held by a full rebuild for as long as it runs. Queued works are not claimed
+# in the meantime, so any change made during the rebuild is still queued when
+# the alias is moved and is then sent to the new index. A batch claimed just
+# before the rebuild started only reaches the old index, which is harmless
+# since the rebuild reads the same works from Postgres
+rebuildLock = 72018
+
+class GutenbergReindex:
+
+    # Works are claimed for a limited time in a short transaction of their
+    # own, so no row stays locked while the documents are sent and ingest can
+    # queue the same works again without waiting on ES. Claimed works are
+    # skipped by other reindex workers until the claim runs out, so a batch
+    # lost with its worker is picked up again rather than dropped
+    claimQueued = """
+        UPDATE reindex_queue SET claimed_until = NOW() + %s * INTERVAL '1 second'
+        WHERE work_id IN (
+            SELECT work_id FROM reindex_queue
+            WHERE claimed_until IS NULL OR claimed_until < NOW()
+            ORDER BY queued LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING work_id, deleted, queued, claimed_until
+    """
+
+    # Works only leave the queue once ES has accepted them, and only if
+    # ingest has not queued them again while the batch was being sent
+    removeSent = """
+        DELETE FROM reindex_queue q
+        USING UNNEST(%s::INT[], %s::TIMESTAMP[]) AS sent (work_id, queued)
+        WHERE q.work_id = sent.work_id AND q.queued = sent.queued
+    """
+
+    releaseClaimed = """
+        UPDATE reindex_queue SET claimed_until = NULL
+        WHERE work_id = ANY(%s) AND claimed_until = %s
+    """
+
+    queueWorks = """
+        INSERT INTO reindex_queue (work_id)
+        SELECT id FROM works
+        ON CONFLICT (work_id) DO UPDATE SET deleted = FALSE, queued = NOW()
+    """
+
+    getWorkIDs = """
+        SELECT id FROM works WHERE id > %s ORDER BY id LIMIT %s
+    """
+
+    def __init__(self, batchSize=None, pollInterval=None):
+        self.logger = logging.getLogger('guten_logs')
+
+        self.esConnector = GutenbergES()
+        # Queued works are claimed and their documents built over the same
+        # connection that ES documents are built from
+        self.db = self.esConnector.esWriter
+
+        config = self.db.config
+        self.batchSize = batchSize or config.getConfigInt("reindex", "batch_size", 500)
+        self.pollInterval = pollInterval or config.getConfigInt("reindex", "poll_interval", 30)
+        self.claimTimeout = config.getConfigInt("reindex", "claim_timeout", 600)
+
+    # Every stored work is queued, which rebuilds the index from Postgres
+    # without reading the RDF files again
+    def queueAll(self):
+        self.db.getCursor()
+        self.db.cursor.execute(GutenbergReindex.queueWorks)
+        queued = self.db.cursor.rowcount
+        self.db.commitOps()
+        self.logger.info("Queued {} works for reindexing".format(queued))
+        return queued
+
+    # Send every queued work to ES, returning the number sent. With follow
+    # set the queue is polled for new works until the process is stopped
+    def run(self, follow=False):
+        total = 0
+        while True:
+            try:
+                total += self.drain()
+            except Exception as err:
+                # A failed batch is left in the queue for the next poll
+                self.logger.error("REINDEX BATCH FAILED: {}".format(err))
+                self.recover()
+                if follow is not True:
+                    raise
+            if follow is not True:
+                return total
+            time.sleep(self.pollInterval)
+
+    def drain(self):
+        total = 0
+        while True:
+            sent = self.drainBatch()
+            if sent < 1:
+                break
+            total += sent
+            self.logger.info("Reindexed {} works".format(total))
+        return total
+
+    # If anything in the batch fails its claim is released so that the whole
+    # batch is tried again
+    def drainBatch(self):
+        self.db.getCursor()
+        self.db.cursor.execute("SELECT pg_try_advisory_xact_lock_shared(%s) AS free", [rebuildLock])
+        if self.db.cursor.fetchone()["free"] is not True:
+            self.logger.debug("Index rebuild running, leaving works queued")
+            self.db.commitOps()
+            return 0
+
+        self.db.cursor.execute(GutenbergReindex.claimQueued, [self.claimTimeout, self.batchSize])
+        rows = self.db.cursor.fetchall()
+        self.db.commitOps()
+        if len(rows) < 1:
+            return 0
+
+        workIDs = [row["work_id"] for row in rows]
+        claimedUntil = rows[0]["claimed_until"]
+        failures = self.esConnector.failures
+        try:
+            for row in rows:
+                if row["deleted"] is True:
+                    self.esConnector.dropES(row["work_id"])
+            self.esConnector.storeWorks([row["work_id"] for row in rows if row["deleted"] is not True])
+            self.esConnector.flush()
+            failed = self.esConnector.failures - failures
+            if failed > 0:
+                raise RuntimeError("{} of {} queued works were not indexed".format(failed, len(rows)))
+        except Exception:
+            self.logger.error("REINDEX FAILED FOR WORKS {} TO {}".format(min(workIDs), max(workIDs)))
+            self.db.rollbackOps()
+            self.release(workIDs, claimedUntil)
+            raise
+
+        # Works that were queued again while the batch was out are released
+        # so that their newer changes are sent with the next batch
+        self.db.getCursor()
+        self.db.cursor.execute(GutenbergReindex.removeSent, [workIDs, [row["queued"] for row in rows]])
+        self.db.cursor.execute(GutenbergReindex.releaseClaimed, [workIDs, claimedUntil])
+        self.db.commitOps()
+        return len(rows)
+
+    def release(self, workIDs, claimedUntil):
+        try:
+            self.db.getCursor()
+            self.db.cursor.execute(GutenbergReindex.releaseClaimed, [workIDs, claimedUntil])
+            self.db.commitOps()
+        except psycopg2.Error as err:
+            # The works are still queued and are sent again once their claim
+            # has run out
+            self.logger.warning("Claim on works {} to {} held until {}".format(min(workIDs), max(workIDs), claimedUntil))
+            self.logger.debug(err)
+
+    # Anything that failed outside of a batch's own rollback, such as the
+    # claim itself, would otherwise leave the connection in an aborted
+    # transaction that every later poll fails on. A connection that has been
+    # lost is replaced
+    def recover(self):
+        self.esConnector.buffer = []
+        self.esConnector.bufferBytes = 0
+        if self.db.conn.closed == 0:
+            try:
+                self.db.rollbackOps()
+                return
+            except psycopg2.Error as err:
+                self.logger.debug(err)
+
+        self.logger.warning("Database connection lost, reconnecting")
+        try:
+            self.esConnector = GutenbergES()
+        except Exception as err:
+            # Left for the next poll to try again
+            self.logger.error("COULD NOT RECONNECT: {}".format(err))
+            return
+        self.db = self.esConnector.esWriter
+
+    # Load every stored work into a new index with the bulk API and then move
+    # the alias over to it. Searches keep using the current index until the
+    # new one is complete, and a failed rebuild leaves it in place
+    def rebuild(self):
+        self.db.getCursor()
+        self.db.cursor.execute("SELECT pg_advisory_lock(%s)", [rebuildLock])
+        self.db.commitOps()
+
+        bulk = self.esConnector.bulk
+        indexName = self.esConnector.createIndex()
+        self.esConnector.targetIndex = indexName
+        self.esConnector.bulk = True
+        failures = self.esConnector.failures
+        try:
+            total = 0
+            lastID = 0
+            while True:
+                self.db.getCursor()
+                self.db.cursor.execute(GutenbergReindex.getWorkIDs, [lastID, self.batchSize])
+                workIDs = [row["id"] for row in self.db.cursor.fetchall()]
+                if len(workIDs) < 1:
+                    break
+                self.esConnector.storeWorks(workIDs)
+                self.db.commitOps()
+                lastID = workIDs[-1]
+                total += len(workIDs)
+                self.logger.info("Loaded {} works into {}".format(total, indexName))
+
+            self.esConnector.flush()
+            failed = self.esConnector.failures - failures
+            if failed > 0:
+                raise RuntimeError("{} of {} works were not loaded into {}".format(failed, total, indexName))
+
+            self.esConnector.finishIndex(indexName)
+            self.esConnector.swapAlias(indexName)
+        except Exception:
+            self.logger.error("REBUILD OF {} FAILED, ALIAS NOT MOVED".format(indexName))
+            self.db.rollbackOps()
+            self.esConnector.buffer = []
+            self.esConnector.bufferBytes = 0
+            # Before ES 6.4 the old index is deleted before the alias is moved,
+            # so if that failed the new index is all that is left to search
+            if self.esConnector.hasLiveIndex() is True:
+                self.esConnector.dropIndex(indexName)
+            else:
+                self.logger.error("KEEPING {}, NO OTHER INDEX IS LEFT FOR THE ALIAS".format(indexName))
+            raise
+        finally:
+            self.esConnector.targetIndex = None
+            self.esConnector.bulk = bulk
+            self.db.getCursor()
+            self.db.cursor.execute("SELECT pg_advisory_unlock(%s)", [rebuildLock])
+            self.db.commitOps()
+
+        self.esConnector.removeOldIndexes(indexName)
+        return total
+
+    def getQueueSize(self):
+        self.db.getCursor()
+        self.db.cursor.execute("SELECT COUNT(*) AS queued FROM reindex_queue")
+        queued = self.db.cursor.fetchone()["queued"]
+        self.db.commitOps()
+        return queued
+
+    def close(self):
+        self.esConnector.closeConn()
@@ -1,86 +1,331 @@
 import os
+import json
 import psycopg2
-import requests
+from psycopg2.extras import execute_values
 import uuid
 import re
 import logging
 from itertools import repeat
 from collections import defaultdict
 
+from helpers.cache import LookupCache
+from helpers.metrics import metrics
 from helpers.postgres import postgresManager
+from lib.gutenberg_records import IdentifierRecord, SubjectRecord, EntityRecord
 
 class GutenbergDB(postgresManager):
 
-    epubStore = "files/epubs/"
-
     def __init__(self, **kwargs):
-        super(GutenbergDB, self).__init__()
+        super(GutenbergDB, self).__init__(
+            test=kwargs.get("test", False),
+            dsn=kwargs.get("dsn", None)
+        )
         self.logger = logging.getLogger('guten_logs')
 
+        # Items created for the work being stored, as (item ID, epub) pairs,
+        # for their epubs to be fetched once the work is committed
+        self.storedItems = []
+
+        # Identifiers, subjects and entity control numbers repeat across
+        # works so their row IDs are kept in memory. Entries found or created
+        # in the open transaction are held back until it is committed, so a
+        # rollback can never leave an ID in the cache that does not exist
+        cacheSize = kwargs.get("cacheSize", 10000)
+        self.lookupCaches = {
+            "identifier": LookupCache(cacheSize),
+            "subject": LookupCache(cacheSize),
+            "entity": LookupCache(cacheSize)
+        }
+        self.pendingCache = []
+
+        # Changed works can be recorded in the reindex queue, in the same
+        # transaction as the change itself, for the reindex worker to send on
+        # to ES rather than being indexed during ingest
+        self.queueReindex = kwargs.get("queueReindex", False)
+
         self.getCursor()
+        if kwargs.get("warmCache", False) is True:
+            self.warmCache(cacheSize)
+
+    @metrics.timed("db.commit")
+    def commitOps(self):
+        super(GutenbergDB, self).commitOps()
+        for cacheName, key, value in self.pendingCache:
+            self.lookupCaches[cacheName].put(key, value)
+        self.pendingCache = []
+
+    def rollbackOps(self):
+        super(GutenbergDB, self).rollbackOps()
+        self.pendingCache = []
+
+    def closeAll(self):
+        self.logger.info("Lookup caches: {}".format(json.dumps(self.getCacheStats())))
+        super(GutenbergDB, self).closeAll()
+
+    # Needed if rows are removed from outside this connection
+    def clearCache(self):
+        for cache in self.lookupCaches.values():
+            cache.clear()
+        self.pendingCache = []
+
+    def getCacheStats(self):
+        return dict(
+            (cacheName, cache.getStats()) for cacheName, cache in self.lookupCaches.items()
+        )
+
+    # Load the most recently created subjects and entity control numbers so
+    # that a new ingest starts with the values it is most likely to need
+    def warmCache(self, size):
+        self.cursor.execute(
+            "SELECT id, authority, subject FROM subjects ORDER BY id DESC LIMIT %s",
+            [size]
+        )
+        for row in reversed(self.cursor.fetchall()):
+            self.lookupCaches["subject"].put((row["authority"], row["subject"]), row["id"])
+
+        self.cursor.execute("""
+            SELECT id, viaf, lcnaf FROM entities
+            WHERE viaf IS NOT NULL OR lcnaf IS NOT NULL
+            ORDER BY id DESC LIMIT %s
+        """, [size])
+        for row in reversed(self.cursor.fetchall()):
+            for field in ["viaf", "lcnaf"]:
+                if row[field] is not None:
+                    self.lookupCaches["entity"].put((field, row[field]), row["id"])
+        self.conn.commit()
+
+    def _cacheLookup(self, cacheName, key):
+        return self.lookupCaches[cacheName].get(key)
+
+    def _cacheWrite(self, cacheName, key, value):
+        self.pendingCache.append((cacheName, key, value))
 
     #TODO
     # 1) Add identifiers for instances and items
     # 2) Update records if they've changed (important to handle relationships)
-    # 3) Generate checksum for epubs
-    # 4) Store epubs in s3
-    # 5) Add date_created and date_modified fields to all tables
-    def insert_record(self, metadata, epubs):
-        self.logger.info("Storing new Gutenberg File")
-        self.logger.debug(metadata)
+    # 3) Add date_created and date_modified fields to all tables
+    @metrics.timed("db.insert_record")
+    def insert_record(self, work, epubs):
+        res = self._insertWork(work, epubs)
+        self.commitOps()
+        return res
+
+    # This stores a batch of (work, epubs) pairs in a single transaction.
+    # Each work gets its own savepoint so that one bad record is rolled back
+    # on its own without losing the rest of the batch
+    @metrics.timed("db.insert_records")
+    def insert_records(self, records):
+        self.logger.debug("Storing batch of {} Gutenberg Files".format(len(records)))
+        results = []
+        for work, epubs in records:
+            self.cursor.execute("SAVEPOINT work_insert")
+            cacheMark = len(self.pendingCache)
+            try:
+                res = self._insertWork(work, epubs)
+            except Exception as err:
+                self.logger.error("Rolling back work {}".format(work.title))
+                self.logger.debug(err)
+                self.cursor.execute("ROLLBACK TO SAVEPOINT work_insert")
+                del self.pendingCache[cacheMark:]
+                res = {"status": "failed", "result": 1, "work": None, "items": []}
+            else:
+                self.cursor.execute("RELEASE SAVEPOINT work_insert")
+            results.append(res)
+
+        self.commitOps()
+        return results
+
+    @metrics.timed("db.insert_work")
+    def _insertWork(self, work, epubs):
+        self.logger.debug("Storing new Gutenberg File")
+        self.logger.debug(work)
+        self.storedItems = []
         status = "existing"
-        workID, newIDs = self._checkIDs("work", metadata["ids"])
+        workID, newIDs = self._checkIDs("work", work.ids)
         if workID is None:
             status = "new"
-            workID, status = self._createWork(metadata, newIDs)
-
-        editionIDs = self._createInstances(metadata["editions"], workID, epubs)
-
-        subjectIDs = self._createSubjects(metadata["subjects"], workID)
+            workID, status = self._createWork(work, newIDs)
+
+        editionIDs = self._createInstances(work.instances, workID, epubs)
+
+        subjectIDs = self._createSubjects(work.subjects, workID)
+
+        entityIDs = self._createEntities(work.entities, workID)
+
+        self._queueWorks([workID])
+
+        return {"status": status, "result": 0, "work": workID, "items": self.storedItems}
+
+    # This removes the items for a Gutenberg book that has been withdrawn. The
+    # Gutenberg instance is removed once it has no items left and the work is
+    # removed entirely if none of its instances have items. Returns the works
+    # that were removed and those that need to be reindexed
+    @metrics.timed("db.delete_record")
+    def deleteRecord(self, gutenbergID):
+        self.logger.info("Deleting Gutenberg book {}".format(gutenbergID))
+        self.cursor.execute("""
+            SELECT i.id, i.instance_id, n.work_id FROM items i
+            JOIN instances n ON n.id = i.instance_id
+            WHERE i.url LIKE %s
+        """, ["%/ebooks/{}.epub%".format(gutenbergID)])
+        rows = self.cursor.fetchall()
+
+        itemIDs = [row["id"] for row in rows]
+        instanceIDs = list(set(row["instance_id"] for row in rows))
+        workIDs = list(set(row["work_id"] for row in rows))
+        res = {"deleted": [], "updated": []}
+        if len(itemIDs) < 1:
+            self.logger.debug("No stored items for Gutenberg book {}".format(gutenbergID))
+            self.commitOps()
+            return res
+
+        self._deleteItems(itemIDs)
+
+        for instanceID in instanceIDs:
+            self.cursor.execute("SELECT id FROM items WHERE instance_id = %s", [instanceID])
+            if self.cursor.rowcount < 1:
+                self._deleteInstances([instanceID])
+
+        for workID in workIDs:
+            self.cursor.execute("""
+                SELECT i.id FROM items i
+                JOIN instances n ON n.id = i.instance_id
+                WHERE n.work_id = %s
+            """, [workID])
+            if self.cursor.rowcount > 0:
+                res["updated"].append(workID)
+                continue
+            self.cursor.execute("SELECT id FROM instances WHERE work_id = %s", [workID])
+            self._deleteInstances([row["id"] for row in self.cursor.fetchall()])
+            for linkTable in ["work_identifiers", "entity_works", "subject_works"]:
+                self.cursor.execute("DELETE FROM {} WHERE work_id = %s".format(linkTable), [workID])
+            self.cursor.execute("DELETE FROM works WHERE id = %s", [workID])
+            res["deleted"].append(workID)
 
-        entityIDs = self._createEntities(metadata["entities"], workID)
+        self._queueWorks(res["updated"])
+        self._queueWorks(res["deleted"], deleted=True)
 
+        # Identifier links were removed along with the records
+        self.commitOps()
+        self.lookupCaches["identifier"].clear()
+        return res
+
+    # The most recent download of each URL, which a new fetch of the same
+    # epub can be made conditional on
+    @metrics.timed("db.fetch_state")
+    def getFetchState(self, urls):
+        self.cursor.execute("""
+            SELECT DISTINCT ON (url) url, epub_path, checksum, etag, last_modified, date_modified
+            FROM items
+            WHERE url = ANY(%s) AND epub_path IS NOT NULL
+            ORDER BY url, id DESC
+        """, [list(set(urls))])
+        fetchState = dict((row["url"], row) for row in self.cursor.fetchall())
+        self.commitOps()
+        return fetchState
+
+    # Fetched epubs are recorded on their items in a single update, and the
+    # works they belong to are queued again so their documents pick up the
+    # new paths
+    @metrics.timed("db.record_fetches")
+    def recordFetches(self, fetches, workIDs):
+        fetched = [
+            (fetch["id"], fetch["epub_path"], fetch["checksum"], fetch["etag"], fetch["last_modified"])
+            for fetch in fetches if fetch["epub_path"] is not None
+        ]
+        if len(fetched) > 0:
+            execute_values(self.cursor, """
+                UPDATE items AS i
+                SET epub_path = v.epub_path, checksum = v.checksum, etag = v.etag,
+                    last_modified = v.last_modified
+                FROM (VALUES %s) AS v (id, epub_path, checksum, etag, last_modified)
+                WHERE i.id = v.id
+            """, fetched)
+            self._queueWorks(workIDs)
         self.commitOps()
 
-        return {"status": status, "result": 0, "work": workID}
-
+    # A work that is already queued is moved to the back of the queue and
+    # takes on the latest action
+    def _queueWorks(self, workIDs, deleted=False):
+        if self.queueReindex is not True or len(workIDs) < 1:
+            return
+        self.cursor.execute("""
+            INSERT INTO reindex_queue (work_id, deleted)
+            SELECT UNNEST(%s::INT[]), %s
+            ON CONFLICT (work_id) DO UPDATE SET deleted = EXCLUDED.deleted, queued = NOW()
+        """, [workIDs, deleted])
+
+    def _deleteItems(self, itemIDs):
+        for linkTable in ["item_identifiers", "entity_items"]:
+            self.cursor.execute("DELETE FROM {} WHERE item_id = ANY(%s)".format(linkTable), [itemIDs])
+        self.cursor.execute("DELETE FROM items WHERE id = ANY(%s)", [itemIDs])
+
+    def _deleteInstances(self, instanceIDs):
+        if len(instanceIDs) < 1:
+            return
+        self.cursor.execute("SELECT id FROM items WHERE instance_id = ANY(%s)", [instanceIDs])
+        itemIDs = [row["id"] for row in self.cursor.fetchall()]
+        if len(itemIDs) > 0:
+            self._deleteItems(itemIDs)
+        for linkTable in ["instance_identifiers", "entity_instances"]:
+            self.cursor.execute("DELETE FROM {} WHERE instance_id = ANY(%s)".format(linkTable), [instanceIDs])
+        self.cursor.execute("DELETE FROM instances WHERE id = ANY(%s)", [instanceIDs])
+
+    # Identifiers are looked up together and any that are not already
+    # attached to a record are all created with a single insert. The new
+    # identifiers are returned as (row ID, identifier) pairs
+    @metrics.timed("db.check_ids")
     def _checkIDs(self, table, ids):
-        idStmt = self.generateInsert("identifiers", ["type", "identifier"])
-        newIDs = []
+        existingIDs = {}
+        uncached = []
+        for iden in ids:
+            cachedID = self._cacheLookup("identifier", (table, iden.identifier))
+            if cachedID is not None:
+                existingIDs[iden.identifier] = cachedID
+            else:
+                uncached.append(iden.identifier)
+        foundIDs = self.getByIDs(uncached, table)
+        for identifier, foundID in foundIDs.items():
+            self._cacheWrite("identifier", (table, identifier), foundID)
+        existingIDs.update(foundIDs)
+
+        newRows = []
         tableID = None
         for iden in ids:
-            existingID = self.getByID(iden["id"], table)
-            if existingID is not None:
-                tableID = existingID
+            if iden.identifier in existingIDs:
+                tableID = existingIDs[iden.identifier]
             else:
-                newID = self.insertRow(idStmt, [iden["type"], iden["id"]])
-                newIDs.append(newID)
-        return tableID, newIDs
+                newRows.append([iden.type, iden.identifier])
+        newIDs = self.insertRows("identifiers", IdentifierRecord.columns, newRows)
+        return tableID, list(zip(newIDs, [row[1] for row in newRows]))
 
     def _relatedIDs(self, table, tableID, ids):
         linkTable = "{}_identifiers".format(table)
         linkID = "{}_id".format(table)
-        linkStmt = self.generateInsert(linkTable, [linkID, "identifier_id"])
-        newIDs = []
-        for iden in ids:
-            newID = self.insertRow(linkStmt, [tableID, iden])
-            newIDs.append(newID)
-        return newIDs
+        for idenID, identifier in ids:
+            self._cacheWrite("identifier", (table, identifier), tableID)
+        return self.insertRows(
+            linkTable,
+            [linkID, "identifier_id"],
+            [[tableID, idenID] for idenID, identifier in ids]
+        )
 
     # This matches entities in the database based off their names, lifespan and
     # control numbers. If a match is found, return the row ID of the entity
     #
     # TODO Also return the relationship number so we don't create duplicate
     # relationships
+    @metrics.timed("db.match_entity")
     def _matchEntity(self, entity):
         scores = defaultdict(int)
         for field in ["viaf", "lcnaf"]:
-            if entity[field] is not None:
-                entityID = self.checkForRow("entities", {field: entity[field]})
+            value = getattr(entity, field)
+            if value is not None:
+                entityID = self._lookupEntity(field, value)
                 if entityID is not None:
                     scores[entityID] += 1
         # Use jaro_winkler algorithim and lifespan to get better matches
-        entityRec = self.queryJaroWinkler("entities", "name", entity["name"], 0.8)
+        entityRec = self.queryJaroWinkler("entities", "name", entity.name, 0.8)
         if entityRec:
             scores[entityRec["id"]] += 1
             if self._matchLifespan(entity, entityRec) is True:
@@ -90,37 +335,45 @@ class GutenbergDB(postgresManager):
                 return ent
         return None
 
+    def _lookupEntity(self, field, value):
+        cacheKey = (field, str(value))
+        entityID = self._cacheLookup("entity", cacheKey)
+        if entityID is None:
+            entityID = self.checkForRow("entities", {field: value})
+            if entityID is not None:
+                self._cacheWrite("entity", cacheKey, entityID)
+        return entityID
+
     def _matchLifespan(self, entity, dbResult):
         # TODO Pass partial score if birth or death dates match?
         # Also handle None values for only one date? (Known to exist)
         try:
             if(
-                dbResult["birth"] == int(entity["birthdate"]) and
-                dbResult["death"] == int(entity["deathdate"])
+                dbResult["birth"] == int(entity.birth) and
+                dbResult["death"] == int(entity.death)
             ):
                 return True
         except TypeError:
             self.logger.debug("Lifespan dates include null value, skip")
-        except KeyError:
-            self.logger.debug("Record is missing birth/death dates")
         return False
 
-    def _createWork(self, metadata, newIDs):
+    @metrics.timed("db.create_work")
+    def _createWork(self, work, newIDs):
         # TODO
         # Generate namespaced UUID
-        workRec = self.queryJaroWinkler("works", "title", metadata["title"], 0.98)
+        workRec = self.queryJaroWinkler("works", "title", work.title, 0.98)
         if workRec:
             entityID = None
-            entMatches = list(filter(lambda x: x, map(self._matchEntity, metadata["entities"])))
+            entMatches = list(filter(lambda x: x, map(self._matchEntity, work.entities)))
             if len(entMatches) > 0:
                 return workRec["id"], "existing"
 
         workFields = ["uuid", "title", "rights_stmt", "language"]
         workValues = [
             uuid.uuid4().hex,
-            metadata["title"],
-            metadata["rights"],
-            metadata["language"]
+            work.title,
+            work.rights_stmt,
+            work.language
         ]
 
         worksStmt = self.generateInsert("works", workFields)
@@ -128,6 +381,7 @@ class GutenbergDB(postgresManager):
         linkedIDs = self._relatedIDs("work", workID, newIDs)
         return workID, "new"
 
+    @metrics.timed("db.create_instances")
     def _createInstances(self, editions, workID, epubs):
         # TODO
         # Check if edition exists based off general identifiers
@@ -148,28 +402,28 @@ class GutenbergDB(postgresManager):
         return editionIDs
 
     def _createInstance(self, edition, editionStmt, workID, epubs):
-        isbns = self._generateIdDict("isbn", edition["isbn"])
+        isbns = self._generateIdDict("isbn", edition.isbn)
         editionID, newISBNids = self._checkIDs("instance", isbns)
-        issns = self._generateIdDict("issn", edition["issn"])
+        issns = self._generateIdDict("issn", edition.issn)
         editionID, newISSNids = self._checkIDs("instance", issns)
-        oclcs = self._generateIdDict("oclc", edition["oclc"])
+        oclcs = self._generateIdDict("oclc", edition.oclc)
         editionID, newOCLCids = self._checkIDs("instance", oclcs)
 
         if editionID is None:
             editionID = self.checkForRowWithRel("instances", {
-                    "pub_date": edition["year"],
-                    "pub_place": edition["pubPlace"],
-                    "publisher": edition["publisher"]
+                    "pub_date": edition.pub_date,
+                    "pub_place": edition.pub_place,
+                    "publisher": edition.publisher
             }, "work", workID)
             if editionID is None:
                 editionValues = [
-                    edition["title"],
-                    edition["year"],
-                    edition["pubPlace"],
-                    edition["publisher"],
-                    edition["extent"],
-                    edition["notes"],
-                    edition["language"],
+                    edition.title,
+                    edition.pub_date,
+                    edition.pub_place,
+                    edition.publisher,
+                    edition.extent,
+                    edition.summary,
+                    edition.language,
                     workID
                 ]
                 editionID = self.insertRow(editionStmt, editionValues)
@@ -179,18 +433,18 @@ class GutenbergDB(postgresManager):
 
         # Add Gutenberg items
         if (
-            edition["publisher"] is not None and
-            'gutenberg' in edition["publisher"].lower()
+            edition.publisher is not None and
+            'gutenberg' in edition.publisher.lower()
         ):
             itemIDs = self._createItems(editionID, epubs)
 
         return editionID
 
     def _generateIdDict(self, idType, ids):
-        return [{"type": idType, "id": iden} for iden in ids]
+        return [IdentifierRecord(type=idType, identifier=iden) for iden in ids]
 
+    @metrics.timed("db.create_items")
     def _createItems(self, instanceID, items):
-        itemIDs = []
         itemFields = [
             "url",
             "epub_path",
@@ -200,148 +454,124 @@ class GutenbergDB(postgresManager):
             "access_policy",
             "instance_id"
         ]
-        itemStmt = self.generateInsert("items", itemFields)
-        itemIDs = list(map(self._createItem, items, repeat(itemStmt), repeat(instanceID)))
+        itemRows = list(map(self._createItem, items, repeat(instanceID)))
+        itemIDs = self.insertRows("items", itemFields, itemRows)
+        self.storedItems.extend(zip(itemIDs, items))
         return itemIDs
 
-    def _createItem(self, epub, itemStmt, instanceID):
+    def _createItem(self, epub, instanceID):
         self.logger.debug(epub)
-        itemValues = [
-            epub["url"],
-            self._retrieveEpub(epub["url"]),
+        # The epub path is filled in once the file has been fetched
+        return [
+            epub.url,
+            None,
             "gutenberg",
-            epub["updated"],
-            epub["size"],
+            epub.date_modified,
+            epub.size,
             1,
             instanceID
         ]
-        itemID = self.insertRow(itemStmt, itemValues)
-        return itemID
 
+    # Existing subjects are looked up in one query, then any new subjects and
+    # all of the links to the work are created with one insert each
+    @metrics.timed("db.create_subjects")
     def _createSubjects(self, subjects, workID):
-        subjectIDs = []
         # TODO Get authority URIs for all subjects
-        subjectFields = ["authority", "subject"]
         subjectRelFields = ["work_id", "subject_id", "weight"]
-        subjectStmt = self.generateInsert("subjects", subjectFields)
-        subjectRelStmt = self.generateInsert("subject_works", subjectRelFields)
 
-        subjectIDs = list(map(self._createSubject, subjects, repeat(subjectStmt), repeat(subjectRelStmt), repeat(workID)))
+        subjectKeys = [(subject.authority, subject.subject) for subject in subjects]
+        knownIDs = {}
+        for subjectKey in subjectKeys:
+            cachedID = self._cacheLookup("subject", subjectKey)
+            if cachedID is not None:
+                knownIDs[subjectKey] = cachedID
+        uncached = tuple(subjectKey for subjectKey in subjectKeys if subjectKey not in knownIDs)
+        if len(uncached) > 0:
+            self.cursor.execute("""
+                SELECT id, authority, subject FROM subjects
+                WHERE (authority, subject) IN %s
+            """, [uncached])
+            for row in self.cursor.fetchall():
+                subjectKey = (row["authority"], row["subject"])
+                knownIDs.setdefault(subjectKey, row["id"])
+                self._cacheWrite("subject", subjectKey, knownIDs[subjectKey])
+
+        newSubjects = []
+        for subjectKey in subjectKeys:
+            if subjectKey not in knownIDs and subjectKey not in newSubjects:
+                newSubjects.append(subjectKey)
+
+        # Another worker may have stored the same subject since it was looked
+        # up, in which case the existing row's id is returned
+        newIDs = self.insertRows(
+            "subjects",
+            SubjectRecord.columns,
+            newSubjects,
+            conflict="(authority, subject) DO UPDATE SET subject = EXCLUDED.subject"
+        )
+        knownIDs.update(zip(newSubjects, newIDs))
+        for subjectKey, subjectID in zip(newSubjects, newIDs):
+            self._cacheWrite("subject", subjectKey, subjectID)
+
+        subjectIDs = [knownIDs[subjectKey] for subjectKey in subjectKeys]
+        self.insertRows("subject_works", subjectRelFields, [
+            # This is the weight of the subject, will potentially be dynamic
+            [workID, subjectID, 1] for subjectID in dict.fromkeys(subjectIDs)
+        ], conflict="DO NOTHING")
         return subjectIDs
 
-    def _createSubject(self, subject, subjectStmt, subjectRelStmt, workID):
-        subjectID = self.checkForRow("subjects", subject)
-        if subjectID is None:
-            subjectValues = [
-                subject["source"],
-                subject["subject"]
-            ]
-            subjectID = self.insertRow(subjectStmt, subjectValues)
-        relValues = [
-            workID,
-            subjectID,
-            1 # This is the weight of the subject, will potentially be dynamic
-        ]
-        subjectRelID = self.insertRow(subjectRelStmt, relValues)
-        return subjectID
-
+    # Entities still have to be matched one at a time, but their links to the
+    # work are checked against the existing links in one query and then
+    # created together
+    @metrics.timed("db.create_entities")
     def _createEntities(self, entities, workID):
-        entityIDs = []
-        entityID = None
-        entityFields = [
-            "name",
-            "sort_name",
-            "viaf",
-            "lcnaf",
-            "birth",
-            "death",
-            "wikipedia",
-            "aliases"
-        ]
-        entityStmt = self.generateInsert("entities", entityFields)
+        entityStmt = self.generateInsert("entities", EntityRecord.columns)
         entityRelFields = ["work_id", "entity_id", "role"]
-        relStmt = self.generateInsert("entity_works", entityRelFields)
 
-        entityIDs = list(map(self._createEntity, entities, repeat(entityFields), repeat(entityStmt), repeat(relStmt), repeat(workID)))
+        entityIDs = list(map(self._createEntity, entities, repeat(entityStmt)))
+
+        self.cursor.execute(
+            "SELECT entity_id, role FROM entity_works WHERE work_id = %s",
+            [workID]
+        )
+        existingRels = set((row["entity_id"], row["role"]) for row in self.cursor.fetchall())
+        newRels = []
+        for entity, entityID in zip(entities, entityIDs):
+            rel = (entityID, entity.role)
+            if rel not in existingRels:
+                existingRels.add(rel)
+                newRels.append([workID, entityID, entity.role])
+        self.insertRows("entity_works", entityRelFields, newRels, conflict="DO NOTHING")
 
         return entityIDs
 
-    def _createEntity(self, entity, entityFields, entityStmt, relStmt, workID):
+    def _createEntity(self, entity, entityStmt):
         # Test for existing entity, see method for algorithim rules
         entityID = self._matchEntity(entity)
         if entityID is None:
-            entity = self._addMissingFields(entity, entityFields)
-            sort_name = entity["sort_name"]
-            if entity["sort_name"] is None:
-                sort_name = entity["name"]
-            entityValues = [
-                entity["name"],
-                sort_name,
-                entity["viaf"],
-                entity["lcnaf"],
-                entity["birthdate"],
-                entity["deathdate"],
-                entity["wikipedia"],
-                entity["aliases"]
-            ]
+            entityValues = [getattr(entity, column) for column in EntityRecord.columns]
+            if entity.sort_name is None:
+                entityValues[EntityRecord.columns.index("sort_name")] = entity.name
             entityID = self.insertRow(entityStmt, entityValues)
+            columns, values = ["viaf", "lcnaf"], [entity.viaf, entity.lcnaf]
         else:
             columns, values = self._generateUpdate(entity, "entities", entityID)
             if len(columns) > 0:
                 self.updateRow("entities", entityID, columns, values)
 
-        self._createEntityRel(workID, entityID, entity["role"], relStmt)
-
+        for column, value in zip(columns, values):
+            if column in ["viaf", "lcnaf"] and value is not None:
+                self._cacheWrite("entity", (column, str(value)), entityID)
 
         return entityID
 
-    def _createEntityRel(self, workID, entityID, role, relStmt):
-        relValues = [
-            workID,
-            entityID,
-            role
-        ]
-        entityRelID = self.checkForRow("entity_works", {
-            "work_id": workID,
-            "entity_id": entityID,
-            "role": role
-        })
-        if entityRelID is None:
-            entityRelID = self.insertRow(relStmt, relValues)
-
-    def _addMissingFields(self, record, fields):
-        for field in fields:
-            if field not in record:
-                record[field] = None
-        return record
-
     def _generateUpdate(self, new, table, recordID):
         old = self.getRow(table, recordID)
         columns = []
         values = []
-        skips = ["role", "gutenberg_id"]
-        for key, value in new.items():
-            if key in skips:
-                continue
-            if old[self.keyReplace(key)] is None and new[key] is not None:
-                columns.append(self.keyReplace(key))
+        for column in new.columns:
+            value = getattr(new, column)
+            if old[column] is None and value is not None:
+                columns.append(column)
                 values.append(value)
         return columns, values
-
-    # TODO
-    # 1) Generate Checksum
-    # 2) "Break" open and store resulting directory
-    # 3) Store resulting directory in s3
-    def _retrieveEpub(self, epub_url):
-        epub = requests.get(epub_url)
-        tmpFile = None
-        epubFile = re.search(r'[0-9]+.epub.(?:|no)images', epub_url).group(0)
-        if epub.status_code == 200:
-            self.logger.debug("Storing downloaded epub from " + epub_url)
-            tmpFile = GutenbergDB.epubStore + epubFile
-            opnFile = open(tmpFile, "wb")
-            opnFile.write(epub.content)
-            opnFile.close()
-        else:
-            self.logger.debug("Download Error! Status {}".format(epub.status_code))
-        return tmpFile
@@ -1,14 +1,43 @@
 import os
 import csv
 import logging
-from itertools import repeat
+from copy import deepcopy
 from lxml import etree
 
+from helpers.metrics import metrics
 from helpers.xml import xmlParser
+from lib.gutenberg_records import WorkRecord, InstanceRecord, EntityRecord, SubjectRecord, ItemRecord
+
+# The catalog lists some entries that are not books, such as deletion markers
+# and the placeholder with ID 0. Every reader of the catalog skips the same
+# entries by checking them here
+def isCatalogBook(bookID):
+    bookID = str(bookID)
+    return 'DELETE' not in bookID and bookID.isdigit() is True and int(bookID) != 0
+
+
+# The result of parsing one ebook record. A new one is built for every book,
+# so nothing read from one book can be carried over into the next
+class ParsedBook:
+
+    __slots__ = ("work", "items")
+
+    def __init__(self, work, items):
+        self.work = work
+        self.items = items
+
+    def __eq__(self, other):
+        if isinstance(other, ParsedBook) is False:
+            return NotImplemented
+        return self.work == other.work and self.items == other.items
+
+    def __repr__(self):
+        return "ParsedBook({!r}, {!r})".format(self.work, self.items)
+
 
 class gutenbergXML(xmlParser):
 
-    def __init__(self):
+    def __init__(self, singlePass=True):
         super(gutenbergXML, self).__init__()
 
         self.logger = logging.getLogger('guten_logs')
@@ -51,162 +80,261 @@ class gutenbergXML(xmlParser):
             ("pgterms", "alias")
         ]
 
+        # The entity fields are stored under the names of their columns
+        self.entityColumns = {
+            "birthdate": "birth",
+            "deathdate": "death",
+            "name": "name",
+            "alias": "aliases"
+        }
+
         self.relCodes = self._loadLCRels()
 
-        self.metadata = {
-            "entities": [],
-            "subjects": [],
-            "language": None
-        }
-        self.ebookURLs = []
+        # The single pass extractor walks the children of the ebook element
+        # once and uses this table to decide what to do with each of them
+        self.singlePass = singlePass
+        self.tagHandlers = self._createTagHandlers()
+        self.entityOrder = ["creator"] + list(self.relCodes.keys())
 
+    @metrics.timed("parse")
     def load(self, rdfFile):
         self.logger.debug("Loading data from {}".format(rdfFile))
-        self.parse(rdfFile)
-        self.loadRecord("pgterms", "ebook") # This resets the XML file context
+        root = self.parse(rdfFile)
+        ebook = self.findRecord(root, "pgterms", "ebook")
 
         self.logger.debug("Creating record from {}".format(rdfFile))
-        self._getMetadata()
-        self.loadRecord("pgterms", "ebook")
+        if self.singlePass is True:
+            return self._getMetadataSinglePass(ebook)
 
+        work = self._getMetadata(ebook)
         self.logger.debug("Downloading Ebooks from Gutenberg for {}".format(rdfFile))
-        self._getEbooks()
-        self.loadRecord("pgterms", "ebook")
+        return ParsedBook(work, self._getEbooks(ebook))
+
+    # This reads the combined Gutenberg RDF catalog one ebook at a time,
+    # yielding the book ID, its parsed record and the serialized ebook
+    # element. Only the ebook being read is held in memory
+    def loadCatalog(self, catalogFile):
+        for bookID, ebook in self._iterCatalog(catalogFile):
+            with metrics.timer("parse"):
+                book = self._getMetadataSinglePass(ebook)
+            yield bookID, book, etree.tostring(ebook)
+
+    # The same as loadCatalog, for readers that parse each serialized record
+    # again somewhere else and so have no use for the parsed book
+    def loadCatalogRecords(self, catalogFile):
+        for bookID, ebook in self._iterCatalog(catalogFile):
+            yield bookID, etree.tostring(ebook)
+
+    # Entries that are not books are skipped here, before anything is read
+    # from them. The catalog only describes an agent in full the first time
+    # it appears, so a copy of each agent is kept to fill in later references
+    def _iterCatalog(self, catalogFile):
+        self.logger.debug("Streaming records from {}".format(catalogFile))
+        aboutAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+        agents = {}
+        for ebook in self.iterRecords(catalogFile, "pgterms", "ebook"):
+            bookID = ebook.get(aboutAttrib, "").split("/")[-1]
+            if isCatalogBook(bookID) is False:
+                continue
+            self._resolveAgents(ebook, agents)
+            yield bookID, ebook
+
+    # Records the agents given in full by an ebook and copies the ones seen
+    # earlier into the entities that only reference them
+    def _resolveAgents(self, ebook, agents):
+        aboutAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+        resourceAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
+        agentTag = self._formatTag("pgterms", "agent")
+        for child in ebook.iterchildren():
+            handler = self.tagHandlers.get(child.tag)
+            if handler is None or handler[0] != "entity":
+                continue
+            agent = child.find(agentTag)
+            if agent is not None:
+                agents[agent.get(aboutAttrib)] = deepcopy(agent)
+                continue
+            agent = agents.get(child.get(resourceAttrib))
+            if agent is not None:
+                child.append(deepcopy(agent))
+
+    # Maps the namespaced tag of each child of the ebook element that we use
+    # to a handler and the key it is stored under
+    def _createTagHandlers(self):
+        handlers = {}
+        for ns, field in self.fields:
+            handlers[self._formatTag(ns, field)] = ("field", field)
+        handlers[self._formatTag("dcterms", "creator")] = ("entity", "creator")
+        for code in self.relCodes.keys():
+            handlers[self._formatTag("marcrel", code)] = ("entity", code)
+        handlers[self._formatTag("dcterms", "subject")] = ("subject", None)
+        handlers[self._formatTag("dcterms", "hasFormat")] = ("ebook", None)
+        return handlers
+
+    # This produces the same metadata as _getMetadata and _getEbooks with a
+    # single iteration over the ebook element rather than one descendant
+    # search per field and relator code. As with those searches only the
+    # first element for each field and entity role is used
+    def _getMetadataSinglePass(self, ebook):
+        fields = dict((field, None) for ns, field in self.fields)
+        seenFields = set()
+        entities = {}
+        subjects = []
+        formats = []
+
+        for child in ebook.iterchildren():
+            handler = self.tagHandlers.get(child.tag)
+            if handler is None:
+                continue
+            handlerType, key = handler
+            if handlerType == "field":
+                if key not in seenFields:
+                    seenFields.add(key)
+                    fields[key] = child
+            elif handlerType == "entity":
+                if key not in entities:
+                    entities[key] = child
+            elif handlerType == "subject":
+                subjects.append(child)
+            else:
+                formats.append(child)
+
+        work = self._createWork(self._getValues(fields.items()))
 
-        return self.metadata, self.ebookURLs
+        # Entities are stored in the same order as the per-code searches
+        for key in self.entityOrder:
+            if key in entities:
+                self._storeEntity(work, key, entities[key])
+
+        work.subjects = list(map(self._loadSubject, subjects))
+        items = list(filter(lambda x: x, map(self._loadEbook, formats)))
+        return ParsedBook(work, items)
 
     # This loads metadata from the Gutenberg RDF files, inluding repeating
     # fields such as subjects and entities (authors, editors, etc)
-    def _getMetadata(self):
-
+    def _getMetadata(self, ebook):
         self.logger.debug("Storing basic fields and edition data")
-        fieldData = self.getFields(self.fields)
-        self._storeFields(fieldData, self.metadata)
-        self._createEditions()
+        fieldData = self.getFields(ebook, self.fields)
+        work = self._createWork(self._getValues(fieldData))
 
         self.logger.debug("Storing creator and other contributors")
-        self._createEntityRecord(("dcterms", "creator"))
+        self._createEntityRecord(work, ebook, ("dcterms", "creator"))
         # This scans the RDF file for all possible marcrel codes
         # and stores the resulting entity records
         for key, value in self.relCodes.items():
-            self.loadRecord("pgterms", "ebook")
-            self._createEntityRecord(("marcrel", key))
+            self._createEntityRecord(work, ebook, ("marcrel", key))
 
-        self.loadRecord("pgterms", "ebook")
         self.logger.debug("Storing subjects from Gutenberg record")
-        self._getSubjects()
+        work.subjects = self._getSubjects(ebook)
+        return work
 
-    def _storeFields(self, fields, obj):
-        list(map(self._storeField, fields, repeat(obj)))
+    # Returns the text of each (field, element) pair by field name
+    def _getValues(self, fields):
+        return dict(
+            (key, value.text if value is not None else None) for key, value in fields
+        )
 
-    def _storeField(self, field, obj):
-        key, value = field
-        if value is not None:
-            value = value.text
-        obj[key] = value
+    def _createWork(self, values):
+        work = WorkRecord(
+            title=values["title"],
+            rights_stmt=values["rights"],
+            marc010=values["marc010"]
+        )
+        work.instances.append(self._createEdition(work, values))
+        return work
 
     # This loads the ePub URLs and descriptive data. It is important to grab
     # The size/date modified since we will check those to see if we need to
     # update the files on our end
-    def _getEbooks(self):
-        formats = self.getRepeatingField("dcterms", "hasFormat")
-        urls = list(filter(lambda x: x, map(self._loadEbook, formats)))
-        self.ebookURLs = urls
+    def _getEbooks(self, ebook):
+        formats = self.getRepeatingField(ebook, "dcterms", "hasFormat")
+        return list(filter(lambda x: x, map(self._loadEbook, formats)))
 
     def _loadEbook(self, format):
-        self.current = format
-        fileTag, file = self.getField(("pgterms", "file"))
+        fileTag, file = self.getField(format, ("pgterms", "file"))
         urlAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
         url = self.getAttrib(file, urlAttrib)
         if '.epub' in url:
-            updatedTag, updated = self.getField(("dcterms", "modified"))
-            sizeTag, size = self.getField(("dcterms", "extent"))
-            epub = {
-                "url": url,
-                "size": size.text,
-                "updated": updated.text
-            }
-            return epub
+            updatedTag, updated = self.getField(format, ("dcterms", "modified"))
+            sizeTag, size = self.getField(format, ("dcterms", "extent"))
+            return ItemRecord(
+                url=url,
+                size=size.text,
+                date_modified=updated.text
+            )
         return False
 
     # Entity records all share fields in the RDF files, so this grabs all
-    # available data from the record and stashes it in a list of dicts
-    def _createEntityRecord(self, tags):
-        entityDict = {
-            "viaf": None,
-            "lcnaf": None,
-            "sort_name": None,
-            "wikipedia": None
-        }
-        entityTag, entity = self.getField(tags)
+    # available data from the record and adds it to the work's entities
+    def _createEntityRecord(self, work, ebook, tags):
+        entityTag, entity = self.getField(ebook, tags)
         if entity is None:
             return False
 
+        self._storeEntity(work, entityTag, entity)
+
+    def _storeEntity(self, work, entityTag, entity):
         rel = entityTag
         self.logger.debug("Creating entity for with relationship {}".format(rel))
         if entityTag in self.relCodes:
             rel = self.relCodes[entityTag]
-        entityDict["role"] = rel
-        self.current = entity
+        entityRecord = EntityRecord(role=rel)
 
-        agentTag, agent = self.getField(("pgterms", "agent"))
+        agentTag, agent = self.getField(entity, ("pgterms", "agent"))
+        if agent is None:
+            # References to agents that were not described earlier in the
+            # catalog cannot be resolved, so the entity is left off the work
+            resourceAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
+            resource = self.getAttrib(entity, resourceAttrib)
+            if resource is not None:
+                self.logger.warning("Unresolved agent {} for {} entity".format(resource, rel))
+                metrics.count("parse.unresolved_agents")
+            else:
+                self.logger.debug("No agent record for {} entity".format(rel))
+            return False
 
         aboutAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
-        gutenbergAgentID = self.getAttrib(agent, aboutAttrib)
-        entityDict["gutenberg_id"] = gutenbergAgentID
+        entityRecord.gutenberg_id = self.getAttrib(agent, aboutAttrib)
 
         # TODO Handle Multiple aliases
-        entityData = self.getFields(self.entity_fields)
-        self._storeFields(entityData, entityDict)
-        wikipediaTag, wikipedia = self.getField(("pgterms", "webpage"))
+        entityData = self._getValues(self.getFields(entity, self.entity_fields))
+        for field, value in entityData.items():
+            setattr(entityRecord, self.entityColumns[field], value)
+        wikipediaTag, wikipedia = self.getField(entity, ("pgterms", "webpage"))
         if wikipedia is not None:
             pageAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
             pageURL = self.getAttrib(wikipedia, pageAttrib)
             self.logger.debug("Setting wikipedia link {} for entity".format(pageURL))
-            entityDict["wikipedia"] = pageURL
-        self.metadata["entities"].append(entityDict)
+            entityRecord.wikipedia = pageURL
+        work.entities.append(entityRecord)
 
     # This does a similar action with subjects
-    def _getSubjects(self):
-        subjects = self.getRepeatingField("dcterms", "subject")
-        self.metadata["subjects"] = list(map(self._loadSubject, subjects))
+    def _getSubjects(self, ebook):
+        subjects = self.getRepeatingField(ebook, "dcterms", "subject")
+        return list(map(self._loadSubject, subjects))
 
-    # This parses the RDF subject areas and stores them in our metadata dict
+    # This parses the RDF subject areas into subject records
     def _loadSubject(self, subject):
-        self.current = subject
-        memberTag, member = self.getField(("dcam", "memberOf"))
+        memberTag, member = self.getField(subject, ("dcam", "memberOf"))
         memberAttrib = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
         subjectMember = self.getAttrib(member, memberAttrib)
-        subjectTag, subjectText = self.getField(("rdf", "value"))
+        subjectTag, subjectText = self.getField(subject, ("rdf", "value"))
         self.logger.debug("Storing subject {}".format(subjectText.text))
-        return {
-            "source": subjectMember,
-            "subject": subjectText.text
-        }
+        return SubjectRecord(
+            authority=subjectMember,
+            subject=subjectText.text
+        )
 
-    # This creates a stub editions/instances section of the metadata dict
-    # It populates the list with a single edition -- the Gutenberg edition that
-    # forms the basis of this record
-    def _createEditions(self):
-        self.metadata["editions"] = []
-        gutenbergEdition = {
-            "pubPlace": "",
-            "publisher": self.metadata["publisher"],
-            "year": self.metadata["issued"][:4],
-            "title": self.metadata["title"],
-            "extent": None,
-            "dimensions": None,
-            "notes": None,
-            "language": self.metadata["language"],
-            "isbn": [],
-            "issn": [],
-            "oclc": []
-        }
-        # Having stored this information on the edition, we pop these fields
-        # off of the main work record (part of FRBR-ization)
-        self.metadata["editions"].append(gutenbergEdition)
-        self.metadata.pop("publisher", None)
-        self.metadata.pop("issued", None)
+    # This creates the Gutenberg edition that forms the basis of this record.
+    # The publisher and issued date are only stored on the edition, not the
+    # work (part of FRBR-ization)
+    def _createEdition(self, work, values):
+        return InstanceRecord(
+            title=work.title,
+            pub_date=values["issued"][:4],
+            pub_place="",
+            publisher=values["publisher"],
+            language=work.language
+        )
 
     # This is a basic helper function that loads a conversion list for the MARC
     # rel codes grabbed from LC (http://id.loc.gov/vocabulary/relators.html)
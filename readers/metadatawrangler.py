@@ -3,16 +3,21 @@ import logging
 import re
 from lxml import etree
 
+from helpers.metrics import metrics
 from helpers.xml import xmlParser
+from lib.gutenberg_records import IdentifierRecord
 
 class MetadataWranglerReader(xmlParser):
 
     mwURL = "https://metadata.librarysimplified.org/lookup?urn=http://www.gutenberg.org/ebooks/"
 
-    def __init__(self):
+    def __init__(self, http=requests):
         super(MetadataWranglerReader, self).__init__()
         self.logger = logging.getLogger('guten_logs')
 
+        # Anything with a requests style get method, such as the response cache
+        self.http = http
+
         self.loadNamespaces([
             ("simplified", "http://librarysimplified.org/terms/"),
             ("schema", "http://schema.org/"),
@@ -20,54 +25,63 @@ class MetadataWranglerReader(xmlParser):
             (None, "http://www.w3.org/2005/Atom")
         ])
 
-    def getMWData(self, metadata, gutenbergID):
-        mwBookURL = "{}{}".format(MetadataWranglerReader.mwURL, gutenbergID)
-        mwData = requests.get(mwBookURL)
+    def getMWData(self, work, gutenbergID):
+        with metrics.timer("mw.lookup"):
+            mwData = self.http.get(self.lookupURL(gutenbergID))
+        return self.parseMWData(work, mwData, gutenbergID)
+
+    def lookupURL(self, gutenbergID):
+        return "{}{}".format(MetadataWranglerReader.mwURL, gutenbergID)
+
+    # This is split from the request so that the lookup can also be made by
+    # the async enrichment stage and handed back here to be parsed. The
+    # response is only read through the local entry element, so one reader
+    # can parse responses for several works at once
+    @metrics.timed("mw.parse")
+    def parseMWData(self, work, mwData, gutenbergID):
         if mwData.status_code == 200:
-            self.parseString(mwData.content)
-            self.loadRecord(None, "entry")
-            if self.current is None:
-                self.logger.info("No MW metadata avaiable for {}".format(gutenbergID))
-                return metadata
+            root = self.parseString(mwData.content)
+            entry = self.findRecord(root, None, "entry")
+            if entry is None:
+                self.logger.debug("No MW metadata avaiable for {}".format(gutenbergID))
+                metrics.count("mw.no_match")
+                return work
 
             # Get additional author data
-            metadata = self._parseAuthor(metadata)
-            self.loadRecord(None, "entry")
-            metadata = self._loadIDs(metadata)
+            work = self._parseAuthor(work, entry)
+            work = self._loadIDs(work, entry)
 
             # Add language
-            langTag, language = self.getField(("dcterms", "language"))
+            langTag, language = self.getField(entry, ("dcterms", "language"))
             if language is not None:
-                metadata["language"] = language.text
+                work.language = language.text
             else:
-                metadata["language"] = "en"
+                work.language = "en"
 
-        return metadata
+        return work
 
-    def _parseAuthor(self, metadata):
+    def _parseAuthor(self, work, entry):
         authorFields = {
             "sort_name": None,
             "viaf": None,
             "lcnaf": None,
         }
-        authorTag, author = self.getField((None, "author"))
+        authorTag, author = self.getField(entry, (None, "author"))
         if author is None:
-            return metadata
-
-        self.current = author
+            return work
 
-        sortTag, sort = self.getField(("simplified", "sort_name"))
+        sortTag, sort = self.getField(author, ("simplified", "sort_name"))
         if sort is not None:
             sort_name = sort.text.strip("., ")
             authorFields["sort_name"] = sort_name
 
-        nameTag, name = self.getField((None, "name"))
+        nameTag, name = self.getField(author, (None, "name"))
         if name.text is not None:
             nameText = name.text.strip("., ")
         else:
             nameText = sort_name
 
-        authorIDs = self.getRepeatingField("schema", "sameas")
+        authorIDs = self.getRepeatingField(author, "schema", "sameas")
         for authorID in authorIDs:
             idString = authorID.text
             if 'viaf' in idString:
@@ -75,24 +89,24 @@ class MetadataWranglerReader(xmlParser):
             elif 'authorities/names' in idString:
                 authorFields["lcnaf"] = self._getControlNumber(idString)
 
-        for i, entity in enumerate(metadata["entities"]):
-            if entity["name"] in [sort_name, name]:
-                enhancedEntity = {**entity, **authorFields}
-                metadata["entities"][i] = enhancedEntity
+        for entity in work.entities:
+            if entity.name in [sort_name, name]:
+                for field, value in authorFields.items():
+                    setattr(entity, field, value)
 
-        return metadata
+        return work
 
-    def _loadIDs(self, metadata):
-        ids = self.getRepeatingField(None, "id")
-        metadata["ids"] = []
+    def _loadIDs(self, work, entry):
+        ids = self.getRepeatingField(entry, None, "id")
+        work.ids = []
         for iden in ids:
-            if len([x for x in metadata["ids"] if x["id"] == iden]) > 0:
+            if len([x for x in work.ids if x.identifier == iden.text]) > 0:
                 continue
-            metadata["ids"].append({
-                "type": "gutenberg",
-                "id": iden.text
-            })
-        return metadata
+            work.ids.append(IdentifierRecord(
+                type="gutenberg",
+                identifier=iden.text
+            ))
+        return work
 
     def _getControlNumber(self, url):
         ctrlNo = re.search(r"([a-z]*[0-9]+)$", url)
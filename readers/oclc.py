@@ -3,11 +3,14 @@ import requests
 import marcalyx
 import re
 import sys
+from itertools import repeat
 from Levenshtein import distance, jaro_winkler
 from lxml import etree
 
 from helpers.config import GutenbergConfig
+from helpers.metrics import metrics
 from helpers.xml import xmlParser
+from lib.gutenberg_records import IdentifierRecord, InstanceRecord, EntityRecord
 
 class oclcReader(xmlParser):
 
@@ -18,30 +21,42 @@ class oclcReader(xmlParser):
     oclcClassify = "http://classify.oclc.org/classify2/Classify?oclc="
     oclcCatalog = "http://www.worldcat.org/webservices/catalog/content/"
 
-    def __init__(self):
+    # Classify responses are read with their own namespace rather than by
+    # changing the reader's, which stays the same once it is set up
+    classifyNS = {None: "http://classify.oclc.org"}
+
+    def __init__(self, http=requests):
         super(oclcReader, self).__init__()
         self.logger = logging.getLogger('guten_logs')
 
+        # Anything with a requests style get method, such as the response cache
+        self.http = http
+
         self.loadNamespaces([
             (None, "http://www.loc.gov/MARC21/slim")
         ])
 
-        self.bookID = None
-
-    def getOCLCData(self, metadata, bookID):
-
-        self.bookID = bookID
+    def getOCLCData(self, work, bookID):
+        oclcData = self.fetchOCLCData(work, bookID)
+        if oclcData is False:
+            return False
+        self.applyOCLCData(work, oclcData)
 
-        query = self._createQuery(metadata)
+    # This makes all of the OCLC requests for a work, one after another, and
+    # returns the parsed data for applyOCLCData
+    def fetchOCLCData(self, work, bookID):
+        query = self._createQuery(work)
         self.logger.debug("Search Query: {}".format(query))
-        oclcResp = requests.get(query)
-        # TODO Handle error codes in a real way here
-        oclcResp.raise_for_status
+        with metrics.timer("oclc.search"):
+            oclcResp = self.http.get(query)
+        if self._checkResponse(oclcResp) is False:
+            return False
 
         # Load returned MARC records
-        oclc = self._getGutenbergOCLC(oclcResp)
+        oclc = self._getGutenbergOCLC(oclcResp, bookID)
         self.logger.debug(oclc)
         if oclc is False:
+            metrics.count("oclc.no_match")
             return False
         workID, workTitle, editionOCLCs, workAuthors = self._getEditions(oclc)
         self.logger.debug("Loaded OCLC records for OWI {}".format(workID))
@@ -49,18 +64,60 @@ class oclcReader(xmlParser):
             return False
         self.logger.debug("Got Edition data from OCLC")
         editions = self._getEditionMARC(editionOCLCs)
-        metadata["entities"].extend(workAuthors)
-        self._enhanceRecord(metadata, workID, workTitle, editions)
+        return workID, workTitle, editions, workAuthors
 
-    def _enhanceRecord(self, metadata, workID, workTitle, marcEditions):
+    # The async version of fetchOCLCData. The search and Classify requests
+    # depend on each other, but all Classify pages and then all catalog
+    # records are requested at once through the fetcher
+    async def fetchOCLCDataAsync(self, work, bookID, fetcher):
+        query = self._createQuery(work)
+        self.logger.debug("Search Query: {}".format(query))
+        with metrics.timer("oclc.search"):
+            oclcResp = await fetcher.get(query)
+        if self._checkResponse(oclcResp) is False:
+            return False
+
+        oclc = self._getGutenbergOCLC(oclcResp, bookID)
+        if oclc is False:
+            metrics.count("oclc.no_match")
+            return False
+
+        with metrics.timer("oclc.classify"):
+            classifyResp = await fetcher.get(self._classifyURL(oclc))
+        if self._checkResponse(classifyResp) is False:
+            return False
+        workID, workTitle, editionOCLCs, workAuthors, pages = self._parseClassify(classifyResp)
+        if workID is None and editionOCLCs is None:
+            return False
+
+        # Pages and catalog records are timed as a whole since they are
+        # requested side by side
+        with metrics.timer("oclc.classify_pages"):
+            pageResps = await fetcher.getAll([self._classifyURL(oclc, page) for page in pages])
+        for pageResp in filter(self._checkResponse, pageResps):
+            editionOCLCs.extend(self._parseMoreEditions(pageResp))
+        editionOCLCs = list(set(editionOCLCs))
+        self.logger.debug("Loaded OCLC records for OWI {}".format(workID))
+
+        with metrics.timer("oclc.catalog_all"):
+            catalogResps = await fetcher.getAll([self._catalogURL(edition) for edition, language in editionOCLCs])
+        editions = list(filter(lambda x: x, map(self._parseEdition, catalogResps, editionOCLCs)))
+        return workID, workTitle, editions, workAuthors
+
+    def applyOCLCData(self, work, oclcData):
+        workID, workTitle, editions, workAuthors = oclcData
+        work.entities.extend(workAuthors)
+        self._enhanceRecord(work, workID, workTitle, editions)
+
+    def _enhanceRecord(self, work, workID, workTitle, marcEditions):
         # Add Work level data
         # TODO Handle Variant Titles, right now each edition has their own
-        metadata["title"] = workTitle
-        metadata["ids"].append({
-            "type": "owi",
-            "id": workID
-        })
-        editions = metadata["editions"]
+        work.title = workTitle
+        work.ids.append(IdentifierRecord(
+            type="owi",
+            identifier=workID
+        ))
+        editions = work.instances
         tmpEditions = []
         pubYear = None
         for edition, language in marcEditions:
@@ -84,19 +141,19 @@ class oclcReader(xmlParser):
 
                 isbns = edition.isbns()
                 issns = edition.issns()
-                newEdition = {
-                    "title": title,
-                    "publisher": publisher,
-                    "pubPlace": pubPlace,
-                    "year": pubYear,
-                    "extent": extent,
-                    "dimensions": dimensions,
-                    "language": language[:2],
-                    "notes": notes,
-                    "isbn": isbns,
-                    "issn": issns,
-                    "oclc": [oclc]
-                }
+                newEdition = InstanceRecord(
+                    title=title,
+                    publisher=publisher,
+                    pub_place=pubPlace,
+                    pub_date=pubYear,
+                    extent=extent,
+                    dimensions=dimensions,
+                    language=language[:2],
+                    summary=notes,
+                    isbn=isbns,
+                    issn=issns,
+                    oclc=[oclc]
+                )
                 editions = self._mergeEdition(editions, newEdition)
             except TypeError as err:
                 self.logger.warning("Could not parse XML for edition in OWI {}".format(workID))
@@ -105,8 +162,8 @@ class oclcReader(xmlParser):
                 self.logger.error("Failure to parse XML data. Bug in the MARC parser!")
                 self.logger.debug(err)
                 sys.exit(5)
-        metadata["editions"] = editions
-        return metadata
+        work.instances = editions
+        return work
 
 
     # This is the main edition matching algorithm. It looks at three fields:
@@ -123,15 +180,15 @@ class oclcReader(xmlParser):
     def _mergeEdition(self, existing, new):
         for i, edition in enumerate(existing):
             score = 0
-            if edition["pubPlace"] is not None and new["pubPlace"] is not None:
-                placeDist = jaro_winkler(edition["pubPlace"].lower(), new["pubPlace"].lower())
+            if edition.pub_place is not None and new.pub_place is not None:
+                placeDist = jaro_winkler(edition.pub_place.lower(), new.pub_place.lower())
                 if placeDist > 0.9:
                     score += 1
-            if edition["publisher"] is not None and new["publisher"] is not None:
-                pubDist = jaro_winkler(edition["publisher"].lower(), new["publisher"].lower())
+            if edition.publisher is not None and new.publisher is not None:
+                pubDist = jaro_winkler(edition.publisher.lower(), new.publisher.lower())
                 if pubDist > 0.9:
                     score += 1
-            if edition["year"] == new["year"]:
+            if edition.pub_date == new.pub_date:
                 score += 1
             if score > 1:
                 self.logger.debug("Found matching editions")
@@ -145,44 +202,43 @@ class oclcReader(xmlParser):
     # TODO Figure out a way to best merge all fields to preserve as much data
     # as humanly possible. We want these records to be rich to enable discovery
     def _mergeRecords(self, edition, new):
-        edition["isbn"] = list(set(edition["isbn"] + new["isbn"]))
-        edition["issn"] = list(set(edition["issn"] + new["issn"]))
-        edition["oclc"].extend(new["oclc"])
-        edition["notes"] = new["notes"]
+        edition.isbn = list(set(edition.isbn + new.isbn))
+        edition.issn = list(set(edition.issn + new.issn))
+        edition.oclc.extend(new.oclc)
+        edition.summary = new.summary
         return edition
 
 
-    def _createQuery(self, metadata):
+    def _createQuery(self, work):
         query = ""
-        if metadata["marc010"] is not None:
-            query = "srw.dn+all+'{}''".format(metadata["marc010"])
+        if work.marc010 is not None:
+            query = "srw.dn+all+'{}''".format(work.marc010)
         else:
-            query = 'srw.ti+all+"{}"'.format(metadata["title"])
-            authors = self._getAuthors(metadata["entities"])
+            query = 'srw.ti+all+"{}"'.format(work.title)
+            authors = self._getAuthors(work.entities)
             if len(authors) > 0:
                 query += '+and+srw.au+all+"{}"'.format(authors)
         query += "&wskey={}".format(oclcReader.wsKey)
         return oclcReader.oclcSearch + query
 
     def _getAuthors(self, entities):
-        authors = [x["name"] for x in entities if x["role"] == "creator"]
+        authors = [x.name for x in entities if x.role == "creator"]
         return ", ".join(authors)
 
-    def _getGutenbergOCLC(self, oclcResp):
+    def _getGutenbergOCLC(self, oclcResp, bookID):
         try:
             results = etree.fromstring(oclcResp.text.encode("utf-8"))
         except etree.XMLSyntaxError as err:
             self.logger.warning("Could not Read OCLC XML Respone")
             self.logger.debug(err)
             return False
-        self.nsmap[None] = "http://www.loc.gov/MARC21/slim"
         records = results.findall(".//record", namespaces=self.nsmap)
-        gutenbergMARC = list(filter(lambda x: x, map(self._findGutenbergOCLC, records)))
+        gutenbergMARC = list(filter(lambda x: x, map(self._findGutenbergOCLC, records, repeat(bookID))))
         if len(gutenbergMARC) > 0:
             return gutenbergMARC[0]
         return False
 
-    def _findGutenbergOCLC(self, record):
+    def _findGutenbergOCLC(self, record, bookID):
         marc = marcalyx.Record(record)
         try:
             urls = [s.value for s in marc.subfield('856', 'u')]
@@ -193,83 +249,108 @@ class oclcReader(xmlParser):
             self.logger.debug(marc.holdings())
         # TODO Does it ever make sense to have multiple records with gutenberg references?
         # If we have more than one, how do we determine which is the correct one
-        gutenbergRefs = [ref for ref in gutenbergRefs if self.bookID in ref]
+        gutenbergRefs = [ref for ref in gutenbergRefs if bookID in ref]
         if len(gutenbergRefs) > 0:
             return marc["001"][0].value
         return False
 
+    def _classifyURL(self, oclc, page=None):
+        if page is not None:
+            classifyQuery = "{}&startRec={}&wskey={}".format(oclc, page, oclcReader.wsKey)
+        else:
+            classifyQuery = "{}&wskey={}".format(oclc, oclcReader.wsKey)
+        return oclcReader.oclcClassify + classifyQuery
+
+    def _catalogURL(self, oclc):
+        catalogQuery = "{}?wskey={}".format(oclc, oclcReader.wsKey)
+        return oclcReader.oclcCatalog + catalogQuery
+
     def _getEditions(self, oclc):
-        classifyQuery = "{}&wskey={}".format(oclc, oclcReader.wsKey)
-        classifyQuery = oclcReader.oclcClassify + classifyQuery
+        classifyQuery = self._classifyURL(oclc)
         self.logger.debug("Classify Query: {}".format(classifyQuery))
 
-        classifyResp = requests.get(classifyQuery)
-        classifyResp.raise_for_status
+        with metrics.timer("oclc.classify"):
+            classifyResp = self.http.get(classifyQuery)
+        if self._checkResponse(classifyResp) is False:
+            return None, None, None, None
+
+        workID, oclcTitle, editionOCLCs, authors, pages = self._parseClassify(classifyResp)
+        if workID is None:
+            return None, None, None, None
 
-        self.nsmap[None] = "http://classify.oclc.org"
+        # Look for additional pages of Edition data
+        for page in pages:
+            editionOCLCs.extend(self._getMoreEditions(page, oclc))
+
+        return workID, oclcTitle, list(set(editionOCLCs)), authors
+
+    # Returns the work data from a Classify response along with the list of
+    # additional pages of editions that need to be requested
+    def _parseClassify(self, classifyResp):
         classifyXML = etree.fromstring(classifyResp.text.encode("utf-8"))
-        classifyCode = classifyXML.find(".//response", namespaces=self.nsmap).attrib["code"]
+        classifyCode = classifyXML.find(".//response", namespaces=oclcReader.classifyNS).attrib["code"]
         if classifyCode == "102":
-            return None, None, None, None
-        workID = classifyXML.find(".//work", namespaces=self.nsmap).attrib["owi"]
-        oclcTitle = classifyXML.find(".//work", namespaces=self.nsmap).attrib["title"]
+            return None, None, None, None, []
+        workID = classifyXML.find(".//work", namespaces=oclcReader.classifyNS).attrib["owi"]
+        oclcTitle = classifyXML.find(".//work", namespaces=oclcReader.classifyNS).attrib["title"]
 
-        authorRecs = classifyXML.findall(".//author", namespaces=self.nsmap)
+        authorRecs = classifyXML.findall(".//author", namespaces=oclcReader.classifyNS)
         authors = list(map(self._parseAuthors, authorRecs))
 
         editionOCLCs = self._getEditionOCLC(classifyXML)
 
-        # Look for additional pages of Edition data
-        navigation = classifyXML.find(".//navigation", namespaces=self.nsmap)
+        pages = []
+        navigation = classifyXML.find(".//navigation", namespaces=oclcReader.classifyNS)
         if navigation is not None:
-            pages = navigation.findall(".//page", namespaces=self.nsmap)
-            for page in pages:
-                pageNumber = page.find(".//label", namespaces=self.nsmap).text
-                pageLink = page.find(".//link", namespaces=self.nsmap)
+            for page in navigation.findall(".//page", namespaces=oclcReader.classifyNS):
+                pageNumber = page.find(".//label", namespaces=oclcReader.classifyNS).text
+                pageLink = page.find(".//link", namespaces=oclcReader.classifyNS)
                 if int(pageNumber) > 1 and pageLink is not None:
-                    editionOCLCs.extend(self._getMoreEditions(pageLink.text, oclc))
-
+                    pages.append(pageLink.text)
 
-        return workID, oclcTitle, list(set(editionOCLCs)), authors
+        return workID, oclcTitle, editionOCLCs, authors, pages
 
     def _getMoreEditions(self, page, oclc):
         self.logger.debug("Loading more editions from Page #{}".format(page))
-        classifyQuery = "{}&startRec={}&wskey={}".format(oclc, page, oclcReader.wsKey)
-        classifyQuery = oclcReader.oclcClassify + classifyQuery
+        with metrics.timer("oclc.classify"):
+            classifyResp = self.http.get(self._classifyURL(oclc, page))
+        if self._checkResponse(classifyResp) is False:
+            return []
 
-        classifyResp = requests.get(classifyQuery)
-        classifyResp.raise_for_status
+        return self._parseMoreEditions(classifyResp)
 
+    def _parseMoreEditions(self, classifyResp):
         classifyXML = etree.fromstring(classifyResp.text.encode("utf-8"))
-
         return self._getEditionOCLC(classifyXML)
 
     def _getEditionOCLC(self, xml):
-        editions = xml.findall(".//edition", namespaces=self.nsmap)
+        editions = xml.findall(".//edition", namespaces=oclcReader.classifyNS)
         return [(edition.attrib["oclc"], edition.attrib["language"]) for edition in editions]
 
     def _parseAuthors(self, author):
-        return {
-            "name": author.text,
-            "viaf": author.get("viaf"),
-            "lcnaf": author.get("lc"),
-            "role": "author",
-            "birthdate": None,
-            "deathdate": None
-        }
+        return EntityRecord(
+            name=author.text,
+            viaf=author.get("viaf"),
+            lcnaf=author.get("lc"),
+            role="author"
+        )
 
     def _getEditionMARC(self, oclcs):
         return list(filter(lambda x: x, map(self._loadEdition, oclcs)))
 
     def _loadEdition(self, oclcData):
         oclc, language = oclcData
-        catalogQuery = "{}?wskey={}".format(oclc, oclcReader.wsKey)
-        catalogQuery = oclcReader.oclcCatalog + catalogQuery
+        catalogQuery = self._catalogURL(oclc)
         self.logger.debug("Catalog Query: {}".format(catalogQuery))
-        catalogResp = requests.get(catalogQuery)
-        catalogResp.raise_for_status
+        with metrics.timer("oclc.catalog"):
+            catalogResp = self.http.get(catalogQuery)
 
-        self.nsmap[None] = "http://classify.oclc.org"
+        return self._parseEdition(catalogResp, oclcData)
+
+    def _parseEdition(self, catalogResp, oclcData):
+        oclc, language = oclcData
+        if self._checkResponse(catalogResp) is False:
+            return False
         catalogXML = etree.fromstring(catalogResp.text.encode("utf-8"))
         try:
             return (marcalyx.Record(catalogXML), language)
@@ -278,6 +359,15 @@ class oclcReader(xmlParser):
             self.logger.debug(err)
             return False
 
+    # Failed requests, including misses when replaying from the response
+    # cache, are skipped rather than handed to the XML parser
+    def _checkResponse(self, resp):
+        if resp.status_code != 200:
+            self.logger.warning("OCLC request failed with status {}".format(resp.status_code))
+            metrics.count("oclc.failed")
+            return False
+        return True
+
     def _getSubfield(self, marc, field, code):
         if len(marc.subfield(field, code)) < 1:
             return None
@@ -0,0 +1,126 @@
+import unittest
+import shutil
+import tempfile
+
+from helpers.cache import ResponseCache, CachedResponse, LookupCache
+
+class MockUpstream:
+
+    def __init__(self):
+        self.requested = []
+
+    def get(self, url):
+        self.requested.append(url)
+        return CachedResponse(url, 200, url.encode("utf-8"), fromCache=False)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        self.upstream = MockUpstream()
+        self.cache = ResponseCache(self.cacheDir, 1024, upstream=self.upstream)
+        self.cache.addEndpoint("test", "http://test.org/", 3600)
+
+    def test_key_ignores_wskey(self):
+        self.assertEqual(
+            self.cache.createKey("http://test.org/a?b=1&wskey=abc"),
+            self.cache.createKey("http://TEST.org/a?wskey=xyz&b=1")
+        )
+
+    def test_cached_response(self):
+        self.cache.get("http://test.org/1?wskey=abc")
+        resp = self.cache.get("http://test.org/1?wskey=def")
+        self.assertTrue(resp.fromCache)
+        self.assertEqual(len(self.upstream.requested), 1)
+        self.assertEqual(self.cache.getStats(), {"hits": 1, "misses": 1})
+
+    def test_expired_response(self):
+        self.cache.endpoints = [("test", "http://test.org/", -1)]
+        self.cache.get("http://test.org/1")
+        self.cache.get("http://test.org/1")
+        self.assertEqual(len(self.upstream.requested), 2)
+
+    def test_lru_eviction(self):
+        self.cache.maxSize = 1100
+        longPath = "http://test.org/" + "x" * 500
+        self.cache.get(longPath + "1")
+        self.cache.get(longPath + "2")
+        self.cache.get(longPath + "1")
+        self.cache.get(longPath + "3")
+        self.cache.get(longPath + "1")
+        self.cache.get(longPath + "2")
+        self.assertEqual(len(self.upstream.requested), 4)
+        self.assertEqual(self.upstream.requested[-1], longPath + "2")
+
+    def test_running_size(self):
+        self.cache.put("http://test.org/1", b"x" * 100)
+        self.cache.put("http://test.org/2", b"x" * 200)
+        self.cache.put("http://test.org/1", b"x" * 50)
+        self.assertEqual(self.cache.getSize(), 250)
+        self.cache._delete(self.cache.createKey("http://test.org/2"))
+        self.assertEqual(self.cache.getSize(), 50)
+
+        reopened = ResponseCache(self.cacheDir, 1024)
+        self.assertEqual(reopened.getSize(), 50)
+        reopened.close()
+
+    def test_access_times_written_on_close(self):
+        self.cache.put("http://test.org/1", b"body")
+        stored = self.cache.index.execute("SELECT accessed FROM responses").fetchone()[0]
+        self.cache.get("http://test.org/1")
+        self.assertEqual(len(self.cache.accessed), 1)
+        self.cache.close()
+
+        self.cache = ResponseCache(self.cacheDir, 1024)
+        accessed = self.cache.index.execute("SELECT accessed FROM responses").fetchone()[0]
+        self.assertGreater(accessed, stored)
+
+    def test_cache_only_miss(self):
+        self.cache.cacheOnly = True
+        resp = self.cache.get("http://test.org/missing")
+        self.assertEqual(resp.status_code, 504)
+        self.assertEqual(len(self.upstream.requested), 0)
+
+    def test_replay_seeded_response(self):
+        self.cache.cacheOnly = True
+        self.cache.put("http://test.org/recorded", b"recorded body")
+        resp = self.cache.get("http://test.org/recorded?wskey=abc")
+        self.assertEqual(resp.content, b"recorded body")
+        self.assertEqual(len(self.upstream.requested), 0)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.cacheDir)
+
+
+class TestLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LookupCache(2)
+
+    def test_hit_and_miss(self):
+        self.cache.put(("lcsh", "Fiction"), 1)
+        self.assertEqual(self.cache.get(("lcsh", "Fiction")), 1)
+        self.assertIsNone(self.cache.get(("lcsh", "Poetry")))
+        stats = self.cache.getStats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_evicts_least_recent(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")
+        self.cache.put("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.getStats()["size"], 2)
+
+    def test_disabled(self):
+        cache = LookupCache(0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
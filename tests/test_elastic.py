@@ -0,0 +1,205 @@
+import logging
+import unittest
+from unittest.mock import patch
+from elasticsearch import ConnectionError
+
+from lib.gutenberg_elastic import GutenbergES
+
+class MockIndices:
+
+    def __init__(self, indexes, aliases):
+        self.indexes = indexes
+        self.aliases = aliases
+        self.updates = []
+        self.deleted = []
+        self.failedUpdates = 0
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return dict((index, {"aliases": {name: {}}}) for index in self.aliases[name])
+
+    def exists(self, index):
+        return index in self.indexes
+
+    def get(self, index):
+        prefix = index.rstrip("*")
+        return dict((name, {}) for name in self.indexes if name.startswith(prefix))
+
+    def update_aliases(self, body):
+        if self.failedUpdates > 0:
+            self.failedUpdates -= 1
+            raise ConnectionError("N/A", "Connection refused", OSError("Connection refused"))
+        self.updates.append(body)
+
+    def delete(self, index, ignore=None):
+        self.deleted.append(index)
+        if index in self.indexes:
+            self.indexes.remove(index)
+
+
+class MockES:
+
+    def __init__(self, version, indexes, aliases={}):
+        self.version = version
+        self.indices = MockIndices(indexes, aliases)
+
+    def info(self):
+        return {"version": {"number": self.version}}
+
+
+class TestIndexVersions(unittest.TestCase):
+
+    def setUp(self):
+        # The connections are not needed to manage indexes
+        self.esConnector = GutenbergES.__new__(GutenbergES)
+        self.esConnector.logger = logging.getLogger('guten_logs')
+        self.esConnector.keepIndexes = 1
+        self.esConnector.bulkRetries = 2
+
+    def swapAlias(self, es, indexName):
+        with patch("lib.gutenberg_elastic.connections.get_connection", return_value=es):
+            self.esConnector.swapAlias(indexName)
+
+    def test_swap_existing_alias(self):
+        es = MockES("6.2.4", ["sfr-1", "sfr-2"], {"sfr": ["sfr-1"]})
+        self.swapAlias(es, "sfr-2")
+        self.assertEqual(es.indices.updates, [{"actions": [
+            {"remove": {"index": "sfr-1", "alias": "sfr"}},
+            {"add": {"index": "sfr-2", "alias": "sfr"}}
+        ]}])
+        self.assertEqual(es.indices.deleted, [])
+
+    def test_replace_index_in_one_request(self):
+        es = MockES("6.4.0", ["sfr", "sfr-1"])
+        self.swapAlias(es, "sfr-1")
+        self.assertEqual(es.indices.updates, [{"actions": [
+            {"remove_index": {"index": "sfr"}},
+            {"add": {"index": "sfr-1", "alias": "sfr"}}
+        ]}])
+        self.assertEqual(es.indices.deleted, [])
+
+    def test_replace_index_before_6_4(self):
+        es = MockES("6.2.4", ["sfr", "sfr-1"])
+        self.swapAlias(es, "sfr-1")
+        self.assertEqual(es.indices.deleted, ["sfr"])
+        self.assertEqual(es.indices.updates, [{"actions": [
+            {"add": {"index": "sfr-1", "alias": "sfr"}}
+        ]}])
+
+    @patch("lib.gutenberg_elastic.time.sleep")
+    def test_alias_retried_after_delete(self, mockSleep):
+        es = MockES("6.2.4", ["sfr", "sfr-1"])
+        es.indices.failedUpdates = 2
+        self.swapAlias(es, "sfr-1")
+        self.assertEqual(es.indices.updates, [{"actions": [
+            {"add": {"index": "sfr-1", "alias": "sfr"}}
+        ]}])
+
+    # When the alias cannot be added the new index is the only one left
+    @patch("lib.gutenberg_elastic.time.sleep")
+    def test_alias_failed_after_delete(self, mockSleep):
+        es = MockES("6.2.4", ["sfr", "sfr-1"])
+        es.indices.failedUpdates = 3
+        with self.assertRaises(ConnectionError):
+            self.swapAlias(es, "sfr-1")
+        with patch("lib.gutenberg_elastic.connections.get_connection", return_value=es):
+            self.assertFalse(self.esConnector.hasLiveIndex())
+
+    def test_live_index(self):
+        with patch("lib.gutenberg_elastic.connections.get_connection", return_value=MockES("6.2.4", ["sfr-1"], {"sfr": ["sfr-1"]})):
+            self.assertTrue(self.esConnector.hasLiveIndex())
+        with patch("lib.gutenberg_elastic.connections.get_connection", return_value=MockES("6.2.4", ["sfr"])):
+            self.assertTrue(self.esConnector.hasLiveIndex())
+
+    def test_remove_old_indexes(self):
+        es = MockES("6.2.4", ["sfr-1", "sfr-2", "sfr-3", "sfr-4"])
+        with patch("lib.gutenberg_elastic.connections.get_connection", return_value=es):
+            self.esConnector.removeOldIndexes("sfr-4")
+        self.assertEqual(es.indices.deleted, ["sfr-1", "sfr-2"])
+
+
+# Stands in for streaming_bulk, answering each action with the statuses
+# queued for its ID and 200 once those run out
+class MockBulk:
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.sent = []
+        self.kwargs = []
+
+    def __call__(self, client, actions, **kwargs):
+        self.kwargs.append(kwargs)
+        for action in actions:
+            opType = action.get("_op_type", "index")
+            self.sent.append((opType, action["_id"]))
+            queued = self.statuses.get(action["_id"], [])
+            status = queued.pop(0) if len(queued) > 0 else 200
+            result = {"_id": action["_id"], "status": status}
+            if status != 200:
+                result["error"] = "status {}".format(status)
+            yield status == 200, {opType: result}
+
+
+@patch("lib.gutenberg_elastic.time.sleep")
+@patch("lib.gutenberg_elastic.connections.get_connection")
+class TestBulkFlush(unittest.TestCase):
+
+    def setUp(self):
+        self.esConnector = GutenbergES.__new__(GutenbergES)
+        self.esConnector.logger = logging.getLogger('guten_logs')
+        self.esConnector.bulkSize = 500
+        self.esConnector.bulkBytes = 1024 * 1024
+        self.esConnector.bulkRetries = 2
+        self.esConnector.buffer = []
+        self.esConnector.bufferBytes = 0
+        self.esConnector.failures = 0
+
+    def flush(self, actions, statuses):
+        self.esConnector.buffer = list(actions)
+        mockBulk = MockBulk(statuses)
+        with patch("lib.gutenberg_elastic.esHelpers.streaming_bulk", mockBulk):
+            failed = self.esConnector.flush()
+        return failed, mockBulk
+
+    def test_retryable_statuses_resent(self, mockConnection, mockSleep):
+        failed, mockBulk = self.flush(
+            [{"_id": 1}, {"_id": 2}, {"_id": 3}],
+            {1: [429], 2: [503, "N/A"]}
+        )
+        self.assertEqual(failed, 0)
+        self.assertEqual(self.esConnector.failures, 0)
+        self.assertEqual(mockBulk.sent, [
+            ("index", 1), ("index", 2), ("index", 3),
+            ("index", 1), ("index", 2),
+            ("index", 2)
+        ])
+        self.assertEqual(self.esConnector.buffer, [])
+        # Errors are read from the results rather than raised
+        for kwargs in mockBulk.kwargs:
+            self.assertFalse(kwargs["raise_on_error"])
+            self.assertFalse(kwargs["raise_on_exception"])
+
+    def test_failures_counted(self, mockConnection, mockSleep):
+        failed, mockBulk = self.flush(
+            [{"_id": 1}, {"_id": 2}, {"_id": 3}],
+            {1: [400], 2: [429, 429, 429]}
+        )
+        self.assertEqual(failed, 2)
+        self.assertEqual(self.esConnector.failures, 2)
+        self.assertEqual(mockBulk.sent.count(("index", 1)), 1)
+        self.assertEqual(mockBulk.sent.count(("index", 2)), 3)
+
+        failed, mockBulk = self.flush([{"_id": 4}], {4: [500]})
+        self.assertEqual(failed, 0)
+        self.assertEqual(self.esConnector.failures, 2)
+
+    def test_missing_delete_ignored(self, mockConnection, mockSleep):
+        failed, mockBulk = self.flush([{"_id": 1, "_op_type": "delete"}], {1: [404]})
+        self.assertEqual(failed, 0)
+        self.assertEqual(mockBulk.sent, [("delete", 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
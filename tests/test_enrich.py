@@ -0,0 +1,65 @@
+import unittest
+
+from lib.gutenberg_enrich import GutenbergEnricher
+from lib.gutenberg_records import WorkRecord
+
+class MockMWReader:
+
+    def __init__(self, matched):
+        self.matched = matched
+
+    def lookupURL(self, bookID):
+        return "http://mw.org/{}".format(bookID)
+
+    def parseMWData(self, work, mwResp, bookID):
+        if self.matched is True:
+            work.ids = []
+        return work
+
+
+class MockOCLCReader:
+
+    def __init__(self):
+        self.fetched = []
+        self.applied = []
+
+    async def fetchOCLCDataAsync(self, work, bookID, fetcher):
+        self.fetched.append(bookID)
+        return {"bookID": bookID}
+
+    def applyOCLCData(self, work, oclcData):
+        self.applied.append(oclcData["bookID"])
+
+
+class TestGutenbergEnricher(unittest.TestCase):
+
+    def enhance(self, matched, speculativeOCLC=False):
+        oclcReader = MockOCLCReader()
+        enricher = GutenbergEnricher(
+            MockMWReader(matched),
+            oclcReader,
+            getter=lambda url: url,
+            speculativeOCLC=speculativeOCLC
+        )
+        enricher.enhance(WorkRecord(), "84")
+        enricher.close()
+        return oclcReader
+
+    def test_oclc_after_mw_match(self):
+        oclcReader = self.enhance(True)
+        self.assertEqual(oclcReader.fetched, ["84"])
+        self.assertEqual(oclcReader.applied, ["84"])
+
+    def test_no_oclc_without_mw_match(self):
+        oclcReader = self.enhance(False)
+        self.assertEqual(oclcReader.fetched, [])
+        self.assertEqual(oclcReader.applied, [])
+
+    def test_speculative_oclc(self):
+        oclcReader = self.enhance(False, speculativeOCLC=True)
+        self.assertEqual(oclcReader.fetched, ["84"])
+        self.assertEqual(oclcReader.applied, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date
+
+from lib.gutenberg_epubs import EpubFetcher
+from lib.gutenberg_records import ItemRecord
+
+class FakeResponse:
+
+    def __init__(self, status, body=b"", headers=None):
+        self.status_code = status
+        self.body = body
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class TestEpubFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.epubDir = tempfile.mkdtemp()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.requests = []
+        self.responses = {}
+        self.fetcher = EpubFetcher(http=self, epubDir=self.epubDir, workers=2, chunkSize=4)
+
+    def get(self, url, headers=None, stream=False):
+        with self.lock:
+            self.requests.append((url, headers, stream))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+        return self.responses.get(url, FakeResponse(404))
+
+    def createEpub(self, bookID, images="images"):
+        return ItemRecord(
+            url="http://www.gutenberg.org/ebooks/{}.epub.{}".format(bookID, images),
+            date_modified="2018-10-01",
+            size=10
+        )
+
+    def test_streamed_to_disk(self):
+        epub = self.createEpub(1)
+        self.responses[epub.url] = FakeResponse(200, b"epub contents", {"ETag": '"abc"'})
+        res = self.fetcher.fetch(7, epub)
+        sha = hashlib.sha256(b"epub contents").hexdigest()
+        self.assertEqual(res["epub_path"], os.path.join(self.epubDir, sha[:2], sha + ".epub"))
+        self.assertEqual(res["checksum"], hashlib.md5(b"epub contents").hexdigest())
+        self.assertEqual(res["etag"], '"abc"')
+        with open(res["epub_path"], "rb") as epubFile:
+            self.assertEqual(epubFile.read(), b"epub contents")
+        self.assertTrue(self.requests[0][2])
+        self.assertEqual(os.listdir(self.epubDir), [sha[:2]])
+
+    def test_missing_directory_created(self):
+        epubDir = os.path.join(self.epubDir, "new", "epubs")
+        fetcher = EpubFetcher(http=self, epubDir=epubDir)
+        epub = self.createEpub(2)
+        self.responses[epub.url] = FakeResponse(200, b"epub contents")
+        res = fetcher.fetch(3, epub)
+        fetcher.close()
+        self.assertTrue(res["epub_path"].startswith(epubDir))
+        self.assertEqual(fetcher.stats["failed"], 0)
+        self.assertEqual(fetcher.stats["fetched"], 1)
+
+    def test_identical_payloads_stored_once(self):
+        images, noimages = self.createEpub(4), self.createEpub(4, "noimages")
+        self.responses[images.url] = FakeResponse(200, b"same contents")
+        self.responses[noimages.url] = FakeResponse(200, b"same contents")
+        res = [self.fetcher.fetch(1, images), self.fetcher.fetch(2, noimages)]
+        self.assertEqual(res[0]["epub_path"], res[1]["epub_path"])
+        self.assertEqual(len(os.listdir(os.path.dirname(res[0]["epub_path"]))), 1)
+        self.assertEqual(self.fetcher.stats["deduplicated"], 1)
+
+    def test_current_copy_skipped(self):
+        epub = self.createEpub(5)
+        epubPath = os.path.join(self.epubDir, "stored.epub")
+        with open(epubPath, "wb") as epubFile:
+            epubFile.write(b"0123456789")
+        previous = {"epub_path": epubPath, "checksum": "a" * 32, "etag": None, "last_modified": None, "date_modified": date(2018, 10, 1)}
+        res = self.fetcher.fetch(10, epub, previous)
+        self.assertEqual(self.requests, [])
+        self.assertEqual(res["checksum"], "a" * 32)
+        epub.date_modified = "2018-11-01"
+        self.fetcher.fetch(10, epub, previous)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_not_modified(self):
+        epub = self.createEpub(2)
+        epubPath = os.path.join(self.epubDir, "2.epub.images")
+        open(epubPath, "wb").close()
+        previous = {"epub_path": epubPath, "checksum": None, "etag": '"abc"', "last_modified": None, "date_modified": date(2018, 10, 1)}
+        self.responses[epub.url] = FakeResponse(304)
+        res = self.fetcher.fetch(8, epub, previous)
+        self.assertEqual(res["epub_path"], epubPath)
+        self.assertEqual(self.requests[0][1], {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Mon, 01 Oct 2018 00:00:00 GMT"
+        })
+
+    def test_missing_file_unconditional(self):
+        epub = self.createEpub(3)
+        previous = {"epub_path": os.path.join(self.epubDir, "gone"), "checksum": None, "etag": '"abc"', "last_modified": None, "date_modified": None}
+        res = self.fetcher.fetch(9, epub, previous)
+        self.assertEqual(self.requests[0][1], {})
+        self.assertIsNone(res["epub_path"])
+
+    def test_bounded_workers(self):
+        items = [(i, self.createEpub(i)) for i in range(6)]
+        res = self.fetcher.fetchAll(items, {})
+        self.assertEqual([fetch["id"] for fetch in res], list(range(6)))
+        self.assertEqual(self.peak, 2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        shutil.rmtree(self.epubDir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+import tempfile
+import zipfile
+
+from lib.gutenberg_explode import EpubExploder, ExplodedEpub
+
+container = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+opf = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0">
+  <metadata><dc:title>Test Book</dc:title></metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="ch1" href="text/ch1.html" media-type="application/xhtml+xml"/>
+    <item id="ch2" href="text/ch2.html" media-type="application/xhtml+xml"/>
+    <item id="img" href="images/cover.jpg" media-type="image/jpeg"/>
+  </manifest>
+  <spine toc="ncx"><itemref idref="ch1"/><itemref idref="ch2"/></spine>
+</package>"""
+
+ncx = """<?xml version="1.0"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <navMap>
+    <navPoint id="n1"><navLabel><text>Chapter One</text></navLabel><content src="text/ch1.html"/></navPoint>
+    <navPoint id="n2"><navLabel><text>Chapter Two</text></navLabel><content src="text/ch2.html#start"/></navPoint>
+  </navMap>
+</ncx>"""
+
+class TestEpubExploder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.archivePath = os.path.join(self.tmpDir, "book.epub")
+        with zipfile.ZipFile(self.archivePath, "w") as archive:
+            archive.writestr("mimetype", "application/epub+zip")
+            archive.writestr("META-INF/container.xml", container)
+            archive.writestr("OEBPS/content.opf", opf)
+            archive.writestr("OEBPS/toc.ncx", ncx)
+            archive.writestr("OEBPS/text/ch1.html", "<html>first chapter</html>")
+            archive.writestr("OEBPS/text/ch2.html", "<html>second</html>")
+            archive.writestr("OEBPS/images/cover.jpg", b"\xff\xd8image")
+            archive.writestr("../outside.txt", "unsafe")
+        self.exploder = EpubExploder(os.path.join(self.tmpDir, "store"))
+        self.contentHash = "ab" * 32
+
+    def test_spine_offsets(self):
+        bookDir = self.exploder.explode(self.archivePath, self.contentHash)
+        book = ExplodedEpub(bookDir)
+        self.assertEqual(book.manifest["title"], "Test Book")
+        self.assertEqual(book.getChapterCount(), 2)
+        self.assertEqual(book.getChapter(0), b"<html>first chapter</html>")
+        self.assertEqual(book.getChapter("OEBPS/text/ch2.html#start"), b"<html>second</html>")
+        self.assertEqual(book.manifest["spine"][1]["offset"], len(b"<html>first chapter</html>"))
+        self.assertEqual([chapter["title"] for chapter in book.manifest["spine"]], ["Chapter One", "Chapter Two"])
+        book.close()
+
+    def test_resources_written(self):
+        bookDir = self.exploder.explode(self.archivePath, self.contentHash)
+        book = ExplodedEpub(bookDir)
+        with open(book.getResourcePath("OEBPS/images/cover.jpg"), "rb") as image:
+            self.assertEqual(image.read(), b"\xff\xd8image")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, "store", "ab", "outside.txt")))
+        self.assertFalse(os.path.exists(book.getResourcePath("OEBPS/text/ch1.html")))
+        book.close()
+
+    def test_unpacked_once(self):
+        bookDir = self.exploder.explode(self.archivePath, self.contentHash)
+        os.remove(self.archivePath)
+        self.assertEqual(self.exploder.explode(self.archivePath, self.contentHash), bookDir)
+        self.assertEqual(os.listdir(os.path.dirname(bookDir)), [self.contentHash])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+if __name__ == '__main__':
+    unittest.main()
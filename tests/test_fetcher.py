@@ -0,0 +1,44 @@
+import unittest
+import asyncio
+import threading
+import time
+
+from helpers.fetcher import AsyncFetcher
+
+class TestAsyncFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.fetcher = AsyncFetcher(getter=self.slowGet, hostLimit=2, threads=8)
+
+    def slowGet(self, url):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return url
+
+    def test_results_order(self):
+        urls = ["http://a.org/{}".format(i) for i in range(5)]
+        loop = asyncio.new_event_loop()
+        res = loop.run_until_complete(self.fetcher.getAll(urls))
+        loop.close()
+        self.assertEqual(res, urls)
+
+    def test_host_limit(self):
+        urls = ["http://a.org/{}".format(i) for i in range(6)]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(self.fetcher.getAll(urls))
+        loop.close()
+        self.assertEqual(self.peak, 2)
+
+    def tearDown(self):
+        self.fetcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import os
+from io import BytesIO
+from copy import deepcopy
+from lxml import etree
+
+from lib.gutenberg_xml import gutenbergXML, isCatalogBook
+
+class TestGutenbergXML(unittest.TestCase):
+
+    fixtureDir = os.path.dirname(__file__) + "/fixtures/catalog/cache/epub/"
+
+    def loadFixture(self, bookID, singlePass):
+        parser = gutenbergXML(singlePass=singlePass)
+        rdfFile = "{}{}/pg{}.rdf".format(TestGutenbergXML.fixtureDir, bookID, bookID)
+        return parser.load(rdfFile)
+
+    def test_single_pass_matches_xpath(self):
+        for bookID in ["84", "1034"]:
+            self.assertEqual(
+                self.loadFixture(bookID, True),
+                self.loadFixture(bookID, False)
+            )
+
+    def test_single_pass_record(self):
+        book = self.loadFixture("1034", True)
+        work = book.work
+        self.assertEqual(work.title, "Paradise Lost")
+        self.assertEqual(work.instances[0].pub_date, "1997")
+        self.assertEqual(len(work.subjects), 3)
+        self.assertEqual(work.entities[0].name, "Milton, John")
+        self.assertEqual(work.entities[0].role, "creator")
+        self.assertIsNone(work.ids)
+        self.assertEqual([item.url for item in book.items], [
+            "http://www.gutenberg.org/ebooks/1034.epub.images",
+            "http://www.gutenberg.org/ebooks/1034.epub.noimages"
+        ])
+
+    # Combine the fixture records into a single catalog document
+    def createCatalog(self, bookIDs):
+        catalog = None
+        for bookID in bookIDs:
+            rdfFile = "{}{}/pg{}.rdf".format(TestGutenbergXML.fixtureDir, bookID, bookID)
+            root = etree.parse(rdfFile).getroot()
+            if catalog is None:
+                catalog = root
+                continue
+            for child in root:
+                catalog.append(child)
+        return BytesIO(etree.tostring(catalog))
+
+    def test_catalog_stream(self):
+        parser = gutenbergXML()
+        records = list(parser.loadCatalog(self.createCatalog(["84", "1034"])))
+        self.assertEqual([record[0] for record in records], ["84", "1034"])
+        for bookID, book, rdfData in records:
+            self.assertEqual(book, self.loadFixture(bookID, True))
+
+    def test_catalog_entries_skipped(self):
+        self.assertTrue(isCatalogBook("84"))
+        self.assertTrue(isCatalogBook(1034))
+        for bookID in ["0", "84DELETE", "DELETE-84", "ebooks", ""]:
+            self.assertFalse(isCatalogBook(bookID))
+
+    def test_catalog_record_reload(self):
+        parser = gutenbergXML()
+        bookID, book, rdfData = next(parser.loadCatalog(self.createCatalog(["1034"])))
+        self.assertEqual(gutenbergXML().load(BytesIO(rdfData)), book)
+
+    # A later ebook that only references an agent gets the one described
+    # earlier in the catalog, and entries that are not books are left out
+    def test_catalog_records(self):
+        catalog = etree.fromstring(self.createCatalog(["84"]).getvalue())
+        rdf = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+        for bookID in ["0", "85"]:
+            ebook = deepcopy(catalog[0])
+            ebook.set(rdf + "about", "ebooks/{}".format(bookID))
+            creator = ebook.find("{http://purl.org/dc/terms/}creator")
+            creator.remove(creator[0])
+            creator.set(rdf + "resource", "2009/agents/61")
+            catalog.append(ebook)
+
+        parser = gutenbergXML()
+        records = list(parser.loadCatalogRecords(BytesIO(etree.tostring(catalog))))
+        self.assertEqual([record[0] for record in records], ["84", "85"])
+        book = parser.load(BytesIO(records[1][1]))
+        self.assertEqual(book.work.entities[0].name, "Shelley, Mary Wollstonecraft")
+        self.assertEqual(book.work.entities[0].gutenberg_id, "2009/agents/61")
+
+    # Nothing from one book is left on the parser for the next
+    def test_books_do_not_share_state(self):
+        parser = gutenbergXML()
+        first = parser.load("{}84/pg84.rdf".format(TestGutenbergXML.fixtureDir))
+        second = parser.load("{}1034/pg1034.rdf".format(TestGutenbergXML.fixtureDir))
+        self.assertEqual(first, self.loadFixture("84", True))
+        self.assertEqual(second, self.loadFixture("1034", True))
+        self.assertIsNot(first.work.entities, second.work.entities)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from lib.gutenberg_manifest import GutenbergManifest
+
+class TestGutenbergManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.epubDir = os.path.join(self.tmpDir, "epub")
+        for bookID in ["1", "2"]:
+            self.writeRDF(bookID, "<rdf>{}</rdf>".format(bookID))
+        self.manifest = GutenbergManifest(os.path.join(self.tmpDir, "manifest.db"))
+
+    def writeRDF(self, bookID, content):
+        rdfDir = os.path.join(self.epubDir, bookID)
+        os.makedirs(rdfDir, exist_ok=True)
+        rdfPath = os.path.join(rdfDir, "pg{}.rdf".format(bookID))
+        with open(rdfPath, "w") as rdfFile:
+            rdfFile.write(content)
+        return rdfPath
+
+    def recordAll(self):
+        for bookID in ["1", "2"]:
+            rdfPath = os.path.join(self.epubDir, bookID, "pg{}.rdf".format(bookID))
+            with open(rdfPath, "rb") as rdfFile:
+                rdfHash = self.manifest.hashData(rdfFile.read())
+            self.manifest.record(bookID, rdfHash, os.path.getmtime(rdfPath), [])
+
+    def test_new_books(self):
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(sorted(changed), ["1", "2"])
+        self.assertEqual(deleted, [])
+
+    def test_unchanged_books(self):
+        self.recordAll()
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(changed, [])
+
+    def test_changed_book(self):
+        self.recordAll()
+        rdfPath = self.writeRDF("2", "<rdf>changed</rdf>")
+        os.utime(rdfPath, (0, 0))
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(changed, ["2"])
+
+    def test_touched_book(self):
+        self.recordAll()
+        rdfPath = os.path.join(self.epubDir, "1", "pg1.rdf")
+        os.utime(rdfPath, (0, 0))
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(changed, [])
+
+    def test_deleted_book(self):
+        os.makedirs(os.path.join(self.epubDir, "DELETE-2"))
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(deleted, ["2"])
+        self.manifest.markDeleted("2")
+        changed, deleted = self.manifest.findChanges(self.epubDir)
+        self.assertEqual(deleted, [])
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmpDir)
+
+
+if __name__ == '__main__':
+    unittest.main()
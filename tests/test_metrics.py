@@ -0,0 +1,56 @@
+import unittest
+
+from helpers.metrics import Metrics, timerBuckets
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_timer_buckets(self):
+        self.metrics.observe("parse", 0.002)
+        self.metrics.observe("parse", 0.002)
+        self.metrics.observe("parse", 60)
+        timer = self.metrics.getSnapshot()["timers"]["parse"]
+        self.assertEqual(timer["count"], 3)
+        self.assertEqual(timer["buckets"][1], 2)
+        self.assertEqual(timer["buckets"][len(timerBuckets)], 1)
+
+        summary = self.metrics.getSummary()["timers"]["parse"]
+        self.assertEqual(summary["p50_ms"], 2.5)
+        self.assertEqual(summary["max_ms"], 60000)
+
+    def test_timed_decorator(self):
+        @self.metrics.timed("store")
+        def store(value):
+            raise ValueError(value)
+
+        with self.assertRaises(ValueError):
+            store("bad")
+        self.assertEqual(self.metrics.getSnapshot()["timers"]["store"]["count"], 1)
+
+    def test_drain_and_merge(self):
+        worker = Metrics()
+        worker.observe("mw.lookup", 0.02)
+        worker.count("books.read", 2)
+        self.metrics.count("books.read")
+
+        self.metrics.merge(worker.drain())
+        self.assertEqual(worker.getSnapshot(), {"timers": {}, "counters": {}})
+        snapshot = self.metrics.getSnapshot()
+        self.assertEqual(snapshot["timers"]["mw.lookup"]["count"], 1)
+        self.assertEqual(snapshot["counters"]["books.read"], 3)
+
+    def test_prometheus_text(self):
+        self.metrics.observe("db.check_ids", 0.003)
+        self.metrics.count("es.failures")
+        lines = self.metrics.getPrometheus().splitlines()
+        self.assertIn('gutenberg_duration_seconds_bucket{name="db.check_ids",le="0.0025"} 0', lines)
+        self.assertIn('gutenberg_duration_seconds_bucket{name="db.check_ids",le="0.005"} 1', lines)
+        self.assertIn('gutenberg_duration_seconds_bucket{name="db.check_ids",le="+Inf"} 1', lines)
+        self.assertIn('gutenberg_duration_seconds_count{name="db.check_ids"} 1', lines)
+        self.assertIn('gutenberg_events_total{name="es.failures"} 1', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+import re
+
+from helpers.migrations import migrations, tableDDL, lookupIndexes, duplicateLinks
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = re.findall(r"CREATE TABLE IF NOT EXISTS (\w+)", " ".join(tableDDL))
+
+    def test_versions_ordered(self):
+        versions = [version for version, name, migration in migrations]
+        self.assertEqual(versions, list(range(1, len(migrations) + 1)))
+
+    def test_names_unique(self):
+        names = [name for version, name, migration in migrations]
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_indexes_cover_tables(self):
+        indexNames = [name for name, table, columns, unique in lookupIndexes]
+        self.assertEqual(len(indexNames), len(set(indexNames)))
+        for name, table, columns, unique in lookupIndexes:
+            self.assertIn(table, self.tables)
+
+    def test_links_deduplicated_before_unique(self):
+        uniqueIndexes = [
+            (table, columns) for name, table, columns, unique in lookupIndexes
+            if unique is True and table != "subjects"
+        ]
+        for link in duplicateLinks:
+            self.assertIn(link, uniqueIndexes)
+        self.assertEqual(len(uniqueIndexes), len(duplicateLinks))
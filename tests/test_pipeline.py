@@ -0,0 +1,121 @@
+import unittest
+import threading
+import time
+
+from helpers.pipeline import Pipeline, PipelineStage
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.stored = []
+
+    def double(self, item, context):
+        if item == 3:
+            raise ValueError("bad item")
+        return item * 2
+
+    def slowStore(self, items, context):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+            self.stored.extend(items)
+        return [RuntimeError("not stored") if item == 8 else item for item in items]
+
+    def test_items_pass_through_stages(self):
+        pipeline = Pipeline([
+            PipelineStage("double", self.double, workers=2),
+            PipelineStage("store", self.slowStore, workers=2, batchSize=3)
+        ], queueSize=2)
+        summary = pipeline.run(range(10))
+        self.assertEqual(summary["processed"], 8)
+        self.assertEqual(sorted(self.stored), [0, 2, 4, 8, 10, 12, 14, 16, 18])
+        self.assertEqual(sorted(summary["failed"]), [
+            ("3", "double: ValueError('bad item')"),
+            ("8", "store: RuntimeError('not stored')")
+        ])
+        self.assertEqual(summary["stages"]["double"]["processed"], 9)
+        self.assertEqual(summary["stages"]["store"]["failed"], 1)
+        self.assertLessEqual(self.peak, 2)
+
+    def test_bounded_queues(self):
+        read = []
+        def source():
+            for item in range(20):
+                read.append(item)
+                yield item
+
+        started = threading.Event()
+        release = threading.Event()
+        def blocked(item, context):
+            started.set()
+            release.wait()
+            return item
+
+        pipeline = Pipeline([PipelineStage("blocked", blocked)], queueSize=2)
+        runner = threading.Thread(target=pipeline.run, args=(source(),))
+        runner.start()
+        started.wait()
+        time.sleep(0.05)
+        # One item is being handled, two are queued and one waits to be queued
+        self.assertEqual(len(read), 4)
+        release.set()
+        runner.join()
+        self.assertEqual(len(read), 20)
+
+    def test_worker_contexts(self):
+        contexts = []
+        def setup():
+            context = []
+            contexts.append(context)
+            return context
+        def record(item, context):
+            context.append(item)
+            time.sleep(0.01)
+            return item
+
+        closed = []
+        pipeline = Pipeline([
+            PipelineStage("record", record, workers=3, setup=setup, teardown=closed.append)
+        ], keyFunc=str)
+        pipeline.run(range(12))
+        self.assertEqual(len(contexts), 3)
+        self.assertEqual(sorted(item for context in contexts for item in context), list(range(12)))
+        self.assertEqual(len(closed), 3)
+
+    # The items of a worker that cannot start are handled by the others, and
+    # only fail once none of them are left
+    def test_worker_setup_failure(self):
+        starts = []
+        def setup():
+            with self.lock:
+                starts.append(len(starts))
+                if len(starts) > 1:
+                    raise RuntimeError("no connection")
+            return None
+
+        pipeline = Pipeline([
+            PipelineStage("double", self.double, workers=3, setup=setup)
+        ], keyFunc=str)
+        summary = pipeline.run(range(6))
+        self.assertEqual(summary["processed"], 5)
+        self.assertEqual(summary["failed"], [("3", "double: ValueError('bad item')")])
+
+        def failSetup():
+            raise RuntimeError("no connection")
+
+        pipeline = Pipeline([
+            PipelineStage("double", self.double, workers=2, setup=failSetup)
+        ], keyFunc=str)
+        summary = pipeline.run(range(4))
+        self.assertEqual(summary["processed"], 0)
+        self.assertEqual(len(summary["failed"]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from helpers.postgres import postgresManager
+
+class TestFuzzyLookup(unittest.TestCase):
+
+    def setUp(self):
+        # The token query is built without a connection
+        self.db = postgresManager.__new__(postgresManager)
+
+    def test_short_values_match_any_word(self):
+        self.assertEqual(self.db._createTokenQuery("Twain, Mark"), "twain | mark")
+        self.assertEqual(self.db._createTokenQuery("Homer"), "homer")
+
+    # A row missing any one of the words, such as a misspelled one, is still
+    # a candidate
+    def test_all_words_but_one(self):
+        self.assertEqual(
+            self.db._createTokenQuery("Paradise Lost, Book 1"),
+            "(lost & book & 1) | (paradise & book & 1) | (paradise & lost & 1) | (paradise & lost & book)"
+        )
+
+    def test_operators_dropped(self):
+        self.assertEqual(self.db._createTokenQuery("Tom & (Jerry) | !"), "tom | jerry")
+        self.assertEqual(self.db._createTokenQuery("_ & !"), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from lib.gutenberg_records import WorkRecord, EntityRecord, IdentifierRecord
+
+class TestRecords(unittest.TestCase):
+
+    def test_defaults(self):
+        work = WorkRecord(title="Paradise Lost")
+        self.assertEqual(work.title, "Paradise Lost")
+        self.assertIsNone(work.ids)
+        self.assertEqual(work.entities, [])
+        self.assertIsNot(work.entities, WorkRecord().entities)
+
+    def test_unknown_field(self):
+        with self.assertRaises(TypeError):
+            EntityRecord(name="Milton, John", birthdate="1608")
+
+    def test_no_instance_dict(self):
+        iden = IdentifierRecord(type="gutenberg", identifier="1034")
+        with self.assertRaises(AttributeError):
+            iden.id = "1034"
+        self.assertEqual(iden.toDict(), {"type": "gutenberg", "identifier": "1034"})
+        self.assertEqual(iden, IdentifierRecord(type="gutenberg", identifier="1034"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import logging
+import psycopg2
+import testing.postgresql
+
+from helpers.postgres import postgresManager
+from lib.gutenberg_reindex import GutenbergReindex
+
+postgresql = None
+
+
+def getDSN():
+    return "host={host} port={port} user={user} dbname={database}".format(**postgresql.dsn())
+
+
+def setUpModule():
+    global postgresql
+    try:
+        postgresql = testing.postgresql.Postgresql()
+    except RuntimeError as err:
+        raise unittest.SkipTest("Postgres could not be started: {}".format(err))
+
+
+def tearDownModule():
+    postgresql.stop()
+
+
+# Records what would have been sent to ES. A failed flush is counted as
+# failed documents in the same way as GutenbergES
+class MockESConnector:
+
+    def __init__(self):
+        self.sent = []
+        self.failures = 0
+        self.failFlush = False
+        self.beforeFlush = None
+        self.buffer = []
+        self.bufferBytes = 0
+
+    def dropES(self, workID):
+        self.sent.append(workID)
+
+    def storeWorks(self, workIDs):
+        self.sent.extend(workIDs)
+
+    def flush(self):
+        if self.beforeFlush is not None:
+            self.beforeFlush()
+        if self.failFlush is True:
+            self.failures += 1
+
+
+class TestGutenbergReindex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = postgresManager(dsn=getDSN())
+        self.db.getCursor()
+        self.db.cursor.execute("TRUNCATE reindex_queue")
+        self.db.cursor.execute("""
+            INSERT INTO reindex_queue (work_id, queued) VALUES
+            (1, NOW() - INTERVAL '3 seconds'),
+            (2, NOW() - INTERVAL '2 seconds'),
+            (3, NOW() - INTERVAL '1 second')
+        """)
+        self.db.commitOps()
+
+        # The queue is read from Postgres, only the ES side is replaced
+        self.reindex = GutenbergReindex.__new__(GutenbergReindex)
+        self.reindex.logger = logging.getLogger('guten_logs')
+        self.reindex.esConnector = MockESConnector()
+        self.reindex.db = self.db
+        self.reindex.batchSize = 2
+        self.reindex.pollInterval = 0
+        self.reindex.claimTimeout = 600
+
+        # Another connection stands in for ingest and other reindex workers
+        self.other = psycopg2.connect(getDSN())
+
+    def getQueue(self):
+        cursor = self.other.cursor()
+        cursor.execute("SELECT work_id, claimed_until IS NOT NULL FROM reindex_queue ORDER BY work_id")
+        rows = cursor.fetchall()
+        self.other.commit()
+        return rows
+
+    def execOther(self, query):
+        cursor = self.other.cursor()
+        cursor.execute(query)
+        self.other.commit()
+
+    def test_sent_works_removed(self):
+        self.assertEqual(self.reindex.run(), 3)
+        self.assertEqual(sorted(self.reindex.esConnector.sent), [1, 2, 3])
+        self.assertEqual(self.getQueue(), [])
+
+    def test_failed_batch_released(self):
+        self.reindex.esConnector.failFlush = True
+        with self.assertRaises(RuntimeError):
+            self.reindex.run()
+        self.assertEqual(self.getQueue(), [(1, False), (2, False), (3, False)])
+
+        self.reindex.esConnector.failFlush = False
+        self.assertEqual(self.reindex.run(), 3)
+        self.assertEqual(self.getQueue(), [])
+
+    # A work queued again while its batch is being sent keeps its place in
+    # the queue, so its newer change is sent with the next batch
+    def test_requeued_during_send(self):
+        def requeue():
+            self.reindex.esConnector.beforeFlush = None
+            self.execOther("UPDATE reindex_queue SET queued = NOW() WHERE work_id = 1")
+
+        self.reindex.esConnector.beforeFlush = requeue
+        self.assertEqual(self.reindex.drainBatch(), 2)
+        self.assertEqual(self.getQueue(), [(1, False), (3, False)])
+        self.assertEqual(self.reindex.drain(), 2)
+        sent = self.reindex.esConnector.sent
+        self.assertEqual((sorted(sent[:2]), sorted(sent[2:])), ([1, 2], [1, 3]))
+
+    # Works claimed by a worker that stopped are left alone until the claim
+    # runs out and then sent by the next worker to poll
+    def test_claims_expire(self):
+        self.execOther("UPDATE reindex_queue SET claimed_until = NOW() + INTERVAL '1 hour' WHERE work_id = 1")
+        self.execOther("UPDATE reindex_queue SET claimed_until = NOW() - INTERVAL '1 second' WHERE work_id = 2")
+        self.assertEqual(self.reindex.run(), 2)
+        self.assertEqual(sorted(self.reindex.esConnector.sent), [2, 3])
+        self.assertEqual(self.getQueue(), [(1, True)])
+
+    # An aborted transaction is rolled back so the next poll can go on
+    def test_recover_aborted_transaction(self):
+        self.db.getCursor()
+        with self.assertRaises(psycopg2.Error):
+            self.db.cursor.execute("SELECT 1 / 0")
+        self.reindex.esConnector.buffer = [{"_id": 1}]
+        with self.assertRaises(psycopg2.Error):
+            self.reindex.run()
+        self.assertEqual(self.reindex.esConnector.buffer, [])
+        self.assertEqual(self.reindex.run(), 3)
+
+    def tearDown(self):
+        self.other.close()
+        self.db.closeAll()
+
+
+if __name__ == '__main__':
+    unittest.main()
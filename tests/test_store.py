@@ -0,0 +1,121 @@
+import unittest
+import testing.postgresql
+
+from lib.gutenberg_records import WorkRecord, IdentifierRecord, SubjectRecord, EntityRecord
+from lib.gutenberg_store import GutenbergDB
+
+postgresql = None
+
+
+def getDSN():
+    return "host={host} port={port} user={user} dbname={database}".format(**postgresql.dsn())
+
+
+def setUpModule():
+    global postgresql
+    try:
+        postgresql = testing.postgresql.Postgresql()
+    except RuntimeError as err:
+        raise unittest.SkipTest("Postgres could not be started: {}".format(err))
+
+
+def tearDownModule():
+    postgresql.stop()
+
+
+class TestLookupCacheCoherence(unittest.TestCase):
+
+    def setUp(self):
+        self.db = GutenbergDB(dsn=getDSN(), cacheSize=100)
+        # Only exact matches are needed to tell these works apart
+        self.db.cursor.execute("""
+            CREATE OR REPLACE FUNCTION jarowinkler(TEXT, TEXT) RETURNS FLOAT AS
+            'SELECT CASE WHEN $1 = $2 THEN 1.0 ELSE 0.0 END' LANGUAGE SQL IMMUTABLE
+        """)
+        self.db.cursor.execute("""
+            TRUNCATE works, instances, items, entities, entity_works, entity_instances,
+            entity_items, subjects, subject_works, identifiers, work_identifiers,
+            instance_identifiers, item_identifiers RESTART IDENTITY
+        """)
+        self.db.commitOps()
+
+    def createWork(self, bookID, subject, viaf, birth=None):
+        return WorkRecord(
+            title="Book {}".format(bookID),
+            rights_stmt="Public domain in the USA.",
+            language="en",
+            ids=[IdentifierRecord(type="gutenberg", identifier="gb{}".format(bookID))],
+            subjects=[SubjectRecord(authority="lcsh", subject=subject)],
+            entities=[EntityRecord(name="Author {}".format(bookID), role="author", viaf=viaf, birth=birth)]
+        )
+
+    def getCached(self, cacheName, key):
+        return self.db.lookupCaches[cacheName].entries.get(key)
+
+    def getRowID(self, query, value):
+        self.db.cursor.execute(query, [value])
+        row = self.db.cursor.fetchone()
+        return row["id"] if row is not None else None
+
+    # Every cached ID is one that exists in the table it was read from
+    def assertCached(self, subject, viaf, bookID):
+        self.assertEqual(
+            self.getCached("subject", ("lcsh", subject)),
+            self.getRowID("SELECT id FROM subjects WHERE subject = %s", subject)
+        )
+        self.assertEqual(
+            self.getCached("entity", ("viaf", viaf)),
+            self.getRowID("SELECT id FROM entities WHERE viaf = %s", viaf)
+        )
+        self.assertEqual(
+            self.getCached("identifier", ("work", "gb{}".format(bookID))),
+            self.getRowID("""
+                SELECT l.work_id AS id FROM work_identifiers l
+                JOIN identifiers i ON i.id = l.identifier_id WHERE i.identifier = %s
+            """, "gb{}".format(bookID))
+        )
+        self.db.commitOps()
+
+    def assertNotCached(self, subject, viaf, bookID):
+        self.assertIsNone(self.getCached("subject", ("lcsh", subject)))
+        self.assertIsNone(self.getCached("entity", ("viaf", viaf)))
+        self.assertIsNone(self.getCached("identifier", ("work", "gb{}".format(bookID))))
+
+    def test_cached_on_commit(self):
+        self.db._insertWork(self.createWork(1, "Fiction", "100"), [])
+        self.assertNotCached("Fiction", "100", 1)
+        self.db.commitOps()
+        self.assertIsNotNone(self.getCached("subject", ("lcsh", "Fiction")))
+        self.assertCached("Fiction", "100", 1)
+
+    def test_dropped_on_rollback(self):
+        self.db._insertWork(self.createWork(2, "Poetry", "200"), [])
+        self.db.rollbackOps()
+        self.assertNotCached("Poetry", "200", 2)
+        self.assertEqual(self.db.pendingCache, [])
+
+        # Stored again, the new rows are the ones cached
+        self.db.insert_record(self.createWork(2, "Poetry", "200"), [])
+        self.assertIsNotNone(self.getCached("subject", ("lcsh", "Poetry")))
+        self.assertCached("Poetry", "200", 2)
+
+    # A work rolled back to its savepoint leaves nothing in the cache while
+    # the rest of the batch is cached as it is committed
+    def test_failed_work_in_batch(self):
+        results = self.db.insert_records([
+            (self.createWork(3, "History", "300"), []),
+            (self.createWork(4, "Drama", "400", birth="unknown"), [])
+        ])
+        self.assertEqual([res["result"] for res in results], [0, 1])
+        self.assertIsNotNone(self.getCached("subject", ("lcsh", "History")))
+        self.assertCached("History", "300", 3)
+        self.assertNotCached("Drama", "400", 4)
+        self.assertIsNone(self.getRowID("SELECT id FROM subjects WHERE subject = %s", "Drama"))
+        self.db.commitOps()
+
+    def tearDown(self):
+        self.db.closeAll()
+
+
+if __name__ == '__main__':
+    unittest.main()